@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+# Benchmarks for the parser and the editing hot paths of proj.py.
+#
+#   bench.py run [--sizes 100 10000 1000000] [--repeat N] [--output results.json]
+#   bench.py compare old.json new.json [--threshold 1.5]
+#
+# run builds synthetic CMakeLists of roughly the given numbers of lines, times each
+# benchmark at each size, measures the memory taken by the parse tree, and prints
+# (or saves) the results as JSON. It also prints how each benchmark scales from
+# one size to the next; a benchmark that grows much faster than the input is
+# flagged. compare prints the ratio of new to old
+# time for every benchmark and size, flags those slower by more than the
+# threshold, and exits non-zero if any were.
+
+import chunkparser
+import optparser
+import proj
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+projscript = os.path.join(here, 'proj.py')
+
+# Return the text of a managed executable CMakeLists with the given numbers of
+# sources, defines, libs and subdirs, and a chunk nested depth levels deep
+def synthetic(sources, defines=0, libs=0, subdirs=0, depth=0, name='bench'):
+  lines = [
+    '# This file is managed by proj.',
+    '',
+    'cmake_minimum_required(VERSION 3.0)',
+    '',
+    '# --== proj begin executable ==--',
+    '',
+    '# --== proj begin projectname ==--',
+    'project(proj_%s)' % name,
+    '# --== proj end projectname ==--',
+    '',
+    '# --== proj begin addexe ==--',
+    'add_executable(',
+    '# --== proj begin exename ==--',
+    name,
+    '# --== proj end exename ==--',
+    '',
+    '# --== proj begin sources ==--',
+  ]
+  lines += ['src/file%d.cpp' % i for i in xrange(sources)]
+  lines += [
+    '# --== proj end sources ==--',
+    '',
+    '# --== proj begin headers ==--',
+    '# --== proj end headers ==--',
+    ')',
+    '# --== proj end addexe ==--',
+    '',
+    '# --== proj begin definitions ==--',
+  ]
+  lines += ['target_compile_definitions(%s PRIVATE -DDEFINE_%d=%d)' % (name, i, i) for i in xrange(defines)]
+  lines += [
+    '# --== proj end definitions ==--',
+    '',
+    '# --== proj begin linklibs ==--',
+  ]
+  lines += ['target_link_libraries(%s general lib%d)' % (name, i) for i in xrange(libs)]
+  lines += [
+    '# --== proj end linklibs ==--',
+    '',
+    '# --== proj begin subdirs ==--',
+  ]
+  lines += ['add_subdirectory(sub%d)' % i for i in xrange(subdirs)]
+  lines += ['# --== proj end subdirs ==--', '']
+  lines += ['# --== proj begin nested%d ==--' % i for i in xrange(depth)]
+  lines += ['# --== proj end nested%d ==--' % i for i in reversed(xrange(depth))]
+  lines += ['# --== proj end executable ==--', '']
+  return '\n'.join(lines)
+
+# Split a number of lines between the kinds of statement, the way a big generated
+# project tends to look: mostly sources, then defines, libs and subdirs
+def synthetic_for_lines(lines):
+  depth = min(lines / 100, 100)
+  body = max(lines - 40 - 2 * depth, 4)
+  return synthetic(body * 6 / 10, body * 2 / 10, body / 10, body / 10, depth)
+
+# Set the (kind, NAME=value) defines one at a time through project, a
+# proj.Project, and make the changes
+def project_set_defines(project, kinded):
+  for kind, define in kinded:
+    name, eq, value = define.partition('=')
+    project.set_define(name, value, kind)
+  project._apply()
+
+# Return the shortest time taken by repeat calls of func(setup()). Only func is
+# timed, so setup can prepare fresh data for each call.
+def best_time(func, repeat, setup=lambda: None):
+  best = None
+  for i in xrange(repeat):
+    arg = setup()
+    start = time.time()
+    func(arg)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+# Code run in a fresh interpreter to measure how much the peak memory use of the
+# process grows while parsing a file, either as proj does or with every line read
+# into its own string (as the tree used to be held)
+#
+# On Linux, ru_maxrss carries over from the process that started us, so the peak
+# is taken from /proc where it can be
+memory_script = '''
+import sys
+import resource
+sys.path.insert(0, %(here)r)
+import chunkparser
+def peak():
+  try:
+    for line in open('/proc/self/status'):
+      if line.startswith('VmHWM:'):
+	return int(line.split()[1])
+  except IOError:
+    pass
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    peak /= 1024
+  return peak
+f = open(%(filename)r)
+text = f.read()
+f.seek(0)
+before = peak()
+if %(lists)r:
+  chunks = chunkparser.parse(line for line in f)
+else:
+  chunks = chunkparser.parse(text)
+print peak() - before
+'''
+
+# Return the growth in peak memory, in KB, from parsing text
+def parse_memory(text, lists):
+  try:
+    import resource
+  except ImportError:
+    return 0
+  fd, filename = tempfile.mkstemp()
+  try:
+    f = os.fdopen(fd, 'w')
+    f.write(text)
+    f.close()
+    script = memory_script % {'here': here, 'filename': filename, 'lists': lists}
+    return int(subprocess.check_output([sys.executable, '-c', script]))
+  finally:
+    os.remove(filename)
+
+# Benchmarks of proj.py run as a command, on a CMakeLists holding text
+class endtoend(object):
+  def __init__(self, text):
+    self.text = text
+    self.dirname = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dirname, 'CMakeLists.txt')
+
+  def close(self):
+    shutil.rmtree(self.dirname)
+
+  def reset(self):
+    f = open(self.filename, 'w')
+    f.write(self.text)
+    f.close()
+
+  def run(self, args):
+    subprocess.check_call([sys.executable, projscript] + args, cwd=self.dirname, stdout=open(os.devnull, 'w'))
+
+def run_benchmarks(lines, repeat):
+  text = synthetic_for_lines(lines)
+  chunks = chunkparser.parse(text)
+  sources = len(chunkparser.find(chunks, 'sources')[1])
+  defines = len(chunkparser.find(chunks, 'definitions')[1])
+  results = {}
+
+  results['parse'] = best_time(chunkparser.parse, repeat, lambda: text)
+  results['parse_file'] = best_time(chunkparser.parse, repeat, lambda: iter(text.splitlines(True)))
+  results['generate'] = best_time(chunkparser.generate, repeat, lambda: chunks)
+
+  # Add as many sources again, half of them already present, and remove half
+  newsources = ['src/file%d.cpp' % i for i in xrange(sources / 2, sources + sources / 2)]
+  oldsources = ['src/file%d.cpp' % i for i in xrange(0, sources, 2)]
+  fresh = lambda: ['sources', list(chunkparser.find(chunks, 'sources')[1])]
+  results['add_to_chunk'] = best_time(lambda c: proj._add_to_chunk(c, newsources, True), repeat, fresh)
+  results['remove_from_chunk'] = best_time(lambda c: proj._add_to_chunk(c, oldsources, False), repeat, fresh)
+
+  # Change the value of half the defines and add as many new ones
+  kinded = [('PRIVATE', 'DEFINE_%d=x' % i) for i in xrange(defines / 2, defines + defines / 2)]
+  edits = [proj._define_edit('bench', 'PRIVATE', 'DEFINE_%d' % i, '=x', True) for i in xrange(defines / 2, defines + defines / 2)]
+  fresh = lambda: list(chunkparser.find(chunks, 'definitions')[1])
+  results['add_or_modify_defines'] = best_time(lambda c: proj._edit_statements(c, proj._define, proj._define_key, edits, True), repeat, fresh)
+
+  # The same defines set one at a time through the Project API, which should cost
+  # about as much
+  fresh = lambda: proj.Project(chunkparser.parse(text))
+  results['project_set_define'] = best_time(lambda p: project_set_defines(p, kinded), repeat, fresh)
+
+  e2e = endtoend(text)
+  try:
+    results['cmd_add'] = best_time(lambda a: e2e.run(['add', '--sources', 'new.cpp']), repeat, e2e.reset)
+    results['cmd_add_unchanged'] = best_time(lambda a: e2e.run(['add', '--sources', 'src/file0.cpp']), repeat, e2e.reset)
+    results['cmd_remove'] = best_time(lambda a: e2e.run(['remove', '--sources', 'src/file0.cpp']), repeat, e2e.reset)
+    # Command lines can only be so long, so new gets at most 10000 sources
+    newargs = ['new', 'executable', '--name', 'bench', '--sources'] + ['src/file%d.cpp' % i for i in xrange(min(sources, 10000))]
+    results['cmd_new'] = best_time(lambda a: e2e.run(newargs), repeat, lambda: os.path.exists(e2e.filename) and os.remove(e2e.filename))
+  finally:
+    e2e.close()
+
+  memory = {
+    'parse': parse_memory(text, False),
+    'parse_lists': parse_memory(text, True),
+  }
+
+  return len(text.split('\n')), results, memory
+
+# Print how the time of each benchmark grows from each size to the next, as the
+# exponent k in time ~ lines ** k, flagging anything much worse than linear
+def print_scaling(report):
+  sizes = sorted(report['lines'].keys(), key=int)
+  for name in sorted(report['results']):
+    times = report['results'][name]
+    exponents = []
+    for a, b in zip(sizes, sizes[1:]):
+      ta, tb = times[a], times[b]
+      if ta > 0 and tb > 0:
+	exponents.append(math.log(tb / ta) / math.log(float(report['lines'][b]) / report['lines'][a]))
+    flag = ''
+    if exponents and exponents[-1] > 1.3:
+      flag = '  <-- worse than linear'
+    sys.stderr.write('%-24s %s%s\n' % (name, ' '.join('%5.2f' % e for e in exponents), flag))
+
+def cmd_run(groups):
+  sizes = [int(s) for s in groups.get('--sizes') or ['100', '10000', '1000000']]
+  repeat = int((groups.get('--repeat') or ['3'])[0])
+  report = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'time': time.time(),
+    'lines': {},
+    'results': {},
+    'memory': {},
+  }
+  for size in sizes:
+    sys.stderr.write('benchmarking %d lines\n' % size)
+    # Big inputs take long enough that one run is representative
+    lines, results, memory = run_benchmarks(size, repeat if size < 1000000 else 1)
+    report['lines'][str(size)] = lines
+    for name, t in results.items():
+      report['results'].setdefault(name, {})[str(size)] = t
+    for name, kb in memory.items():
+      report['memory'].setdefault(name, {})[str(size)] = kb
+  if len(sizes) > 1:
+    sys.stderr.write('scaling exponents between sizes:\n')
+    print_scaling(report)
+  sys.stderr.write('peak memory growth from parsing, KB (lines as strings):\n')
+  for size in sizes:
+    size = str(size)
+    sys.stderr.write('%10s lines %10d (%d)\n' % (size, report['memory']['parse'][size], report['memory']['parse_lists'][size]))
+
+  output = groups.get('--output')
+  if output:
+    f = open(output[0], 'w')
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
+  else:
+    print json.dumps(report, indent=2, sort_keys=True)
+
+def cmd_compare(old, new, groups):
+  threshold = float((groups.get('--threshold') or ['1.5'])[0])
+  old = json.load(open(old))
+  new = json.load(open(new))
+  regressions = 0
+  for section, fmt in [('results', '%10.6f -> %10.6f s '), ('memory', '%10d -> %10d KB')]:
+    oldresults = old.get(section, {})
+    newresults = new.get(section, {})
+    for name in sorted(newresults):
+      for size in sorted(newresults[name], key=int):
+	if size not in oldresults.get(name, {}):
+	  continue
+	before = oldresults[name][size]
+	after = newresults[name][size]
+	ratio = float(after) / before if before > 0 else 1.0
+	flag = ''
+	if ratio > threshold:
+	  flag = '  <-- regression'
+	  regressions += 1
+	print ('%-24s %8s lines  ' + fmt + '  x%.2f%s') % (name, size, before, after, ratio, flag)
+  if regressions:
+    print '%d regressions' % regressions
+    sys.exit(1)
+
+if __name__ == '__main__':
+  preflags, cmdwords, groups = optparser.parse(sys.argv[1:])
+  if cmdwords == ['run']:
+    cmd_run(groups)
+  elif len(cmdwords) == 3 and cmdwords[0] == 'compare':
+    cmd_compare(cmdwords[1], cmdwords[2], groups)
+  else:
+    print 'usage: bench.py run [--sizes N...] [--repeat N] [--output FILE]'
+    print '       bench.py compare OLD.json NEW.json [--threshold RATIO]'
+    sys.exit(1)
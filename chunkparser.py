@@ -1,55 +1,540 @@
 import re
+import bisect
+import itertools
 
 _beg = re.compile(r'# --== proj begin (.+) ==--\s*')
 _end = re.compile(r'# --== proj end (.+) ==--\s*')
 
+# Raised by parse() for text whose chunk markers don't match up
+class ParseError(Exception):
+  pass
+
+# A named chunk. It behaves like the list [name, children] it used to be: c[0] is
+# the name, c[1] the children, and it compares equal to such a list.
+class Chunk(object):
+  __slots__ = ('name', 'children')
+
+  def __init__(self, name, children):
+    self.name = name
+    self.children = children
+
+  def __getitem__(self, i):
+    return (self.name, self.children)[i]
+
+  def __setitem__(self, i, value):
+    if i == 0 or i == -2:
+      self.name = value
+    elif i == 1 or i == -1:
+      self.children = value
+    else:
+      raise IndexError('chunk index out of range')
+
+  def __len__(self):
+    return 2
+
+  def __iter__(self):
+    return iter((self.name, self.children))
+
+  def __eq__(self, other):
+    if not isinstance(other, (Chunk, list, tuple)) or len(other) != 2:
+      return NotImplemented
+    return self.name == other[0] and self.children == other[1]
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return repr([self.name, self.children])
+
+# Things in a list of children that are chunks rather than plain lines
+_chunk_types = (Chunk, list)
+
+# Return True if item, from a list of children, is a chunk rather than a line
+def is_chunk(item):
+  return type(item) in _chunk_types
+
+def is_line(item):
+  return type(item) not in _chunk_types
+
+# The children of a chunk, a list of lines and chunks. parse() doesn't make a
+# string of every line: a Lines holds the text it was parsed from, and each run of
+# consecutive lines is just where it starts and ends in that text. Counting,
+# iterating over and generating the children never needs more, and the lines
+# become strings only when one is looked up by index or the children change,
+# which turns them into an ordinary list of strings and chunks. Either way, a
+# Lines works like a list.
+class Lines(object):
+  __slots__ = ('_buf', '_parts', '_items')
+
+  def __init__(self, items=()):
+    self._buf = None
+    self._parts = None
+    self._items = list(items)
+
+  # Hold the children given by parts, a list of chunks and (start, end) pairs,
+  # each pair standing for the lines in buf[start:end]
+  def _set(self, buf, parts):
+    self._buf = buf
+    self._parts = parts
+    self._items = None
+
+  # Return the children as a list of strings and chunks that can be changed
+  def _list(self):
+    if self._items is None:
+      self._items = list(self)
+      self._buf = None
+      self._parts = None
+    return self._items
+
+  def __len__(self):
+    if self._items is not None:
+      return len(self._items)
+    n = 0
+    count = self._buf.count
+    for part in self._parts:
+      if type(part) is tuple:
+	n += count('\n', part[0], part[1]) + 1
+      else:
+	n += 1
+    return n
+
+  def __iter__(self):
+    if self._items is not None:
+      return iter(self._items)
+    return self._iter()
+
+  def _iter(self):
+    buf = self._buf
+    for part in self._parts:
+      if type(part) is tuple:
+	for line in buf[part[0]:part[1]].split('\n'):
+	  yield line
+      else:
+	yield part
+
+  # Iterate over the children with each run of consecutive lines as one string,
+  # joined by newlines, which is how they are generated
+  def _runs(self):
+    if self._items is not None:
+      return iter(self._items)
+    return self._iter_runs()
+
+  def _iter_runs(self):
+    buf = self._buf
+    for part in self._parts:
+      if type(part) is tuple:
+	yield buf[part[0]:part[1]]
+      else:
+	yield part
+
+  def __getitem__(self, i):
+    return self._list()[i]
+
+  def __setitem__(self, i, value):
+    self._list()[i] = value
+
+  def __delitem__(self, i):
+    del self._list()[i]
+
+  # Python 2 calls these for simple slices of objects that have them
+  def __getslice__(self, i, j):
+    return self._list()[i:j]
+
+  def __setslice__(self, i, j, value):
+    self._list()[i:j] = value
+
+  def __delslice__(self, i, j):
+    del self._list()[i:j]
+
+  def append(self, item):
+    self._list().append(item)
+
+  def extend(self, items):
+    self._list().extend(items)
+
+  def insert(self, i, item):
+    self._list().insert(i, item)
+
+  def pop(self, i=-1):
+    return self._list().pop(i)
+
+  def remove(self, item):
+    self._list().remove(item)
+
+  def __iadd__(self, items):
+    self._list().extend(items)
+    return self
+
+  def index(self, item):
+    return list(self).index(item)
+
+  def count(self, item):
+    return list(self).count(item)
+
+  def __eq__(self, other):
+    if not isinstance(other, (Lines, list, tuple)):
+      return NotImplemented
+    if len(self) != len(other):
+      return False
+    for a, b in itertools.izip(self, other):
+      if a != b:
+	return False
+    return True
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return repr(list(self))
+
+# The result of parse(): the top level lines and chunks, which also indexes every
+# named chunk it contains, at any depth, by name. When a name is used more than
+# once, the index holds the first chunk with that name in file order.
+#
+# spans lists [chunk, start, end] for every chunk in file order, where start and
+# end are the byte offsets of the chunk's body in the parsed text: the text
+# between the end of its begin marker line and the start of its end marker line.
+# dirty lists the chunks that have been changed since (see changed()). Together
+# they let a writer rewrite only the bodies of the chunks that changed. Chunks
+# not made by parse() have no spans.
+class Chunks(Lines):
+  def __init__(self, items=()):
+    Lines.__init__(self, items)
+    self.names = {}
+    self.spans = None
+    self.dirty = []
+
+# Every begin and end marker starts with this, so a line that doesn't can be
+# rejected without running the regexes
+_marker = '# --== proj '
+_nlmarker = '\n' + _marker
+
+# Parse data, which is a string, a file (anything with a read method) or any
+# other iterable of lines. The chunk tree is built with an explicit stack of open
+# chunks, so nesting depth is not limited by the recursion limit.
+#
+# A string, or the contents of a file, is kept whole and the children of every
+# chunk are Lines pointing into it, so no string is made for a line until it is
+# needed. Other iterables are read one line at a time into lists.
 def parse(data):
-  return _parse((l for l in data.split('\n')), None)
-    
-def _parse(lines, currname):
-  # List of subchunks to return
-  chunks = []
-  
-  # Line buffer
-  buf = []
-  
-  # For each line...
-  line = next(lines, None)
-  while line is not None:
+  if hasattr(data, 'read'):
+    data = data.read()
+  if isinstance(data, basestring):
+    return _parse_buffer(data)
+  return _parse_lines(_split_lines(data))
+
+def _parse_buffer(buf):
+  chunks = Chunks()
+  names = chunks.names
+  spans = chunks.spans = []
+  size = len(buf)
+  find = buf.find
+
+  # Stack of (chunk, offset of its begin marker, its span, parts) for every open
+  # chunk, the parts (see Lines._set) of the children currently being read, and
+  # where the run of lines that will go in them next starts
+  stack = []
+  parts = []
+  run = 0
+
+  pos = 0
+  while pos <= size:
+    # Find the next line that looks like a marker. Everything before it belongs
+    # to the current run of lines.
+    if buf.startswith(_marker, pos):
+      marker = pos
+    else:
+      marker = find(_nlmarker, pos)
+      if marker < 0:
+	break
+      marker += 1
+    eol = find('\n', marker)
+    if eol < 0:
+      eol = size
+    line = buf[marker:eol]
+    pos = eol + 1
+
     matchbegin = _beg.match(line)
+    if matchbegin:
+      if marker > run:
+	parts.append((run, marker - 1))
+      name = matchbegin.group(1)
+      subchunk = Chunk(name, Lines())
+      # Index the chunk when it opens so that the index keeps the first
+      # occurrence of a name in file order
+      names.setdefault(name, subchunk)
+      parts.append(subchunk)
+      span = [subchunk, pos, None]
+      spans.append(span)
+      stack.append((subchunk, marker, span, parts))
+      parts = []
+      run = pos
+      continue
     matchend = _end.match(line)
-    if not matchbegin and not matchend:
-      buf.append(line)
-    else:
-      if buf:
-	chunks += buf
-	buf = []
+    if matchend:
+      name = matchend.group(1)
+      currname = None
+      if stack:
+	currname = stack[-1][0].name
+      if name != currname:
+	raise ParseError('line %d: unexpected chunk close marker \'%s\' (expected \'%s\')' % (buf.count('\n', 0, marker) + 1, name, currname))
+      if marker > run:
+	parts.append((run, marker - 1))
+      subchunk, begin, span, parentparts = stack.pop()
+      span[2] = marker
+      subchunk.children._set(buf, parts)
+      parts = parentparts
+      run = pos
+    # Any other line is part of the run
+
+  # Like str.split('\n'), text ending in a newline ends with an empty line
+  if run <= size:
+    parts.append((run, size))
+  if stack:
+    subchunk, begin, span, parentparts = stack[-1]
+    raise ParseError('line %d: missing chunk close marker (expected \'%s\')' % (buf.count('\n', 0, begin) + 1, subchunk.name))
+  chunks._set(buf, parts)
+  return chunks
+
+def _parse_lines(lines):
+  chunks = Chunks()
+  names = chunks.names
+  spans = chunks.spans = []
+
+  # Stack of (chunk, line number of its begin marker, its span) for every open
+  # chunk, and the list that lines are currently being added to
+  stack = []
+  children = chunks._items
+
+  lineno = 0
+  # Byte offset of the start of the next line
+  offset = 0
+  for line in lines:
+    lineno += 1
+    start = offset
+    offset += len(line) + 1
+    if line.startswith(_marker):
+      matchbegin = _beg.match(line)
       if matchbegin:
 	name = matchbegin.group(1)
-	subchunk = _parse(lines, name)
-	chunks.append([name, subchunk])
-      else:
+	subchunk = Chunk(name, [])
+	# Index the chunk when it opens so that the index keeps the first
+	# occurrence of a name in file order
+	names.setdefault(name, subchunk)
+	children.append(subchunk)
+	span = [subchunk, offset, None]
+	spans.append(span)
+	stack.append((subchunk, lineno, span))
+	children = subchunk.children
+	continue
+      matchend = _end.match(line)
+      if matchend:
 	name = matchend.group(1)
+	currname = None
+	if stack:
+	  currname = stack[-1][0].name
 	if name != currname:
-	  raise Exception('unexpected chunk close marker \'%s\' (expected \'%s\')' % (name, currname))
-	break
-    line = next(lines, None)
+	  raise ParseError('line %d: unexpected chunk close marker \'%s\' (expected \'%s\')' % (lineno, name, currname))
+	stack.pop()[2][2] = start
+	if stack:
+	  children = stack[-1][0].children
+	else:
+	  children = chunks._items
+	continue
+    children.append(line)
 
-  if line is None and currname is not None:
-    raise Exception('missing chunk close marker (expected \'%s\')' % currname)
-  
-  if buf:
-    chunks += buf
+  if stack:
+    subchunk, beginline, span = stack[-1]
+    raise ParseError('line %d: missing chunk close marker (expected \'%s\')' % (beginline, subchunk.name))
   return chunks
 
+# Yield the lines of a file without their line endings. Like str.split('\n'), a
+# final newline (or an empty file) produces a last empty line.
+def _split_lines(f):
+  line = '\n'
+  for line in f:
+    if line.endswith('\n'):
+      yield line[:-1]
+    else:
+      yield line
+  if line.endswith('\n'):
+    yield ''
+
+# Find the named chunk anywhere in chunks, or return None. This is a dictionary
+# lookup for the result of parse(), and a depth first search for any other list.
+def find(chunks, name):
+  names = getattr(chunks, 'names', None)
+  if names is not None:
+    return names.get(name)
+  for c in chunks:
+    if type(c) in _chunk_types:
+      if c[0] == name:
+	return c
+      c = find(c[1], name)
+      if c is not None:
+	return c
+  return None
+
 def generate(chunks):
-  return str.join('\n', map(_gen, chunks))
-
-def _gen(chunk):
-  if type(chunk) == type([]):
-    name = chunk[0]
-    inner = generate(chunk[1])
-    if inner != '':
-      inner += '\n'
-    return '# --== proj begin %s ==--\n%s# --== proj end %s ==--' % (name, inner, name)
-  return chunk
\ No newline at end of file
+  return ''.join(pieces(chunks))
+
+# Return the text of the body of a chunk, which is what goes between its begin
+# and end markers when it is generated
+def body(chunk):
+  children = chunk[1]
+  if _empty(children):
+    return ''
+  return ''.join(pieces(children)) + '\n'
+
+# Record that chunk, which is chunks itself or any chunk in it, has been changed
+def changed(chunks, chunk):
+  dirty = getattr(chunks, 'dirty', None)
+  if dirty is not None and not [c for c in dirty if c is chunk]:
+    dirty.append(chunk)
+
+# Insert a new, empty chunk called name at index i of the children of parent, a
+# chunk in chunks, and return it. The chunk is indexed by name, and it and parent
+# are recorded as changed.
+def insert(chunks, parent, i, name):
+  chunk = Chunk(name, [])
+  parent[1].insert(i, chunk)
+  names = getattr(chunks, 'names', None)
+  if names is not None:
+    names.setdefault(name, chunk)
+  changed(chunks, parent)
+  changed(chunks, chunk)
+  return chunk
+
+# Return the edits that turn the text chunks were parsed from into their text now,
+# as (start, end, new body) triples in file order: the body of every changed
+# chunk that isn't inside another changed chunk is replaced. Return None if that
+# isn't possible, because chunks weren't parsed from text, or chunks itself (or a
+# chunk that wasn't there when it was parsed, other than inside a changed chunk
+# that was) has changed.
+def patches(chunks):
+  spans = getattr(chunks, 'spans', None)
+  if spans is None:
+    return None
+  dirty = set(id(c) for c in chunks.dirty)
+  if id(chunks) in dirty:
+    return None
+  result = []
+  replaced = []
+  for chunk, start, end in spans:
+    if id(chunk) in dirty:
+      dirty.remove(id(chunk))
+      # Spans come in file order, so a chunk inside the last one replaced
+      # starts before the end of it
+      if not result or start >= result[-1][1]:
+	result.append((start, end, body(chunk)))
+	replaced.append(chunk)
+  # New chunks are written with the body of the chunk they're in
+  stack = [c[1] for c in replaced]
+  while dirty and stack:
+    for item in stack.pop():
+      if type(item) in _chunk_types:
+	dirty.discard(id(item))
+	stack.append(item[1])
+  if dirty:
+    return None
+  return result
+
+# Bring the spans of chunks up to date after the edits given by patches() (or a
+# subset of them, which left the rest of the text alone) have been applied to
+# the text they were parsed from, and forget which chunks changed
+def patched(chunks, edits):
+  starts = [e[0] for e in edits]
+  ends = [e[1] for e in edits]
+  # How far each offset at or after the end of the ith edit moves
+  shifts = []
+  shift = 0
+  for start, end, text in edits:
+    shift += len(text) - (end - start)
+    shifts.append(shift)
+  spans = []
+  for span in chunks.spans:
+    chunk, start, end = span
+    i = bisect.bisect_right(starts, start) - 1
+    if i >= 0 and start == starts[i] and end == ends[i]:
+      # The chunk whose body was replaced
+      before = shifts[i - 1] if i > 0 else 0
+      span[1] = start + before
+      span[2] = span[1] + len(edits[i][2])
+    elif i >= 0 and start < ends[i]:
+      # Inside a replaced body, so gone
+      continue
+    else:
+      span[1] = start + _shift(ends, shifts, start)
+      span[2] = end + _shift(ends, shifts, end)
+    spans.append(span)
+  chunks.spans = spans
+  chunks.dirty = []
+
+def _shift(ends, shifts, offset):
+  i = bisect.bisect_right(ends, offset) - 1
+  if i < 0:
+    return 0
+  return shifts[i]
+
+# Write chunks to f, which can be anything with a writelines method, such as an
+# open file or a StringIO
+def write(chunks, f):
+  f.writelines(pieces(chunks))
+
+# Yield the text of chunks as a sequence of strings which, joined, give exactly
+# the same result as generate. Each line and marker is produced once, in a single
+# pass with an explicit stack, so no per-chunk strings are built and copied into
+# their parents.
+def pieces(chunks):
+  # Each stack entry holds an iterator over the items of an open chunk, the name
+  # of that chunk (None for the top level) and whether an item has been emitted
+  stack = [[_items(chunks), None, False]]
+  while stack:
+    top = stack[-1]
+    item = next(top[0], _done)
+    if item is _done:
+      stack.pop()
+      if top[1] is not None:
+	yield '\n# --== proj end %s ==--' % top[1]
+      continue
+
+    # Items within a chunk are separated by newlines
+    if top[2]:
+      yield '\n'
+    top[2] = True
+
+    if type(item) not in _chunk_types:
+      yield item
+      continue
+
+    name, children = item
+    yield '# --== proj begin %s ==--\n' % name
+    if _empty(children):
+      # An empty chunk (or one holding a single empty line) has no content line
+      yield '# --== proj end %s ==--' % name
+    else:
+      stack.append([_items(children), name, False])
+
+_done = object()
+
+# Iterate over children for generating them, taking runs of lines as they are in
+# the parsed text where possible
+def _items(children):
+  if isinstance(children, Lines):
+    return children._runs()
+  return iter(children)
+
+# Return True if children generate no lines: there are none, or just an empty one
+def _empty(children):
+  n = len(children)
+  return n == 0 or (n == 1 and children[0] == '')
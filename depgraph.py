@@ -0,0 +1,153 @@
+# The dependency graph of the targets in a tree of projects. Each target has a
+# type (the type of its project, or 'external' for libraries that aren't built
+# by any project in the tree) and the file it comes from, and depends on other
+# targets either by linking to them ('link') or by adding their directory
+# ('subdir').
+class Graph(object):
+  def __init__(self):
+    # name -> (type, filename)
+    self.targets = {}
+    # name -> {name of a target it depends on -> kind of dependency}
+    self.edges = {}
+
+  def add_target(self, name, kind, filename):
+    current = self.targets.get(name)
+    if current is not None and current[0] != 'external':
+      raise Exception('%s and %s both define target %s' % (current[1], filename, name))
+    self.targets[name] = (kind, filename)
+    self.edges.setdefault(name, {})
+
+  # Record that name depends on dep. A link is the stronger dependency, so it
+  # wins when both are given.
+  def add_dependency(self, name, dep, kind):
+    if name not in self.targets:
+      self.targets[name] = ('external', None)
+      self.edges[name] = {}
+    if dep not in self.targets:
+      self.targets[dep] = ('external', None)
+      self.edges[dep] = {}
+    if self.edges[name].get(dep) != 'link':
+      self.edges[name][dep] = kind
+
+  # Return the names of the targets name depends on, in name order
+  def depends(self, name):
+    return sorted(self.edges[name])
+
+# Return the strongly connected components of graph, each a sorted list of names,
+# with every component after all the components it depends on. Tarjan's algorithm,
+# with an explicit stack so that long chains of dependencies don't hit the
+# recursion limit.
+def components(graph):
+  index = {}
+  low = {}
+  stack = []
+  onstack = set()
+  result = []
+  for root in sorted(graph.targets):
+    if root in index:
+      continue
+    index[root] = low[root] = len(index)
+    stack.append(root)
+    onstack.add(root)
+    work = [(root, iter(graph.depends(root)))]
+    while work:
+      node, deps = work[-1]
+      for dep in deps:
+	if dep not in index:
+	  index[dep] = low[dep] = len(index)
+	  stack.append(dep)
+	  onstack.add(dep)
+	  work.append((dep, iter(graph.depends(dep))))
+	  break
+	if dep in onstack:
+	  low[node] = min(low[node], index[dep])
+      else:
+	work.pop()
+	if work:
+	  parent = work[-1][0]
+	  low[parent] = min(low[parent], low[node])
+	if low[node] == index[node]:
+	  component = []
+	  while True:
+	    n = stack.pop()
+	    onstack.discard(n)
+	    component.append(n)
+	    if n == node:
+	      break
+	  result.append(sorted(component))
+  return result
+
+# Return (order, cycles). order lists every target after the targets it depends
+# on, which is an order they can be built in, except that the targets of a cycle
+# come together. cycles lists the targets of each cycle.
+def order(graph):
+  result = []
+  cycles = []
+  for component in components(graph):
+    result += component
+    if len(component) > 1 or component[0] in graph.edges[component[0]]:
+      cycles.append(component)
+  return result, cycles
+
+# Return every target that depends on one of names, directly or through other
+# targets, in build order
+def dependents(graph, names):
+  rdeps = {}
+  for name, deps in graph.edges.iteritems():
+    for dep in deps:
+      rdeps.setdefault(dep, []).append(name)
+  found = set()
+  queue = []
+  for name in names:
+    if name not in graph.targets:
+      raise Exception('no target named %s' % name)
+    queue.append(name)
+  while queue:
+    for name in rdeps.get(queue.pop(), ()):
+      if name not in found:
+	found.add(name)
+	queue.append(name)
+  return [name for name in order(graph)[0] if name in found]
+
+# Node shapes in dot output, by target type
+_shapes = {
+  'rootproject': 'folder',
+  'executable': 'box',
+  'library': 'ellipse',
+  'external': 'plaintext',
+}
+
+def _quote(name):
+  return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+
+# Return the graph in the dot language of Graphviz. Subdirectory dependencies are
+# dashed.
+def dot(graph):
+  lines = ['digraph proj {']
+  for name in sorted(graph.targets):
+    lines.append('  %s [shape=%s];' % (_quote(name), _shapes[graph.targets[name][0]]))
+  for name in sorted(graph.targets):
+    for dep in graph.depends(name):
+      if graph.edges[name][dep] == 'subdir':
+	lines.append('  %s -> %s [style=dashed];' % (_quote(name), _quote(dep)))
+      else:
+	lines.append('  %s -> %s;' % (_quote(name), _quote(dep)))
+  lines.append('}')
+  return str.join('\n', lines) + '\n'
+
+# Return the graph as JSON: an object with "targets", mapping the name of each
+# target to its "type", "file" and what it "links" to and adds as "subdirs", and
+# the "order" and "cycles" given by order()
+def as_json(graph):
+  import json
+  targets = {}
+  for name, (kind, filename) in graph.targets.iteritems():
+    deps = graph.edges[name]
+    targets[name] = {
+      'type': kind,
+      'file': filename,
+      'links': sorted(d for d in deps if deps[d] == 'link'),
+      'subdirs': sorted(d for d in deps if deps[d] == 'subdir'),
+    }
+  buildorder, cycles = order(graph)
+  return json.dumps({'targets': targets, 'order': buildorder, 'cycles': cycles}, indent=2, sort_keys=True, separators=(',', ': ')) + '\n'
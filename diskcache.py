@@ -0,0 +1,122 @@
+import os
+import errno
+import hashlib
+import tempfile
+import cPickle
+
+# A directory of pickled values, each stored in its own file named after a hash of
+# its key. Reading an entry marks it as recently used by touching its file, and
+# whenever storing an entry takes the directory over maxsize bytes, the least
+# recently used entries are deleted until it is a tenth under maxsize, so that
+# the next few entries fit without deleting any more.
+#
+# Listing and stating the whole directory on every store would make filling the
+# cache quadratic, so the size of the directory is only counted by the first
+# store and when the running total kept since then goes over maxsize.
+#
+# Several processes can share a cache directory: entries are written to a
+# temporary file and renamed into place, and an entry that disappears or can't be
+# read is simply a miss. Each keeps its own running total, so the directory can go
+# over maxsize by what the others have stored until one of them counts it.
+class DiskCache(object):
+  def __init__(self, dirname, maxsize=64 * 1024 * 1024):
+    self.dirname = dirname
+    self.maxsize = maxsize
+    # Bytes in the directory as far as we know, or None before it's been counted
+    self.size = None
+    if not os.path.isdir(dirname):
+      try:
+	os.makedirs(dirname)
+      except OSError as e:
+	if e.errno != errno.EEXIST:
+	  raise
+
+  def _path(self, key):
+    return os.path.join(self.dirname, hashlib.sha1(key).hexdigest() + '.entry')
+
+  # Return the value stored for key, or None
+  def get(self, key):
+    path = self._path(key)
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return None
+    try:
+      try:
+	storedkey, value = cPickle.load(f)
+      except Exception:
+	return None
+    finally:
+      f.close()
+    if storedkey != key:
+      return None
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    return value
+
+  def put(self, key, value):
+    path = self._path(key)
+    fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.dirname)
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+	cPickle.dump((key, value), f, cPickle.HIGHEST_PROTOCOL)
+	size = f.tell()
+      finally:
+	f.close()
+      oldsize = self._entry_size(path)
+      os.rename(tmpname, path)
+    except:
+      if os.path.exists(tmpname):
+	os.remove(tmpname)
+      raise
+    if self.size is not None:
+      self.size += size - oldsize
+    if self.size is None or self.size > self.maxsize:
+      self._evict()
+
+  def remove(self, key):
+    path = self._path(key)
+    size = self._entry_size(path)
+    try:
+      os.remove(path)
+    except OSError:
+      return
+    if self.size is not None:
+      self.size -= size
+
+  # The size of the entry at path, or 0 if there is none
+  def _entry_size(self, path):
+    try:
+      return os.path.getsize(path)
+    except OSError:
+      return 0
+
+  # Count the size of the cache, and if it's over maxsize delete least recently
+  # used entries until it's a tenth under
+  def _evict(self):
+    entries = []
+    total = 0
+    for name in os.listdir(self.dirname):
+      if not name.endswith('.entry'):
+	continue
+      path = os.path.join(self.dirname, name)
+      try:
+	st = os.stat(path)
+      except OSError:
+	continue
+      entries.append((st.st_mtime, st.st_size, path))
+      total += st.st_size
+    if total > self.maxsize:
+      entries.sort()
+      for mtime, size, path in entries:
+	try:
+	  os.remove(path)
+	except OSError:
+	  pass
+	total -= size
+	if total <= self.maxsize * 9 / 10:
+	  break
+    self.size = total
@@ -0,0 +1,208 @@
+import sys
+import time
+import inspect
+
+# resource gives the peak memory use of the process. It only exists on Unix;
+# elsewhere memory is reported as 0.
+try:
+  import resource
+except ImportError:
+  resource = None
+
+# Profiling of one proj.py command, used by --profile.
+#
+# While the command runs, each function doing one phase of the work is replaced by
+# a wrapper that records how many times it was called, how long it took and how
+# much the peak memory use of the process grew meanwhile. Nothing is wrapped when
+# profiling is off, so it costs nothing then.
+#
+# Times are exclusive: time spent in an operation called from another one (such
+# as parsing while loading, or generating text while writing) only counts for
+# the inner operation. Generators, and files being parsed, are timed while they
+# produce each item, so the time the consumer spends between items isn't theirs.
+# Memory isn't exclusive, since the peak an inner operation reached is also
+# reached by the operation that called it.
+#
+# output says where the results go: True prints a table to stderr, a name ending
+# in .json writes them to that file as JSON, and any other name prints the table
+# and also runs the command under cProfile, saving its stats to that file for
+# python -m pstats.
+
+# Phases in the order they usually happen
+PHASES = ['read', 'parse', 'scan', 'lookup', 'edit', 'generate', 'compare', 'write']
+
+class Profiler(object):
+  # functions is a list of (phase, namespace, name): the function called name in
+  # the namespace dictionary (a module's globals) is timed as part of phase
+  def __init__(self, functions, output):
+    self.functions = functions
+    self.output = output
+    # (phase, operation) -> [calls, seconds, peak growth in KB]
+    self.operations = {}
+    # [operation, start time, time in nested operations, peak at start] for each
+    # operation that is running, innermost last
+    self.running = []
+    self.originals = []
+    self.cprofile = None
+
+  def start(self):
+    for phase, namespace, name in self.functions:
+      func = namespace[name]
+      module = namespace.get('__name__')
+      if module == '__main__':
+	module = 'proj'
+      op = (phase, '%s.%s' % (module, name))
+      self.originals.append((namespace, name, func))
+      if inspect.isgeneratorfunction(func):
+	namespace[name] = self._wrap_generator(op, func)
+      elif phase == 'parse':
+	namespace[name] = self._wrap_parse(op, func)
+      else:
+	namespace[name] = self._wrap(op, func)
+    if self.output != True and not self.output.endswith('.json'):
+      import cProfile
+      self.cprofile = cProfile.Profile()
+      self.cprofile.enable()
+    self.started = time.time()
+    self.startpeak = _peak_kb()
+
+  # Put the original functions back and report the results
+  def stop(self):
+    self.elapsed = time.time() - self.started
+    if self.cprofile is not None:
+      self.cprofile.disable()
+      self.cprofile.dump_stats(self.output)
+    for namespace, name, func in reversed(self.originals):
+      namespace[name] = func
+    self.originals = []
+    if self.output != True and self.output.endswith('.json'):
+      import json
+      f = open(self.output, 'w')
+      try:
+	json.dump(self.results(), f, indent=2, sort_keys=True)
+      finally:
+	f.close()
+    else:
+      self.report(sys.stderr)
+
+  def _enter(self, op):
+    self.running.append([op, time.time(), 0.0, _peak_kb()])
+
+  def _leave(self, calls):
+    op, start, nested, peak = self.running.pop()
+    elapsed = time.time() - start
+    if self.running:
+      self.running[-1][2] += elapsed
+    stats = self.operations.setdefault(op, [0, 0.0, 0])
+    stats[0] += calls
+    stats[1] += elapsed - nested
+    stats[2] += _peak_kb() - peak
+
+  def _wrap(self, op, func):
+    def wrapper(*args, **kwargs):
+      self._enter(op)
+      try:
+	return func(*args, **kwargs)
+      finally:
+	self._leave(1)
+    return wrapper
+
+  def _wrap_generator(self, op, func):
+    def wrapper(*args, **kwargs):
+      self._enter(op)
+      try:
+	it = func(*args, **kwargs)
+      finally:
+	self._leave(1)
+      return self._timed(op, it)
+    return wrapper
+
+  # Reading a file while parsing it counts as reading, not parsing
+  def _wrap_parse(self, op, func):
+    def wrapper(data, *args, **kwargs):
+      if hasattr(data, 'read'):
+	self._enter(('read', 'file'))
+	try:
+	  data = data.read()
+	finally:
+	  self._leave(1)
+      elif not isinstance(data, basestring):
+	data = self._timed(('read', 'file lines'), data, 1)
+      self._enter(op)
+      try:
+	return func(data, *args, **kwargs)
+      finally:
+	self._leave(1)
+    return wrapper
+
+  # Yield the items of iterable, timing how long it takes to produce each one.
+  # This runs once per line or piece of text, so it doesn't go through _enter and
+  # _leave, and memory is only measured over the whole iteration.
+  def _timed(self, op, iterable, calls=0):
+    stats = self.operations.setdefault(op, [0, 0.0, 0])
+    stats[0] += calls
+    running = self.running
+    clock = time.time
+    peak = _peak_kb()
+    it = iter(iterable)
+    while True:
+      frame = [op, clock(), 0.0, None]
+      running.append(frame)
+      try:
+	item = next(it, _done)
+      finally:
+	running.pop()
+	elapsed = clock() - frame[1]
+	if running:
+	  running[-1][2] += elapsed
+	stats[1] += elapsed - frame[2]
+      if item is _done:
+	break
+      yield item
+    stats[2] += _peak_kb() - peak
+
+  def results(self):
+    phases = {}
+    operations = []
+    for (phase, name), (calls, seconds, growth) in self.operations.items():
+      operations.append({'phase': phase, 'operation': name, 'calls': calls, 'seconds': seconds, 'peak_growth_kb': growth})
+      total = phases.setdefault(phase, {'seconds': 0.0, 'peak_growth_kb': 0})
+      total['seconds'] += seconds
+      total['peak_growth_kb'] += growth
+    operations.sort(key=lambda o: (_phase_order(o['phase']), o['operation']))
+    return {
+      'seconds': self.elapsed,
+      'other_seconds': self.elapsed - sum(p['seconds'] for p in phases.values()),
+      'start_peak_kb': self.startpeak,
+      'peak_kb': _peak_kb(),
+      'phases': phases,
+      'operations': operations,
+    }
+
+  def report(self, f):
+    results = self.results()
+    total = results['seconds'] or 1e-9
+    f.write('%-9s %-30s %6s %10s %6s %10s\n' % ('phase', 'operation', 'calls', 'ms', '%', 'peak +KB'))
+    for o in results['operations']:
+      f.write('%-9s %-30s %6d %10.2f %6.1f %10d\n' % (o['phase'], o['operation'], o['calls'], o['seconds'] * 1000, o['seconds'] * 100 / total, o['peak_growth_kb']))
+    f.write('%-9s %-30s %6s %10.2f %6.1f\n' % ('other', '', '', results['other_seconds'] * 1000, results['other_seconds'] * 100 / total))
+    f.write('%-9s %-30s %6s %10.2f %6.1f %10d\n' % ('total', '', '', results['seconds'] * 1000, 100.0, results['peak_kb'] - results['start_peak_kb']))
+    f.write('peak memory %d KB\n' % results['peak_kb'])
+
+# Marks the end of an iteration
+_done = object()
+
+def _phase_order(phase):
+  if phase in PHASES:
+    return PHASES.index(phase)
+  return len(PHASES)
+
+# The peak resident size of the process so far, in KB
+def _peak_kb():
+  if resource is None:
+    return 0
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # OS X reports it in bytes, Linux in KB
+  if sys.platform == 'darwin':
+    peak /= 1024
+  return peak
@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 
+# Most runs of proj.py are small edits, so startup time matters. Only what every
+# command needs is imported here, everything else is imported by the functions
+# that use it. --timing reports how long this takes.
+import time
+_started = time.time()
+
 import chunkparser
 import optparser
-import templates
 import os
 import sys
 import re
 import itertools
+import posixpath
+import stat
+
+_imported = time.time()
 
 def usage(exitcode=0):
   print \
@@ -15,25 +24,142 @@ def usage(exitcode=0):
   new [rootproject | executable | library]
   add
   remove
+  sync
+  scan-headers
+  pch
+  info
+  list
+  graph
+  check
+  batch FILE
+  serve
 
 Usage examples:
 
 Create an executable project from all source files in the current directory
   proj.py new executable --name hello --sources *.cpp --headers *.h
 
+Or let proj find them under directories relative to the project's, recursively,
+skipping subprojects and anything listed in .projignore files
+  proj.py new executable --name hello --sources-from . --headers-from .
+  proj.py add --sources-from src --exclude 'test_*' build/
+  proj.py add --sources-from src --sources-include '*.cu' --headers-from src --headers-include '*.cuh'
+
+Make the sources and headers of a project match the files on disk
+  proj.py sync
+  proj.py sync --sources-from src --headers-from include
+
+Add the local headers the sources #include to the headers of a project
+  proj.py scan-headers
+
 Add things to a project
   proj.py add --sources another.cpp
   proj.py add --headers another.h
   proj.py add --defines MAX_CLIENTS=32
 
+Build the C++ sources in batches of about the same size (a unity build, which
+needs CMake 3.1), keeping some out of the batches, or stop doing so
+  proj.py add --unity 8 --unity-exclude main.cpp
+  proj.py remove --unity
+
+Precompile the 10 (or --top) headers the most sources include which haven't
+changed for 7 (or --stable-days) days, when building with CMake 3.16 or later
+  proj.py pch
+  proj.py pch --top 20 --stable-days 30
+
 Remove things from a project
   proj.py remove --sources bad.cpp
   proj.py remove --headers bad.h
   proj.py remove --defines MAX_CLIENTS
 
+Show the name and type of a project, or list what's in it
+  proj.py info
+  proj.py list
+  proj.py list --sources --libs
+
+Apply add, remove, info or list to a project and all its subprojects
+  proj.py --recursive add --defines MAX_CLIENTS=32
+  proj.py --recursive --jobs=4 info
+
+Show an order the targets of a project and its subprojects can be built in and
+any dependency cycles, or the whole graph for Graphviz or as JSON, or everything
+that depends on a target. What was read is kept in the cache and only changed
+files are read again.
+  proj.py graph
+  proj.py graph --dot | dot -Tsvg > graph.svg
+  proj.py graph --json
+  proj.py graph --dependents mylib
+
+Check that a project, or a whole tree of them, is well formed, without writing
+anything. Problems are reported with their line numbers and make proj fail.
+  proj.py check
+  proj.py --jobs=8 check --recursive
+
+Run many commands, one per line of a file (or stdin), writing each CMakeLists once
+  proj.py batch edits.txt
+  generate_edits | proj.py batch -
+
+Edits lock the CMakeLists so that proj processes editing it take turns. Instead,
+edit without locking, and make the edit again if the file changed meanwhile
+  proj.py --optimistic add --sources another.cpp
+
+Write changes to big CMakeLists over the old text when nothing has to move,
+instead of copying the file. Faster, but readers may see it half written.
+  proj.py --in-place add --defines LEVEL=2
+
+Keep parsed CMakeLists in a cache directory to speed up repeated queries
+  proj.py --cache=/tmp/projcache --recursive list
+
+Keep a server running and send it commands (or send JSON requests on stdin)
+  proj.py --socket=/tmp/proj.sock serve
+  proj.py --socket=/tmp/proj.sock add --sources another.cpp
+
+Report how long startup and the command took
+  proj.py --timing add --sources another.cpp
+
+Report the time and memory taken by each phase of a command (reading, parsing,
+editing, writing...), or save it as JSON, or also save cProfile stats
+  proj.py --profile add --sources another.cpp
+  proj.py --profile=profile.json add --sources another.cpp
+  proj.py --profile=add.prof add --sources another.cpp
+
+Edit projects from Python, many edits to a file costing one write, with no
+process started for each edit
+  import proj
+  project = proj.Project.open('src/engine')
+  project.add_sources(['render.cpp'])
+  project.set_define('USE_GL', '1')
+  project.save()
+
 For more detailed help, consult the manual.'''
   sys.exit(exitcode)
 
+# Errors. Everything proj raises is an Exception, which the command line just
+# prints, but problems with a project raise one of these so that code using
+# Project can tell them apart.
+class Error(Exception):
+  pass
+
+# A CMakeLists couldn't be parsed
+class ParseError(Error):
+  pass
+
+# A CMakeLists isn't managed by proj, or is missing something proj needs
+class ProjectError(Error):
+  pass
+
+# A change can't be made to a project of its type
+class EditError(Error):
+  pass
+
+# A CMakeLists was changed by someone else while it was being edited
+class ConflictError(Error):
+  pass
+
+# Someone else took too long to finish editing a CMakeLists
+class LockError(Error):
+  pass
+
 # Internal functions
 
 def _confirm_overwrite(filename):
@@ -63,179 +189,649 @@ def _get_cmakelists(preflags):
     return 'CMakeLists.txt'
   return cmakelists
 
+# Return preflags with --cmakelists set to filename
+def _with_cmakelists(preflags, filename):
+  preflags = [k for k in preflags if k != '--cmakelists' and not k.startswith('--cmakelists=')]
+  return preflags + ['--cmakelists=%s' % filename]
+
+# A regular expression which is compiled the first time it is used, so that
+# commands which never use it don't pay for compiling it
+class _LazyRegex(object):
+  def __init__(self, pattern, flags=0):
+    self.pattern = pattern
+    self.flags = flags
+    self.regex = None
+
+  def _compiled(self):
+    if self.regex is None:
+      self.regex = re.compile(self.pattern, self.flags)
+    return self.regex
+
+  def match(self, s):
+    return self._compiled().match(s)
+
+  def findall(self, s):
+    return self._compiled().findall(s)
+
 def _find_chunk(chunks, name):
-  c = _find_chunk_recursive(chunks, name)
+  c = chunkparser.find(chunks, name)
   if c is None:
-    raise Exception('couldn\'t find \'%s\' chunk' % name)
+    raise ProjectError('couldn\'t find \'%s\' chunk' % name)
   return c
-  
-def _find_chunk_recursive(chunks, name):
-  for c in chunks:
-    if type(c) == type([]):
-      if c[0] == name:
-	return c
-      c = _find_chunk_recursive(c[1], name)
-      if c != None:
-	return c
-  return None
 
-def _is_plain_chunk(chunk):
-  return type(chunk) != type([])
+# Find the named chunk in order to change it. Saving only rewrites the chunks that
+# were changed, so anything that changes a chunk must find it this way.
+def _edit_chunk(chunks, name):
+  c = _find_chunk(chunks, name)
+  chunkparser.changed(chunks, c)
+  return c
 
-# Safely add items to the chunk, avoiding duplicates and ignoring whitespace
-def _add_to_chunk(chunk, items, adding):
-  # Get current list of items in the chunk, stripping surrounding whitespace.
-  # Use filter to ignore sub-chunks
-  currentitems = map(str.strip, filter(_is_plain_chunk, chunk[1]))
+# Find the named chunk in order to change it, like _edit_chunk, adding an empty one
+# to the project's chunk if there isn't one. CMakeLists made from older templates
+# lack the chunks added to the templates since; the new chunk goes after the last
+# of the chunks named in after that the project has, or at the end.
+def _edit_or_add_chunk(chunks, name, after):
+  c = chunkparser.find(chunks, name)
+  if c is not None:
+    chunkparser.changed(chunks, c)
+    return c
+  project = _find_chunk(chunks, _get_type(chunks))
+  children = project[1]
+  i = len(children)
+  for j, item in enumerate(children):
+    if chunkparser.is_chunk(item) and item[0] in after:
+      i = j + 1
+  # Separated from the chunk before by a blank line, as in the templates
+  children.insert(i, '')
+  return chunkparser.insert(chunks, project, i + 1, name)
 
+# True for a plain line, False for a chunk
+_is_plain_chunk = chunkparser.is_line
+
+# Safely add items to the chunk, avoiding duplicates and ignoring whitespace.
+# items can be any iterable, it is only read once.
+# Membership is tested against a set, so adding or removing n items from a chunk
+# of m items costs O(n + m) and the chunk keeps its original order.
+def _add_to_chunk(chunk, items, adding):
   if adding:
-    for i in map(str.strip, items):
+    # Get current set of items in the chunk, stripping surrounding whitespace.
+    # Use filter to ignore sub-chunks
+    currentitems = set(map(str.strip, filter(_is_plain_chunk, chunk[1])))
+    for i in itertools.imap(str.strip, items):
       if i not in currentitems:
 	chunk[1].append(i)
-	currentitems.append(i)
+	currentitems.add(i)
 
   else:
+    # Sub-chunks are kept as they are, plain items are kept (stripped) unless
+    # they are being removed
     outitems = []
-    cmpitems = map(str.strip, items)
-    for i in currentitems:
-      if i not in cmpitems:
-	outitems.append(i)
+    cmpitems = set(itertools.imap(str.strip, items))
+    for c in chunk[1]:
+      if _is_plain_chunk(c):
+	c = c.strip()
+	if c in cmpitems:
+	  continue
+      outitems.append(c)
     chunk[1] = outitems
 
-_define = re.compile(r'\s*target_compile_definitions\s*\(\s*(\S+)\s+(PUBLIC|PRIVATE|INTERFACE)\s+-D([0-9a-zA-Z_]+)(=(\S+))?\s*\)\s*')
-def _add_or_modify_define(chunk, target, define, kind, adding):
-  # Split the define into name and value. Keep the = character in the value, we'll make use of it later
-  eq = define.find('=')
-  if eq >= 0:
-    name = define[:eq]
-    value = define[eq:]
-  else:
-    name = define
-    value = ''
+# Apply a batch of edits to the statements of a chunk. Every plain line is matched
+# against regex once and the statements found are indexed by key(match), so each
+# edit is a dictionary lookup however long the chunk is. Edits are (key, line)
+# pairs, applied in order:
+#
+# * line is None: delete every statement with that key
+# * otherwise: append line if no statement has that key, or, if replace is True,
+#   replace the first statement that does
+#
+# The chunk contents are replaced once at the end.
+def _edit_statements(chunk, regex, key, edits, replace):
+  lines = list(chunk)
+  index = {}
+  for i in xrange(len(lines)):
+    c = lines[i]
+    if _is_plain_chunk(c):
+      m = regex.match(c)
+      if m:
+	index.setdefault(key(m), []).append(i)
+
+  for k, line in edits:
+    positions = index.get(k)
+    if line is None:
+      if positions:
+	# Deleted lines are dropped when the chunk is rebuilt
+	for i in positions:
+	  lines[i] = None
+	del index[k]
+    elif positions:
+      if replace:
+	lines[positions[0]] = line
+    else:
+      index[k] = [len(lines)]
+      lines.append(line)
+
+  chunk[:] = [c for c in lines if c is not None]
 
+# Defines are keyed by (target, kind, symbol)
+_define = _LazyRegex(r'\s*target_compile_definitions\s*\(\s*(\S+)\s+(PUBLIC|PRIVATE|INTERFACE)\s+-D([0-9a-zA-Z_]+)(=(\S+))?\s*\)\s*')
+def _define_key(m):
+  return (m.group(1), m.group(2), m.group(3))
+
+# The edit (see _edit_statements) that defines name, with value (which is empty or
+# starts with =), for target, or removes the define
+def _define_edit(target, kind, name, value, adding):
+  line = None
   if adding:
-    # Scan the chunk looking for an existing definition of this symbol
-    for i in xrange(len(chunk)):
-      c = chunk[i]
-      if _is_plain_chunk(c):
-	m = _define.match(c)
-	if m:
-	  existingtarget = m.group(1)
-	  existingkind = m.group(2)
-	  existingsymbol = m.group(3)
-	  if existingtarget == target and existingsymbol == name and existingkind == kind:
-	    # Found it
-	    chunk[i] = 'target_compile_definitions(%s %s -D%s%s)' % (target, kind, name, value)
-	    return
-    chunk.append('target_compile_definitions(%s %s -D%s%s)' % (target, kind, name, value))
+    line = 'target_compile_definitions(%s %s -D%s%s)' % (target, kind, name, value)
+  return (target, kind, name), line
 
-  else:
-    outitems = []
-    for i in chunk:
-      if _is_plain_chunk(i):
-	m = _define.match(i)
-	if m:
-	  existingtarget = m.group(1)
-	  existingkind = m.group(2)
-	  existingsymbol = m.group(3)
-	  if existingtarget == target and existingsymbol == name and existingkind == kind:
-	    # This is the matching one, skip it
-	    continue
-      outitems.append(i)
-    # Replace chunk contents with new list
-    chunk[:] = outitems
+# Subdirs are keyed by path
+_subdir = _LazyRegex(r'\s*add_subdirectory\s*\(\s*(\S+)\s*\)\s*')
+def _subdir_key(m):
+  return m.group(1)
 
-_subdir = re.compile(r'\s*add_subdirectory\s*\(\s*(\S+)\s*\)\s*')
-def _add_subdir(chunk, subdir, adding):
+def _subdir_edit(subdir, adding):
+  line = None
   if adding:
-    for i in chunk:
-      if _is_plain_chunk(i):
-	m = _subdir.match(i)
-	if m:
-	  if m.group(1) == subdir:
-	    # Already added, do not add it again
-	    return
-    chunk.append('add_subdirectory(%s)' % subdir)
+    line = 'add_subdirectory(%s)' % subdir
+  return subdir, line
 
-  else:
-    outitems = []
-    for i in chunk:
-      if _is_plain_chunk(i):
-	m = _subdir.match(i)
-	if m:
-	  if m.group(1) == subdir:
-	    # This is the one, don't add it to the output
-	    continue
-      outitems.append(i)
-    chunk[:] = outitems
+# Libs are keyed by (target, kind, lib)
+_linklib = _LazyRegex(r'\s*target_link_libraries\s*\(\s*(\S+)\s+(debug|optimized|general)\s+(\S+)\s*\)\s*')
+def _linklib_key(m):
+  return (m.group(1), m.group(2), m.group(3))
 
-_linklib = re.compile(r'\s*target_link_libraries\s*\(\s*(\S+)\s+(debug|optimized|general)\s+(\S+)\s*\)\s*')
-def _add_lib(chunk, target, lib, kind, adding):
+def _lib_edit(target, kind, lib, adding):
+  line = None
   if adding:
-    for i in chunk:
-      if _is_plain_chunk(i):
-	m = _linklib.match(i)
-	if m:
-	  existingtarget = m.group(1)
-	  existingkind = m.group(2)
-	  existinglib = m.group(3)
-	  if existingtarget == target and existingkind == kind and existinglib == lib:
-	    # Already added, do not add it again
-	    return
-    chunk.append('target_link_libraries(%s %s %s)' % (target, kind, lib))
+    line = 'target_link_libraries(%s %s %s)' % (target, kind, lib)
+  return (target, kind, lib), line
 
-  else:
-    outitems = []
-    for i in chunk:
-      if _is_plain_chunk(i):
-	m = _linklib.match(i)
-	if m:
-	  existingtarget = m.group(1)
-	  existingkind = m.group(2)
-	  existinglib = m.group(3)
-	  if existingtarget == target and existingkind == kind and existinglib == lib:
-	    # This is the one, don't add it to the output
-	    continue
-      outitems.append(i)
-    chunk[:] = outitems
+# How the statements of each chunk that holds them are matched, keyed and edited,
+# as (regex, key, replace) for _edit_statements
+_statement_chunks = {
+  'definitions': (_define, _define_key, True),
+  'subdirs': (_subdir, _subdir_key, False),
+  'linklibs': (_linklib, _linklib_key, False),
+}
+
+# While serving, parsed chunk trees are kept here between requests, keyed by the
+# real path of the file, together with the _file_key it had when it was parsed
+_tree_cache = None
+
+# A file's (mtime, size, inode). Any change to the file, including replacing it by
+# renaming another over it, changes its key.
+def _file_key(filename):
+  return _stat_key(os.stat(filename))
+
+def _stat_key(st):
+  return (st.st_mtime, st.st_size, st.st_ino)
+
+# Return the parse cache given by --cache=DIR (or $PROJ_CACHE_DIR), or None when no
+# cache is in use. --cache on its own uses ~/.cache/proj, and --cache-size=MB
+# limits how big the cache directory gets. Commands that need somewhere to keep
+# state between runs pass default=True to use ~/.cache/proj when no cache is given.
+def _get_cache(preflags, default=False):
+  dirname = _find_preflag(preflags, '--cache')
+  if dirname == False:
+    dirname = os.environ.get('PROJ_CACHE_DIR')
+  if not dirname:
+    if not default:
+      return None
+    dirname = True
+  if dirname == True:
+    dirname = os.path.join(os.path.expanduser('~'), '.cache', 'proj')
+  import diskcache
+  size = _find_preflag(preflags, '--cache-size')
+  if size == True or size == False:
+    return diskcache.DiskCache(dirname)
+  return diskcache.DiskCache(dirname, int(size) * 1024 * 1024)
 
 def _load_chunks(preflags):
   filename = _get_cmakelists(preflags)
+  if _tree_cache is not None:
+    realname = os.path.realpath(filename)
+    key = _file_key(realname)
+    cached = _tree_cache.get(realname)
+    if cached is not None and cached[0] == key:
+      return cached[1]
+  cache = _get_cache(preflags)
   f = open(filename, 'r')
+  try:
+    # The key of the file actually read, even if it is being replaced meanwhile
+    st = os.fstat(f.fileno())
+    try:
+      if cache is not None:
+	chunks = _load_cached_chunks(cache, os.path.realpath(filename), f, st)
+      else:
+	chunks = chunkparser.parse(f)
+    except chunkparser.ParseError as e:
+      raise ParseError, str(e), sys.exc_info()[2]
+  finally:
+    f.close()
+  # Remember which version of the file the chunks came from, see _plan_edits and
+  # _Session.check
+  chunks.origin = _stat_key(st)
+  if _tree_cache is not None:
+    _tree_cache[realname] = (chunks.origin, chunks)
+  return chunks
+
+# Load chunks from f, the open file realname whose os.stat is st, through the
+# parse cache. Entries are keyed by the real path of the file and hold its mtime,
+# size and the SHA-1 of its contents along with the parsed chunks. A matching
+# mtime and size is trusted without reading the file; otherwise the file is read
+# and a matching hash still saves the parse.
+def _load_cached_chunks(cache, realname, f, st):
+  key = 'chunks:' + realname
+  entry = cache.get(key)
+  if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+    return entry[3]
   data = f.read()
-  f.close()
-  return chunkparser.parse(data)
+  import hashlib
+  digest = hashlib.sha1(data).hexdigest()
+  if entry is not None and entry[1] == len(data) and entry[2] == digest:
+    chunks = entry[3]
+  else:
+    chunks = chunkparser.parse(data)
+  cache.put(key, (st.st_mtime, len(data), digest, chunks))
+  return chunks
 
+# Write chunks to the CMakeLists. If the file already holds exactly that text it
+# is left alone, so its mtime doesn't change and CMake doesn't re-run configure.
+# Otherwise the text goes to a temporary file in the same directory which is then
+# renamed over the original, so nobody ever sees a half-written file.
+#
+# When the chunks were parsed from the file as it is now, only the bodies of the
+# chunks that changed are generated, and everything else is copied from the file
+# as it is, so text outside the changed chunks is never touched. With --in-place,
+# if the file is big and none of the new bodies changes length, they are written
+# straight over the old ones instead, which saves copying the whole file for a
+# small change.
 def _save_chunks(preflags, chunks):
-  filename = _get_cmakelists(preflags)
-  data = chunkparser.generate(chunks)
-  f = open(filename, 'w')
-  f.write(data)
-  f.close()
+  _save_all([(os.path.realpath(_get_cmakelists(preflags)), chunks)], _find_preflag(preflags, '--in-place'))
+
+# Files at least this big are edited in place, if asked to, when nothing in them
+# has to move. Unlike a rename, this isn't atomic: a reader can see the file half
+# written, and since the size stays the same a rewrite within the same mtime
+# tick leaves _file_key unchanged, so the cache and --optimistic may miss it.
+_inplace_size = 1024 * 1024
+
+# Save several (real filename, chunks) pairs together. Every file that changed is
+# written to its temporary file first, and only once all of them have been
+# written are they renamed into place (or, if in_place is set, edited in place).
+def _save_all(files, in_place=False):
+  staged = []
+  inplace = []
+  planned = []
+  stale = []
+  try:
+    for filename, chunks in files:
+      unitystaged, unitystale = _stage_unity(filename, chunks)
+      staged += unitystaged
+      stale += unitystale
+      edits = _plan_edits(filename, chunks)
+      planned.append(edits)
+      if edits is None:
+	if not _same_as_file(filename, chunks):
+	  staged.append((_stage_chunks(filename, chunks), filename))
+      elif edits:
+	if in_place and os.path.getsize(filename) >= _inplace_size and not [e for e in edits if len(e[2]) != e[1] - e[0]]:
+	  inplace.append((filename, edits))
+	else:
+	  staged.append((_stage_edits(filename, edits), filename))
+  except:
+    for tmpname, filename in staged:
+      os.remove(tmpname)
+    raise
+  for filename, edits in inplace:
+    _write_in_place(filename, edits)
+  for tmpname, filename in staged:
+    if os.name == 'nt' and os.path.exists(filename):
+      # Windows won't rename over an existing file
+      os.remove(filename)
+    os.rename(tmpname, filename)
+  for filename in stale:
+    os.remove(filename)
+  for (filename, chunks), edits in zip(files, planned):
+    if edits is None:
+      # Where the chunks are in the file is no longer known, but which version
+      # of the file they hold still is, for _Session.check
+      chunks.spans = None
+      chunks.dirty = []
+    else:
+      chunkparser.patched(chunks, edits)
+    chunks.origin = _file_key(filename)
+    if _tree_cache is not None:
+      _tree_cache[filename] = (_file_key(filename), chunks)
+
+# If the unity chunk of chunks, which are to be saved to filename, has changed,
+# write the batch files it lists that don't already hold what they should to
+# temporary files. Return the (temporary file, batch file) pairs and the batch
+# files of batches that no longer exist.
+def _stage_unity(filename, chunks):
+  c = chunkparser.find(chunks, 'unity')
+  if c is None or not [d for d in getattr(chunks, 'dirty', ()) if d is c]:
+    return [], []
+  projdir = os.path.dirname(filename)
+  name = _get_name(chunks)
+  staged = []
+  try:
+    batches = _read_unity(c)[2]
+    for batchname, members in batches:
+      text = '// Generated by proj for the unity build of %s. Don\'t edit it, it is\n// rewritten when the batch changes.\n' % name
+      for i in members:
+	text += '#include "%s"\n' % posixpath.join(posixpath.relpath('.', posixpath.dirname(batchname)), i)
+      batchfile = os.path.join(projdir, batchname)
+      try:
+	f = open(batchfile, 'rb')
+	try:
+	  if f.read() == text:
+	    continue
+	finally:
+	  f.close()
+      except IOError:
+	if not os.path.isdir(os.path.dirname(batchfile)):
+	  os.makedirs(os.path.dirname(batchfile))
+      staged.append((_stage(batchfile, lambda f: f.write(text)), batchfile))
+  except:
+    for tmpname, batchfile in staged:
+      os.remove(tmpname)
+    raise
+  stale = []
+  n = len(batches)
+  while os.path.exists(os.path.join(projdir, _unity_dir, 'unity_%d.cpp' % n)):
+    stale.append(os.path.join(projdir, _unity_dir, 'unity_%d.cpp' % n))
+    n += 1
+  return staged, stale
+
+# Return the edits (see chunkparser.patches) that bring filename up to date with
+# chunks, leaving out any that wouldn't change it, or None if the whole file has
+# to be generated. Editing is only possible if the chunks were parsed from the
+# file as it is now, which is checked by its key and by finding an end marker at
+# the end of each body that is replaced.
+def _plan_edits(filename, chunks):
+  # Files are read in text mode, which on Windows means offsets in the parsed
+  # text aren't offsets in the file
+  if os.name == 'nt':
+    return None
+  origin = getattr(chunks, 'origin', None)
+  if origin is None or not os.path.exists(filename) or origin != _file_key(filename):
+    return None
+  edits = chunkparser.patches(chunks)
+  if edits is None:
+    return None
+  needed = []
+  f = open(filename, 'rb')
+  try:
+    for start, end, text in edits:
+      f.seek(start)
+      old = f.read(end - start)
+      if f.read(len(_end_marker)) != _end_marker:
+	return None
+      if old != text:
+	needed.append((start, end, text))
+  finally:
+    f.close()
+  return needed
+
+_end_marker = '# --== proj end '
+
+# Write chunks to a new temporary file next to filename, with the same permissions,
+# and return its name
+def _stage_chunks(filename, chunks):
+  return _stage(filename, lambda f: chunkparser.write(chunks, f))
+
+# Write a copy of filename with edits applied to a new temporary file next to it,
+# and return its name
+def _stage_edits(filename, edits):
+  def write(f):
+    original = open(filename, 'rb')
+    try:
+      for start, end, text in edits:
+	_copy(original, f, start - original.tell())
+	f.write(text)
+	original.seek(end)
+      _copy(original, f, None)
+    finally:
+      original.close()
+  return _stage(filename, write)
+
+# Copy size bytes (or everything that's left, if size is None) from fin to fout
+def _copy(fin, fout, size):
+  while size is None or size > 0:
+    block = fin.read(65536 if size is None else min(size, 65536))
+    if not block:
+      break
+    fout.write(block)
+    if size is not None:
+      size -= len(block)
+
+# Replace the bodies given by edits, none of which changes length, in the file
+def _write_in_place(filename, edits):
+  f = open(filename, 'r+b')
+  try:
+    for start, end, text in edits:
+      f.seek(start)
+      f.write(text)
+  finally:
+    f.close()
+
+# Call write with a new temporary file next to filename, which is given the same
+# permissions, and return the name of the file
+def _stage(filename, write):
+  import shutil
+  import tempfile
+  dirname, basename = os.path.split(filename)
+  fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp', dir=dirname)
+  try:
+    f = os.fdopen(fd, 'wb')
+    try:
+      write(f)
+    finally:
+      f.close()
+    if os.path.exists(filename):
+      shutil.copymode(filename, tmpname)
+    else:
+      # mkstemp creates the file readable only by us, use the usual permissions
+      umask = os.umask(0)
+      os.umask(umask)
+      os.chmod(tmpname, 0666 & ~umask)
+  except:
+    os.remove(tmpname)
+    raise
+  return tmpname
+
+# Return True if filename exists and holds exactly the text of chunks. The file is
+# compared a block at a time as the text is generated, so neither is held in full.
+def _same_as_file(filename, chunks):
+  try:
+    f = open(filename, 'r')
+  except IOError:
+    return False
+  try:
+    buf = []
+    size = 0
+    for piece in itertools.chain(chunkparser.pieces(chunks), [None]):
+      if piece is not None:
+	buf.append(piece)
+	size += len(piece)
+	if size < 65536:
+	  continue
+      data = ''.join(buf)
+      if f.read(len(data)) != data:
+	return False
+      buf = []
+      size = 0
+    # Anything left in the file means it was longer
+    return f.read(1) == ''
+  finally:
+    f.close()
+
+# While a batch runs, the sessions its commands have opened, keyed by the real path
+# of their CMakeLists. Later commands on the same file share the session, and
+# nothing is written until the whole batch has succeeded.
+_batch_sessions = None
+
+# A session holds the chunks of one CMakeLists while a command edits them. The file
+# is loaded (or the chunks built from a template) once, every change is applied in
+# memory, and nothing touches the disk until commit() writes the result once.
+#
+# A session opened to edit a file locks it first, so that other proj processes
+# editing it wait until this one has saved it (see _lock). With --optimistic the
+# file is only locked while it is saved, so others can edit it meanwhile, and
+# commit() raises ConflictError instead of saving if the file changed after it was
+# loaded. A batch doesn't lock its files either until all its commands have run
+# (see cmd_batch).
+class _Session(object):
+  def __init__(self, preflags, chunks=None, lock=False):
+    self.preflags = preflags
+    self.filename = os.path.realpath(_get_cmakelists(preflags))
+    self.locking = lock
+    self.lock_held = None
+    self.origin = None
+    if chunks is None:
+      if not _find_preflag(preflags, '--optimistic') and _batch_sessions is None:
+	self.lock()
+      try:
+	chunks = _load_chunks(preflags)
+      except:
+	self.close()
+	raise
+      self.origin = chunks.origin
+    self.chunks = chunks
+    if _batch_sessions is not None:
+      _batch_sessions[self.filename] = self
+
+  def commit(self):
+    # A batch saves all of its sessions when it ends
+    if _batch_sessions is None:
+      try:
+	self.lock()
+	self.check()
+	_save_chunks(self.preflags, self.chunks)
+      finally:
+	self.close()
+
+  # Lock the file, unless it's already locked or the session isn't for editing
+  def lock(self):
+    if self.locking and self.lock_held is None:
+      self.lock_held = _lock(self.filename)
+
+  # Raise ConflictError if the file has changed since the session loaded it. Even
+  # with a lock this can happen, if something other than proj changed it.
+  def check(self):
+    if self.origin is not None and _file_key(self.filename) != self.origin:
+      raise ConflictError('%s was changed by someone else while it was being edited' % self.filename)
+
+  # Release the lock, if there is one
+  def close(self):
+    if self.lock_held is not None:
+      _unlock(self.lock_held)
+      self.lock_held = None
+
+# Open a session on the CMakeLists given by preflags, or return the one the running
+# batch already has open on it. Sessions are opened for editing, and so locked,
+# unless readonly is True. Everything in a batch could be edited by a later
+# command, so its sessions are all for editing, but they are opened unlocked, and
+# the batch locks them all at once in a fixed order before saving them.
+def _open_session(preflags, readonly=False):
+  if _batch_sessions is not None:
+    session = _batch_sessions.get(os.path.realpath(_get_cmakelists(preflags)))
+    if session is not None:
+      return session
+    readonly = False
+  return _Session(preflags, lock=not readonly)
+
+# How many times an edit is made again after someone else changed the file
+_retries = 10
+
+# Apply edit, a function that changes chunks in place, to the CMakeLists given by
+# preflags and save it. If the file was changed by someone else after it was
+# loaded, which without a lock is always possible, it is loaded again and the
+# edit made again. Return whatever edit returned the time it was saved.
+def _edit(preflags, edit):
+  for attempt in xrange(_retries + 1):
+    session = _open_session(preflags)
+    try:
+      result = edit(session.chunks)
+      session.commit()
+      return result
+    except ConflictError:
+      if attempt == _retries:
+	raise
+    finally:
+      if _batch_sessions is None:
+	session.close()
+
+# How long to wait for another process to finish with a CMakeLists, in seconds
+_lock_timeout = 60
 
-def _set_name(preflags, name):
-  chunks = _load_chunks(preflags)
-  namechunk = _find_chunk(chunks, 'projectname')
+# The locks this process holds, as directory -> [file descriptor holding the lock,
+# number of sessions using it]
+_held_locks = {}
+
+# Take an exclusive advisory lock for editing filename, waiting for whoever holds
+# it, and return the lock, which _unlock releases. Return None where such locks
+# aren't available. Saving replaces filename with a new file, so the lock is taken
+# on the directory containing it, which also saves leaving a lock file in the
+# project.
+#
+# Every file in a directory shares its lock, and a lock taken through a second
+# file descriptor would wait for the first, so sessions of this process editing
+# files in the same directory share one lock.
+def _lock(filename):
+  try:
+    import fcntl
+  except ImportError:
+    return None
+  dirname = os.path.dirname(filename)
+  held = _held_locks.get(dirname)
+  if held is not None:
+    held[1] += 1
+    return dirname
+  fd = os.open(dirname, os.O_RDONLY)
+  deadline = time.time() + _lock_timeout
+  delay = 0.001
+  while True:
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      _held_locks[dirname] = [fd, 1]
+      return dirname
+    except IOError:
+      if time.time() > deadline:
+	os.close(fd)
+	raise LockError('timed out waiting for the lock on %s' % filename)
+      time.sleep(delay)
+      delay = min(delay * 2, 0.05)
+
+# Release a lock returned by _lock
+def _unlock(lock):
+  held = _held_locks[lock]
+  held[1] -= 1
+  if held[1] == 0:
+    del _held_locks[lock]
+    os.close(held[0])
+
+def _set_name(chunks, name):
+  namechunk = _edit_chunk(chunks, 'projectname')
   namechunk[1] = ['project(proj_%s)' % name]
-  _save_chunks(preflags, chunks)
 
-_extract_projname = re.compile(r'\s*project\(proj_(.*)\)')
+_extract_projname = _LazyRegex(r'\s*project\(proj_(.*)\)')
 def _get_name(chunks):
   name = _find_chunk(chunks, 'projectname')
-  m = _extract_projname.match(name[1][0])
+  m = None
+  if name[1] and _is_plain_chunk(name[1][0]):
+    m = _extract_projname.match(name[1][0])
   if not m:
-    raise Exception('corrupted or missing project name')
+    raise ProjectError('corrupted or missing project name')
   return m.group(1)
 
 def _get_type(chunks):
   possibilities = ['rootproject', 'executable', 'library']
   for p in possibilities:
-    try:
-      _find_chunk(chunks, p)
+    if chunkparser.find(chunks, p) is not None:
       return p
-    except:
-      pass
-  raise Exception('project doesn\'t seem to be managed by proj')
+  raise ProjectError('project doesn\'t seem to be managed by proj')
 
 def _init_from_template(template, preflags, groups):
   # All things initialized from template must be given a name
@@ -244,17 +840,38 @@ def _init_from_template(template, preflags, groups):
   if len(groups['--name']) > 1:
     raise Exception('name must be given exactly once')
   name = groups['--name'][0]
-  # To create new, we start with the template and then do an 'add'
+  # To create new, we start with the template and then do an 'add'. Nothing is
+  # written until the caller commits the returned session.
   filename = _get_cmakelists(preflags)
   _confirm_overwrite(filename)
-  f = open(filename, 'w')
-  f.write(template)
-  f.close()
-  _set_name(preflags, name)
-  cmd_add(preflags, groups)
+  session = _Session(preflags, chunkparser.parse(template))
+  _set_name(session.chunks, name)
+  _add_or_remove(Project(session.chunks, os.path.dirname(filename)), groups, True)
+  return session
+
+# Return the patterns of the files a scan of the directories given by group,
+# --sources-from or --headers-from, includes: those of --sources-include or
+# --headers-include, or the default ones. Each kind has its own, since a pattern
+# meant for sources would otherwise make sources of headers too.
+def _scan_include(groups, group, default):
+  if '--include' in groups:
+    raise Exception('--include would apply to both sources and headers, use --sources-include or --headers-include')
+  return groups.get(group.replace('-from', '-include')) or default
+
+# Scan the directories given by group, relative to the project directory projdir,
+# for files, including the ones matching its include patterns (see _scan_include)
+# and skipping those matching --exclude or a .projignore file. Paths are relative
+# to projdir, like those sync finds.
+def _scan(groups, group, default, projdir):
+  if not groups[group]:
+    raise Exception('%s needs at least one directory' % group)
+  include = _scan_include(groups, group, default)
+  exclude = groups.get('--exclude', [])
+  return _scan_project(projdir, [posixpath.normpath(t) for t in groups[group]], include, exclude, None)
 
-# adding==True adds the information, adding==False deletes it
-def _add_or_remove(preflags, groups, adding):
+# Make the changes the groups of an add (adding==True) or remove (adding==False)
+# command ask for to project, a Project
+def _add_or_remove(project, groups, adding):
   sources = []
   headers = []
   defines = []
@@ -278,62 +895,620 @@ def _add_or_remove(preflags, groups, adding):
     subdirs += groups['--subdirs']
   if '--libs' in groups:
     libs += groups['--libs']
+  # --unity takes the number of batches, and removing it turns unity builds off
+  unity = None
+  if '--unity' in groups:
+    unity = 0
+    if adding:
+      unity = _unity_default
+      if groups['--unity']:
+	unity = _get_number(groups, '--unity', None)
+	if unity < 1:
+	  raise Exception('--unity takes the number of batches')
+  unityexclude = groups.get('--unity-exclude', [])
 
-  # Load in the chunks
-  chunks = _load_chunks(preflags)
+  # Files found by scanning directories are streamed into the chunks as they are
+  # found rather than collected first
+  if '--sources-from' in groups or '--headers-from' in groups:
+    import sourcescan
+  if '--sources-from' in groups:
+    sources = itertools.chain(sources, _scan(groups, '--sources-from', sourcescan.SOURCES, project._projdir))
+  if '--headers-from' in groups:
+    headers = itertools.chain(headers, _scan(groups, '--headers-from', sourcescan.HEADERS, project._projdir))
 
-  # Do some sanity checking based on project type
-  projtype = _get_type(chunks)
-  if projtype == 'rootproject':
-    if sources or headers:
-      raise Exception('sources and headers can\'t be added to a rootproject')
-
-  # Add sources
+  # Add sources and headers
   if sources:
-    c = _find_chunk(chunks, 'sources')
-    _add_to_chunk(c, sources, adding)
-
-  # Add headers
+    project._change_items('sources', sources, adding)
   if headers:
-    c = _find_chunk(chunks, 'headers')
-    _add_to_chunk(c, headers, adding)
+    project._change_items('headers', headers, adding)
 
-  # Add defines
-  if defines:
-    name = _get_name(chunks)
-    c = _find_chunk(chunks, 'definitions')
-    for d in defines:
-      _add_or_modify_define(c[1], name, d, 'PRIVATE', adding)
+  # Add defines, publicdefines and interfacedefines. A value keeps its = so that
+  # "X=" can be told from "X".
+  kinded = [('PRIVATE', d) for d in defines]
+  kinded += [('PUBLIC', d) for d in publicdefines]
+  kinded += [('INTERFACE', d) for d in interfacedefines]
+  for kind, define in kinded:
+    name, eq, value = define.partition('=')
+    if not adding:
+      project.remove_define(name, kind)
+    elif eq:
+      project.set_define(name, value, kind)
+    else:
+      project.set_define(name, None, kind)
 
-  # Add publicdefines
-  if publicdefines:
-    name = _get_name(chunks)
-    c = _find_chunk(chunks, 'definitions')
-    for d in publicdefines:
-      _add_or_modify_define(c[1], name, d, 'PUBLIC', adding)
+  # Add subdirs and libs
+  for subdir in subdirs:
+    if adding:
+      project.add_subdir(subdir)
+    else:
+      project.remove_subdir(subdir)
+  for lib in libs:
+    if adding:
+      project.add_lib(lib)
+    else:
+      project.remove_lib(lib)
 
-  # Add interfacedefines
-  if interfacedefines:
-    name = _get_name(chunks)
-    c = _find_chunk(chunks, 'definitions')
-    for d in interfacedefines:
-      _add_or_modify_define(c[1], name, d, 'INTERFACE', adding)
-
-  # Add subdirs
-  if subdirs:
-    c = _find_chunk(chunks, 'subdirs')
-    for d in subdirs:
-      _add_subdir(c[1], d, adding)
-
-  # Add libs
-  if libs:
+  if unity is not None or unityexclude:
+    project._change_unity(unity, unityexclude, adding)
+  project._apply()
+
+# Unity builds. With --unity the C++ files in the sources chunk are compiled in
+# batches instead of one at a time: each batch is a generated file in the unity
+# directory which includes its sources, and the sources themselves are marked
+# HEADER_FILE_ONLY, so they are still part of the target but not compiled on
+# their own. The unity chunk holds the number of batches, the sources kept out of
+# them with --unity-exclude and what is in each batch, and the batch files are
+# written from it when the CMakeLists is saved (see _stage_unity).
+_unity_default = 4
+_unity_dir = 'unity'
+_unity_extensions = ['.cc', '.cpp', '.cxx', '.c++']
+_unity_setting = _LazyRegex(r'\s*set\s*\(\s*proj_unity_(batches|exclude)\s([^)]*)\)\s*')
+_unity_batch = _LazyRegex(r'\s*target_sources\s*\(\s*\S+\s+PRIVATE\s+(\S+)\s*\)\s*')
+_unity_members = _LazyRegex(r'\s*set_source_files_properties\s*\(([^)]*)\sPROPERTIES\s+HEADER_FILE_ONLY\s+ON\s*\)\s*')
+
+# Return True if path, relative to the project directory, is one of the batch
+# files of a unity build. They are never sources themselves.
+def _is_unity_batch(path):
+  return _unity_batch_file.match(posixpath.normpath(path)) is not None
+
+_unity_batch_file = _LazyRegex(_unity_dir + r'/unity_[0-9]+\.cpp$')
+
+# A batch may grow to this many times its share of the sources before the
+# batches are balanced again
+_unity_slack = 1.5
+
+# Return (number of batches, excluded sources, [(batch file, [source...])...])
+# from the unity chunk
+def _read_unity(chunk):
+  count = 0
+  exclude = []
+  batches = []
+  for line in filter(_is_plain_chunk, chunk[1]):
+    m = _unity_setting.match(line)
+    if m:
+      if m.group(1) == 'batches':
+	count = int(m.group(2))
+      else:
+	exclude = m.group(2).split()
+      continue
+    m = _unity_batch.match(line)
+    if m:
+      batches.append((m.group(1), []))
+      continue
+    m = _unity_members.match(line)
+    if m and batches:
+      batches[-1][1].extend(m.group(1).split())
+  return count, exclude, batches
+
+# Bring the unity chunk up to date with the sources chunk, after setting the
+# number of batches to count (unless it is None) and adding or removing the
+# sources in exclude from those kept out of the batches. Sources stay in the
+# batch they are in, so that only the batches that changed are compiled again;
+# new sources go to the smallest batch, and the sources are only shared out
+# again when the number of batches changes or a batch gets too big.
+def _update_unity(chunks, projdir, count, exclude, adding):
+  if count is None and not exclude:
+    c = chunkparser.find(chunks, 'unity')
+    if c is None or not _read_unity(c)[0]:
+      return
+  c = _edit_or_add_chunk(chunks, 'unity', ('addexe', 'addlib'))
+  oldcount, oldexclude, oldbatches = _read_unity(c)
+  if count is None:
+    count = oldcount
+  if adding:
+    exclude = oldexclude + [e for e in exclude if e not in oldexclude]
+  else:
+    exclude = [e for e in oldexclude if e not in exclude]
+
+  lines = []
+  if count:
+    lines.append('set(proj_unity_batches %d)' % count)
+  if exclude:
+    lines.append('set(proj_unity_exclude %s)' % str.join(' ', exclude))
+  if count:
+    excluded = set(exclude)
+    sources = []
+    for i in filter(_is_plain_chunk, _find_chunk(chunks, 'sources')[1]):
+      i = i.strip()
+      if i and i not in excluded and _is_plain_path(i) and os.path.splitext(i)[1].lower() in _unity_extensions and not _is_unity_batch(i):
+	sources.append(i)
     name = _get_name(chunks)
-    c = _find_chunk(chunks, 'linklibs')
-    for l in libs:
-      _add_lib(c[1], name, l, 'general', adding)
+    sizes = {}
+    for i in sources:
+      try:
+	sizes[i] = os.path.getsize(os.path.join(projdir, i))
+      except OSError:
+	sizes[i] = 0
+    batches = _unity_batches(sources, [b[1] for b in oldbatches], count, sizes)
+    for n, members in enumerate(batches):
+      lines.append('target_sources(%s PRIVATE %s/unity_%d.cpp)' % (name, _unity_dir, n))
+      lines.append('set_source_files_properties(%s PROPERTIES HEADER_FILE_ONLY ON)' % str.join(' ', members))
+  c[1] = lines
+
+# Share sources out into count batches of about the same total size, keeping the
+# batches of old where they are still good enough. sizes maps each source to its
+# size. Empty batches are left out.
+def _unity_batches(sources, old, count, sizes):
+  count = min(count, len(sources))
+  if count == 0:
+    return []
+  if len(old) == count:
+    placed = set()
+    batches = []
+    for members in old:
+      batch = [i for i in members if i in sizes and i not in placed]
+      placed.update(batch)
+      batches.append(batch)
+    totals = [sum(sizes[i] for i in batch) for batch in batches]
+    for i in sources:
+      if i not in placed:
+	n = totals.index(min(totals))
+	batches[n].append(i)
+	totals[n] += sizes[i]
+	placed.add(i)
+    share = float(sum(totals)) / count
+    biggest = totals.index(max(totals))
+    if min(len(batch) for batch in batches) > 0:
+      # A batch of one source can't be made smaller
+      if totals[biggest] <= share * _unity_slack or len(batches[biggest]) == 1:
+	return batches
+
+  # Biggest first, each to the batch that is smallest so far. The batches then
+  # list their sources in the order of the sources chunk, and come in the order
+  # of their first source.
+  order = dict((i, n) for n, i in enumerate(sources))
+  batches = [[] for n in xrange(count)]
+  totals = [0] * count
+  for i in sorted(sources, key=lambda i: (-sizes[i], order[i])):
+    n = totals.index(min(totals))
+    batches[n].append(i)
+    totals[n] += sizes[i]
+  for batch in batches:
+    batch.sort(key=order.get)
+  batches.sort(key=lambda batch: order[batch[0]])
+  return batches
+
+# Return the CMakeLists of the project given by preflags followed by those of all
+# its managed subprojects, found by following the add_subdirectory entries in the
+# subdirs chunk of each project. Files that can't be parsed are included so that
+# the failure gets reported.
+def _find_tree(preflags):
+  found = []
+  seen = set()
+  queue = [_get_cmakelists(preflags)]
+  while queue:
+    filename = queue.pop(0)
+    realname = os.path.realpath(filename)
+    if realname in seen:
+      continue
+    seen.add(realname)
+    try:
+      chunks = _load_chunks(_with_cmakelists(preflags, filename))
+    except Exception:
+      found.append(filename)
+      continue
+    try:
+      _get_type(chunks)
+    except Exception:
+      continue
+    found.append(filename)
+    c = chunkparser.find(chunks, 'subdirs')
+    if c is None:
+      continue
+    dirname = os.path.dirname(filename)
+    for line in c[1]:
+      if _is_plain_chunk(line):
+	m = _subdir.match(line)
+	if m:
+	  subfilename = os.path.join(dirname, m.group(1), 'CMakeLists.txt')
+	  if os.path.isfile(subfilename):
+	    queue.append(subfilename)
+  return found
+
+# Call func(*args) with its output captured. Returns (exit status, output). There
+# is nobody to answer prompts, so stdin reads as empty.
+def _captured(func, *args):
+  from StringIO import StringIO
+  out = StringIO()
+  stdout = sys.stdout
+  stdin = sys.stdin
+  sys.stdout = out
+  sys.stdin = StringIO()
+  status = 0
+  try:
+    try:
+      func(*args)
+    except SystemExit as e:
+      status = e.code or 0
+    except Exception as e:
+      print 'ERROR: %s' % str(e)
+      status = 1
+  finally:
+    sys.stdout = stdout
+    sys.stdin = stdin
+  return status, out.getvalue()
+
+# Run a command on one file of a recursive run. This is called in a pool worker,
+# so rather than printing, it returns (filename, succeeded, output).
+def _run_one(job):
+  filename, preflags, cmdwords, groups = job
+  status, output = _captured(_dispatch, _with_cmakelists(preflags, filename), cmdwords, groups)
+  return filename, status == 0, output
 
-  # Blow chunks
-  _save_chunks(preflags, chunks)
+# Return the number of worker processes given by --jobs=N, or None for as many as
+# there are CPUs
+def _get_jobs(preflags):
+  jobs = _find_preflag(preflags, '--jobs')
+  if jobs == True or jobs == False:
+    return None
+  return int(jobs)
+
+# Run a command on every project in the tree, in a process pool, and print a
+# summary for each file
+def _run_recursive(preflags, cmdwords, groups):
+  preflags = [k for k in preflags if k != '--recursive']
+  jobs = _get_jobs(preflags)
+  work = [(f, preflags, cmdwords, groups) for f in _find_tree(preflags)]
+  if jobs == 1 or len(work) < 2:
+    results = itertools.imap(_run_one, work)
+  else:
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap(_run_one, work)
+    pool.close()
+
+  failed = 0
+  for filename, succeeded, output in results:
+    if succeeded:
+      print '%s: ok' % filename
+    else:
+      print '%s: failed' % filename
+      failed += 1
+    for line in output.splitlines():
+      print '  %s' % line
+  if failed:
+    raise Exception('%d of %d projects failed' % (failed, len(work)))
+
+# Read the project in filename for the dependency graph. This is called in a pool
+# worker, so it returns just what the graph needs: (filename, key of the file,
+# entry), where entry is (name, type, [(target, library)...], [subdir...]), or
+# None if the file isn't managed by proj.
+def _read_project(job):
+  filename, preflags = job
+  try:
+    chunks = _load_chunks(_with_cmakelists(preflags, filename))
+    try:
+      projtype = _get_type(chunks)
+    except Exception:
+      return filename, chunks.origin, None
+    links = []
+    c = chunkparser.find(chunks, 'linklibs')
+    if c is not None:
+      for line in filter(_is_plain_chunk, c[1]):
+	m = _linklib.match(line)
+	if m:
+	  links.append((m.group(1), m.group(3)))
+    subdirs = []
+    c = chunkparser.find(chunks, 'subdirs')
+    if c is not None:
+      for line in filter(_is_plain_chunk, c[1]):
+	m = _subdir.match(line)
+	if m:
+	  subdirs.append(m.group(1))
+    return filename, chunks.origin, (_get_name(chunks), projtype, links, subdirs)
+  except Exception as e:
+    raise Exception('%s: %s' % (filename, str(e)))
+
+# Return the depgraph.Graph of the targets in the project given by preflags and
+# all its subprojects. The tree is walked a level of subdirectories at a time,
+# and the projects of each level are read in a process pool.
+#
+# What was read from each file is kept in an index in the cache, keyed by the
+# real path of the root project, and a file whose key (see _file_key) hasn't
+# changed isn't read again, so an unchanged tree costs one stat per project.
+def _project_graph(preflags):
+  import depgraph
+  cache = _get_cache(preflags, True)
+  root = _get_cmakelists(preflags)
+  rootdir = os.path.dirname(root)
+  cachekey = 'graph:' + os.path.realpath(root)
+  index = cache.get(cachekey) or {}
+  newindex = {}
+  jobs = _get_jobs(preflags)
+  pool = None
+  # The index makes keeping whole parsed files in the cache as well a waste
+  readflags = [k for k in preflags if k != '--cache' and not k.startswith('--cache=')]
+  graph = depgraph.Graph()
+  # Projects are known by the path of their directory relative to the root's,
+  # which doesn't depend on where proj is run from and costs less than a real
+  # path. The (device, inode) of each file catches a directory reached twice
+  # through symbolic links.
+  inodes = set()
+  # (project, directory of a subproject) for every subdirectory, and the name of
+  # the project in each directory
+  subdirs = []
+  names = {}
+  # Unlike its subdirectories, the root project has to be there
+  _file_key(root)
+  queue = ['.']
+  try:
+    while queue:
+      found = []
+      work = []
+      for reldir in queue:
+	filename = os.path.join(rootdir, reldir, 'CMakeLists.txt')
+	try:
+	  st = os.stat(filename)
+	except OSError:
+	  continue
+	if (st.st_dev, st.st_ino) in inodes:
+	  continue
+	inodes.add((st.st_dev, st.st_ino))
+	key = _stat_key(st)
+	cached = index.get(reldir)
+	if cached is not None and cached[0] == key:
+	  newindex[reldir] = cached
+	  found.append((reldir, filename, cached[1]))
+	else:
+	  work.append((filename, readflags))
+      if jobs == 1 or len(work) < 2:
+	results = itertools.imap(_read_project, work)
+      else:
+	if pool is None:
+	  import multiprocessing
+	  pool = multiprocessing.Pool(jobs)
+	results = pool.imap(_read_project, work)
+      for filename, key, entry in results:
+	reldir = os.path.relpath(os.path.dirname(filename) or '.', rootdir or '.')
+	newindex[reldir] = (key, entry)
+	found.append((reldir, filename, entry))
+
+      queue = []
+      for reldir, filename, entry in found:
+	if entry is None:
+	  continue
+	name, projtype, links, subdirnames = entry
+	graph.add_target(name, projtype, filename)
+	names[reldir] = name
+	for target, lib in links:
+	  graph.add_dependency(target, lib, 'link')
+	for subdir in subdirnames:
+	  subreldir = os.path.normpath(os.path.join(reldir, subdir))
+	  subdirs.append((name, subreldir))
+	  queue.append(subreldir)
+  finally:
+    if pool is not None:
+      pool.terminate()
+  for name, reldir in subdirs:
+    if reldir in names:
+      graph.add_dependency(name, names[reldir], 'subdir')
+  # Projects no longer in the tree are dropped from the index
+  if newindex != index:
+    cache.put(cachekey, newindex)
+  return graph
+
+# Handle one request from a client of the server. A request is a JSON object with
+# "args", the command line exactly as it would be given to proj.py, and optionally
+# "cwd", the directory to run it in. The response is a JSON object with the exit
+# "status" and the "output" of the command.
+def _handle_request(line):
+  import json
+  servedir = os.getcwd()
+  try:
+    request = json.loads(line)
+    args = [str(a) for a in request['args']]
+    cwd = request.get('cwd')
+    if cwd is not None:
+      os.chdir(str(cwd))
+    status, output = _captured(process_cmdline, args)
+  except Exception as e:
+    status, output = 1, 'ERROR: bad request: %s\n' % str(e)
+  finally:
+    os.chdir(servedir)
+  if status != 0:
+    # A failed command may have edited cached chunks without saving them
+    _tree_cache.clear()
+  return json.dumps({'status': status, 'output': output}) + '\n'
+
+# Serve requests, one per line, from fin and write a response line for each to fout
+def _serve_stream(fin, fout):
+  for line in iter(fin.readline, ''):
+    if line.strip():
+      fout.write(_handle_request(line))
+      fout.flush()
+
+# Send a command line to the server listening on the socket and print its output.
+# This makes "proj.py --socket=PATH add ..." behave like "proj.py add ...".
+def _run_client(socketname, args):
+  import json
+  import socket
+  args = [a for a in args if a != '--socket' and not a.startswith('--socket=')]
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.connect(socketname)
+  f = s.makefile('rw')
+  f.write(json.dumps({'args': args, 'cwd': os.getcwd()}) + '\n')
+  f.flush()
+  response = json.loads(f.readline())
+  f.close()
+  s.close()
+  sys.stdout.write(response['output'])
+  if response['status'] != 0:
+    sys.exit(response['status'])
+
+# A project managed by proj, for Python code that edits projects without going
+# through the command line:
+#
+#   project = proj.Project.open('src/engine')
+#   project.add_sources(['engine.cpp', 'render.cpp'])
+#   project.set_define('USE_GL', '1')
+#   project.add_lib('gfx')
+#   project.save()
+#
+# Changes are queued and made to the chunks, each chunk in one pass, when the
+# project is saved, so thousands of edits made one at a time cost about as much
+# as the same edits made all at once by a single command, and the file is written
+# once. Nothing is printed or read from the console; problems with the project
+# raise an Error.
+#
+# The CMakeLists isn't locked while the project is open, only while it is saved.
+# If someone else changed it meanwhile, save() raises ConflictError and writes
+# nothing, and the project has to be opened again.
+class Project(object):
+  # Edit chunks, which have already been loaded. Paths of sources are relative to
+  # projdir, the directory of the CMakeLists. Use open() to edit a file.
+  def __init__(self, chunks, projdir=''):
+    self._chunks = chunks
+    self._projdir = projdir
+    self._session = None
+    # The queued changes: chunk name -> [(items, adding)...] for the sources and
+    # headers, chunk name -> [edit...] for statements (see _edit_statements) and
+    # [(count, exclude, adding)...] for unity builds (see _update_unity)
+    self._items = {}
+    self._statements = {}
+    self._unity = []
+    self._name = None
+
+  # Open the project whose CMakeLists is path, or is in the directory path
+  @classmethod
+  def open(cls, path='.'):
+    if os.path.isdir(path):
+      path = os.path.join(path, 'CMakeLists.txt')
+    session = _Session(['--cmakelists=%s' % path, '--optimistic'], lock=True)
+    project = cls(session.chunks, os.path.dirname(path))
+    project._session = session
+    return project
+
+  def name(self):
+    return _get_name(self._chunks)
+
+  # 'rootproject', 'executable' or 'library'
+  def type(self):
+    return _get_type(self._chunks)
+
+  # Add or remove paths, which are relative to the project directory
+  def add_sources(self, paths):
+    self._change_items('sources', paths, True)
+
+  def remove_sources(self, paths):
+    self._change_items('sources', paths, False)
+
+  def add_headers(self, paths):
+    self._change_items('headers', paths, True)
+
+  def remove_headers(self, paths):
+    self._change_items('headers', paths, False)
+
+  # Define name for the project's target, with value unless it is None. kind is
+  # 'PRIVATE', 'PUBLIC' or 'INTERFACE'. Setting a define that is already set
+  # changes its value.
+  def set_define(self, name, value=None, kind='PRIVATE'):
+    self._change_define(name, value, kind, True)
+
+  def remove_define(self, name, kind='PRIVATE'):
+    self._change_define(name, None, kind, False)
+
+  # Link the project's target to the library lib
+  def add_lib(self, lib):
+    self._change_statement('linklibs', _lib_edit(self._target(), 'general', lib, True))
+
+  def remove_lib(self, lib):
+    self._change_statement('linklibs', _lib_edit(self._target(), 'general', lib, False))
+
+  # Add the project in subdir, relative to the project directory
+  def add_subdir(self, subdir):
+    self._change_statement('subdirs', _subdir_edit(subdir, True))
+
+  def remove_subdir(self, subdir):
+    self._change_statement('subdirs', _subdir_edit(subdir, False))
+
+  # Make the queued changes and write the CMakeLists, and any unity batch files
+  # that changed. The file is left alone if nothing in it changed.
+  def save(self):
+    if self._session is None:
+      raise Error('the project wasn\'t opened from a file')
+    self._apply()
+    self._session.commit()
+    # Later changes are saved over the file as it is now
+    self._session.origin = _file_key(self._session.filename)
+
+  def _change_items(self, name, items, adding):
+    if self.type() == 'rootproject':
+      raise EditError('sources and headers can\'t be added to a rootproject')
+    _find_chunk(self._chunks, name)
+    changes = self._items.setdefault(name, [])
+    # Consecutive changes the same way are made together
+    if type(items) in (list, tuple):
+      if changes and changes[-1][1] == adding and type(changes[-1][0]) is list:
+	changes[-1][0].extend(items)
+      else:
+	changes.append((list(items), adding))
+    else:
+      changes.append((items, adding))
+
+  def _change_define(self, name, value, kind, adding):
+    if kind not in ('PRIVATE', 'PUBLIC', 'INTERFACE'):
+      raise EditError('a define is PRIVATE, PUBLIC or INTERFACE, not %s' % kind)
+    if value is None:
+      value = ''
+    else:
+      value = '=' + value
+    self._change_statement('definitions', _define_edit(self._target(), kind, name, value, adding))
+
+  # The name of the target, looked up once for all the changes queued
+  def _target(self):
+    if self._name is None:
+      self._name = _get_name(self._chunks)
+    return self._name
+
+  def _change_statement(self, name, edit):
+    _find_chunk(self._chunks, name)
+    self._statements.setdefault(name, []).append(edit)
+
+  def _change_unity(self, count, exclude, adding):
+    if self.type() == 'rootproject':
+      raise EditError('a rootproject has no sources to build in batches')
+    self._unity.append((count, exclude, adding))
+
+  # Make the queued changes to the chunks
+  def _apply(self):
+    chunks = self._chunks
+    for name, changes in self._items.iteritems():
+      c = _edit_chunk(chunks, name)
+      for items, adding in changes:
+	_add_to_chunk(c, items, adding)
+    for name, edits in self._statements.iteritems():
+      regex, key, replace = _statement_chunks[name]
+      _edit_statements(_edit_chunk(chunks, name)[1], regex, key, edits, replace)
+    # Batches follow the sources
+    unity = self._unity
+    if not unity and 'sources' in self._items:
+      unity = [(None, [], True)]
+    for count, exclude, adding in unity:
+      _update_unity(chunks, self._projdir, count, exclude, adding)
+    self._items = {}
+    self._statements = {}
+    self._unity = []
+    self._name = None
 
 # Command implementations.
 
@@ -341,60 +1516,771 @@ def cmd_help(preflags, groups):
   usage()
 
 def cmd_new_rootproject(preflags, groups):
-  _init_from_template(templates.rootproject, preflags, groups)
+  import templates
+  session = _init_from_template(templates.rootproject, preflags, groups)
+  session.commit()
 
 def cmd_new_executable(preflags, groups):
-  _init_from_template(templates.executable, preflags, groups)
-  chunks = _load_chunks(preflags)
-  name = _get_name(chunks)
-  exename = _find_chunk(chunks, 'exename')
+  import templates
+  session = _init_from_template(templates.executable, preflags, groups)
+  name = _get_name(session.chunks)
+  exename = _edit_chunk(session.chunks, 'exename')
   exename[1] = [name]
-  _save_chunks(preflags, chunks)
+  session.commit()
 
 def cmd_new_library(preflags, groups):
-  _init_from_template(templates.library, preflags, groups)
-  chunks = _load_chunks(preflags)
-  name = _get_name(chunks)
-  libname = _find_chunk(chunks, 'libname')
+  import templates
+  session = _init_from_template(templates.library, preflags, groups)
+  name = _get_name(session.chunks)
+  libname = _edit_chunk(session.chunks, 'libname')
   libname[1] = [name]
-  exports = _find_chunk(chunks, 'exports')
+  exports = _edit_chunk(session.chunks, 'exports')
   exports[1] = ['target_include_directories(%s INTERFACE ${CMAKE_CURRENT_SOURCE_DIR})' % name]
-  _save_chunks(preflags, chunks)
+  session.commit()
 
 def cmd_add(preflags, groups):
-  _add_or_remove(preflags, groups, True)
+  projdir = os.path.dirname(_get_cmakelists(preflags))
+  _edit(preflags, lambda chunks: _add_or_remove(Project(chunks, projdir), groups, True))
 
 def cmd_remove(preflags, groups):
-  _add_or_remove(preflags, groups, False)
+  projdir = os.path.dirname(_get_cmakelists(preflags))
+  _edit(preflags, lambda chunks: _add_or_remove(Project(chunks, projdir), groups, False))
 
-def process_cmdline(args):
-  preflags, cmdwords, groups = optparser.parse(args)
-  # TODO: validate all the stuff we just parsed:
-  # * Only recognized preflags are allowed
-  # * Only recognized commands are allowed
-  # * Only recognized groups are allowed
-  #
-  # The individual commands can validate the specific usages of preflags and groups.
-  
-  if cmdwords == []:
-    usage()
+# Make the sources and headers chunks match the files on disk. Files found under
+# the scanned directories (the project's directory unless --sources-from or
+# --headers-from say otherwise) are added, and entries under those directories
+# whose files no longer exist are removed. The directories of subprojects, those
+# in the subdirs chunk and those holding a CMakeLists managed by proj, are left
+# out. The directory listings are kept in the cache between runs, so only
+# directories that changed are listed again.
+def cmd_sync(preflags, groups):
+  import sourcescan
+  # The chunks to keep up to date, the groups that give the directories to scan
+  # for them and the files looked for by default
+  syncable = [
+    ('--sources-from', 'sources', sourcescan.SOURCES),
+    ('--headers-from', 'headers', sourcescan.HEADERS),
+  ]
+  filename = _get_cmakelists(preflags)
+  projdir = os.path.dirname(filename)
+  cache = _get_cache(preflags, True)
+  key = 'dirs:' + os.path.realpath(filename)
+  snapshot = sourcescan.Snapshot(cache.get(key) or {})
+  exclude = groups.get('--exclude', [])
+  # The scan doesn't depend on the file, so it isn't repeated if the edit is
+  # made again
+  found = []
+  for group, name, default in syncable:
+    tops = [posixpath.normpath(t) for t in groups.get(group) or ['.']]
+    include = _scan_include(groups, group, default)
+    found.append((name, tops, list(_scan_project(projdir, tops, include, exclude, snapshot))))
+
+  def sync(chunks):
+    if _get_type(chunks) == 'rootproject':
+      raise Exception('a rootproject has no sources or headers to sync')
+    # The directories of subprojects are left to them, even where they don't hold
+    # a project managed by proj
+    subdirs = _subdir_paths(chunks)
+    report = []
+    for name, tops, files in found:
+      files = [f for f in files if not _under(f, subdirs)]
+      chunk = _edit_chunk(chunks, name)
+      current = set(i.strip() for i in filter(_is_plain_chunk, chunk[1]))
+      gone = [i for i in current if _under(i, tops) and not os.path.exists(os.path.join(projdir, i))]
+      added = len(set(files) - current)
+      _add_to_chunk(chunk, gone, False)
+      _add_to_chunk(chunk, files, True)
+      report.append('%s: %d added, %d removed' % (name, added, len(gone)))
+    _update_unity(chunks, projdir, None, [], True)
+    return report
+
+  for line in _edit(preflags, sync):
+    print line
+  cache.put(key, snapshot.dirs)
+
+# Scan directories given relative to the project directory, yielding paths
+# relative to it as well as they are found. Subprojects are left out, and so are
+# the batch files of unity builds.
+def _scan_project(projdir, tops, include, exclude, snapshot):
+  import sourcescan
+  found = sourcescan.scan([os.path.normpath(os.path.join(projdir, t)) for t in tops], include, exclude, snapshot, _holds_project)
+  # The scan leaves off a top directory of ., which is what projdir is when the
+  # CMakeLists is given as ./CMakeLists.txt
+  base = os.path.normpath(projdir or '.').replace(os.sep, '/')
+  for f in found:
+    if base != '.':
+      if f.startswith(base + '/'):
+	f = f[len(base) + 1:]
+      else:
+	# A top outside the project directory
+	f = posixpath.relpath(f, base)
+    if not _is_unity_batch(f):
+      yield f
+
+# Return the directories of the add_subdirectory entries in the subdirs chunk,
+# relative to the project directory
+def _subdir_paths(chunks):
+  subdirs = []
+  c = chunkparser.find(chunks, 'subdirs')
+  if c is not None:
+    for line in filter(_is_plain_chunk, c[1]):
+      m = _subdir.match(line)
+      if m and posixpath.normpath(m.group(1)) != '.':
+	subdirs.append(posixpath.normpath(m.group(1)))
+  return subdirs
+
+# Return a function telling whether a file, given relative to the project
+# directory projdir, belongs to a subproject: it is under one of subdirs, or
+# under a directory that holds a project managed by proj (see _holds_project)
+def _in_subproject(projdir, subdirs):
+  held = {}
+  def check(path):
+    if _under(path, subdirs):
+      return True
+    dirname = posixpath.dirname(path)
+    while dirname:
+      if dirname not in held:
+	full = os.path.join(projdir, dirname)
+	entries = [('CMakeLists.txt', False)] if os.path.isfile(os.path.join(full, 'CMakeLists.txt')) else []
+	held[dirname] = _holds_project(full, entries)
+      if held[dirname]:
+	return True
+      dirname = posixpath.dirname(dirname)
+    return False
+  return check
 
+# Return True if dirname, whose entries are listed (see sourcescan.scan), holds a
+# project managed by proj. The files of a subproject are its own.
+def _holds_project(dirname, entries):
+  if ('CMakeLists.txt', False) not in entries:
+    return False
+  try:
+    f = open(os.path.join(dirname, 'CMakeLists.txt'), 'r')
+    try:
+      _get_type(chunkparser.parse(f))
+    finally:
+      f.close()
+  except Exception:
+    return False
+  return True
+
+# Return True if path (relative to the project directory) is a file under one of
+# the directories in tops. Entries that aren't plain paths never count.
+def _under(path, tops):
+  if not path or not _is_plain_path(path):
+    return False
+  path = posixpath.normpath(path)
+  if posixpath.isabs(path) or path == '..' or path.startswith('../'):
+    return False
+  for t in tops:
+    if t == '.' or path.startswith(t + '/'):
+      return True
+  return False
+
+# Return False for an entry of the sources or headers chunk that uses CMake
+# variables or generator expressions, whose path only CMake can tell
+def _is_plain_path(path):
+  return '$' not in path and not path.startswith('<')
+
+# Add the local headers included by the project's sources to its headers chunk.
+# Every #include "..." in a source is looked up relative to the source's
+# directory and then the project directory, and a header found inside the project
+# directory is added and scanned for includes in turn. Like for sync, headers in
+# the directories of subprojects are theirs, and left out. Files are read in a
+# thread pool, and the includes of each file are kept in the cache, so a rescan
+# only reads the files that changed.
+def cmd_scan_headers(preflags, groups):
+  filename = _get_cmakelists(preflags)
+  projdir = os.path.dirname(filename)
+  cache = _get_cache(preflags, True)
+  key = 'include-index:' + os.path.realpath(filename)
+  index = cache.get(key) or {}
+  includes = _Includes(projdir, index, _get_jobs(preflags))
+
+  def scan(chunks):
+    if _get_type(chunks) == 'rootproject':
+      raise Exception('a rootproject has no sources to scan')
+    headers = _scan_includes(includes, _get_sources(chunks), _in_subproject(projdir, _subdir_paths(chunks)))
+    chunk = _edit_chunk(chunks, 'headers')
+    current = set(i.strip() for i in filter(_is_plain_chunk, chunk[1]))
+    _add_to_chunk(chunk, headers, True)
+    return 'headers: %d added' % len(set(headers) - current)
+
+  try:
+    print _edit(preflags, scan)
+  finally:
+    includes.close()
+  # Files that are no longer scanned are dropped from the index
+  if includes.entries != index:
+    cache.put(key, includes.entries)
+
+# Return the sources listed in the sources chunk
+def _get_sources(chunks):
+  return [i.strip() for i in filter(_is_plain_chunk, _find_chunk(chunks, 'sources')[1]) if i.strip()]
+
+# Choose the headers to precompile for a project: those included by the most of
+# its sources, directly, that are included by at least two of them and haven't
+# changed for a while, since a change to a precompiled header means compiling
+# everything again. System headers (#include <...> that isn't a file in the
+# project) are taken not to change. The --top of them are written to the pch
+# chunk. What each file includes is kept in the cache, like for scan-headers.
+def cmd_pch(preflags, groups):
+  top = _get_number(groups, '--top', _pch_top)
+  days = _get_number(groups, '--stable-days', _pch_stable_days)
+  if top < 0 or days < 0:
+    raise Exception('--top and --stable-days can\'t be negative')
+  filename = _get_cmakelists(preflags)
+  projdir = os.path.dirname(filename)
+  cache = _get_cache(preflags, True)
+  key = 'include-index:' + os.path.realpath(filename)
+  index = cache.get(key) or {}
+  includes = _Includes(projdir, index, _get_jobs(preflags))
+
+  def choose(chunks):
+    if _get_type(chunks) == 'rootproject':
+      raise Exception('a rootproject has no sources to precompile headers for')
+    sources = _get_sources(chunks)
+    keys = includes.keys(sources)
+    includes.read(sorted(keys), keys)
+    # How many sources include each header, and when it last changed (None for
+    # system headers)
+    counts = {}
+    mtimes = {}
+    for path in keys:
+      if path not in includes.entries:
+	continue
+      dirname = posixpath.dirname(path)
+      for include in set(includes.entries[path][1]):
+	if include[0] == '"':
+	  found = includes.resolve(dirname, include[1:-1])
+	else:
+	  found = includes.resolve('', include[1:-1])
+	if found is not None:
+	  header, mtime = found[0], found[1][0]
+	elif include[0] == '<':
+	  header, mtime = include, None
+	else:
+	  # Found on an include path proj doesn't know about
+	  continue
+	counts[header] = counts.get(header, 0) + 1
+	mtimes[header] = mtime
+    cutoff = time.time() - days * 24 * 60 * 60
+    ranked = sorted(counts, key=lambda h: (-counts[h], h))
+    chosen = [h for h in ranked if counts[h] > 1 and (mtimes[h] is None or mtimes[h] <= cutoff)][:top]
+
+    chunk = _edit_or_add_chunk(chunks, 'pch', ('addexe', 'addlib', 'unity'))
+    lines = []
+    if chosen:
+      # target_precompile_headers is new in CMake 3.16, older versions build
+      # without precompiled headers
+      lines.append('if(COMMAND target_precompile_headers)')
+      lines.append('  target_precompile_headers(%s PRIVATE' % _get_name(chunks))
+      lines += ['    %s' % h for h in chosen]
+      lines.append('  )')
+      lines.append('endif()')
+    chunk[1] = lines
+    return ['%s: included by %d of %d sources' % (h, counts[h], len(sources)) for h in chosen]
+
+  try:
+    report = _edit(preflags, choose)
+  finally:
+    includes.close()
+  for line in report:
+    print line
+  # Keep what scan-headers knows about the headers, as well as the sources
+  entries = dict(index)
+  entries.update(includes.entries)
+  if entries != index:
+    cache.put(key, entries)
+
+# How many headers pch chooses, and for how many days they must have been left
+# alone, unless told otherwise
+_pch_top = 10
+_pch_stable_days = 7
+
+# Return the number given by a group, or default if the group isn't given
+def _get_number(groups, group, default):
+  if group not in groups:
+    return default
+  try:
+    if len(groups[group]) != 1:
+      raise ValueError()
+    return int(groups[group][0])
+  except ValueError:
+    raise Exception('%s takes a number' % group)
+
+_include = _LazyRegex(r'^[ \t]*#[ \t]*include[ \t]*(<[^>\n]+>|"[^"\n]+")', re.MULTILINE)
+
+# What the files of a project include, read in a thread pool of jobs threads.
+# Paths are relative to the project directory, projdir. index maps each of them
+# to (key of the file, what it includes) as of the last time it was read, which
+# is used instead of reading a file whose key (see _file_key) is unchanged.
+# entries holds the entries of every file looked at since.
+class _Includes(object):
+  def __init__(self, projdir, index, jobs):
+    self.projdir = projdir
+    self.index = index
+    self.jobs = jobs
+    self.entries = {}
+    self.pool = None
+    # What each #include means in each directory, since the files in a
+    # directory tend to include the same headers
+    self.resolved = {}
+
+  # Return the keys of the files in paths, with None for those that aren't there
+  def keys(self, paths):
+    keys = {}
+    for path in paths:
+      path = posixpath.normpath(path)
+      try:
+	keys[path] = _file_key(os.path.join(self.projdir, path))
+      except OSError:
+	keys[path] = None
+    return keys
+
+  # Look up what each of the files in paths includes, given their keys, so that
+  # it is in entries. A file that isn't there is left out.
+  def read(self, paths, keys):
+    work = []
+    for path in paths:
+      if keys[path] is None:
+	continue
+      cached = self.index.get(path)
+      if cached is not None and cached[0] == keys[path]:
+	self.entries[path] = cached
+      else:
+	work.append(path)
+    filenames = [os.path.join(self.projdir, path) for path in work]
+    if self.jobs == 1 or len(work) < 2:
+      results = itertools.imap(_read_includes, filenames)
+    else:
+      if self.pool is None:
+	from multiprocessing.pool import ThreadPool
+	self.pool = ThreadPool(self.jobs)
+      results = self.pool.imap(_read_includes, filenames)
+    for path, includes in itertools.izip(work, results):
+      self.entries[path] = (keys[path], includes)
+
+  # Return (path, key) for the file inside the project directory that a file in
+  # dirname means by the #include of include, or None if there is no such file
+  def resolve(self, dirname, include):
+    result = self.resolved.get((dirname, include), False)
+    if result is False:
+      result = self.resolved[dirname, include] = _resolve_include(self.projdir, dirname, include)
+    return result
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
+
+# Return the local headers included, directly or through other headers, by the
+# files in sources, using includes, an _Includes. Headers for which skip returns
+# True are neither returned nor scanned.
+def _scan_includes(includes, sources, skip):
+  headers = []
+  # The key of every file found so far
+  keys = includes.keys(sources)
+  queue = sorted(keys)
+  while queue:
+    includes.read(queue, keys)
+    found = []
+    for path in queue:
+      if path not in includes.entries:
+	continue
+      dirname = posixpath.dirname(path)
+      for include in includes.entries[path][1]:
+	if include[0] != '"':
+	  continue
+	header = includes.resolve(dirname, include[1:-1])
+	if header is not None and header[0] not in keys:
+	  keys[header[0]] = header[1]
+	  if skip(header[0]):
+	    continue
+	  headers.append(header[0])
+	  found.append(header[0])
+    queue = found
+  return headers
+
+# Return what the file includes, each as it is written in its #include with the
+# quotes or angle brackets. A file that can't be read includes nothing.
+def _read_includes(filename):
+  try:
+    f = open(filename, 'rb')
+  except IOError:
+    return []
+  try:
+    return _include.findall(f.read())
+  finally:
+    f.close()
+
+# Return (path, key) for the file that a file in dirname means by #include
+# "include", with both the path and dirname relative to the project directory,
+# or None if it isn't a file inside the project directory. Like a compiler, look
+# next to the including file first.
+def _resolve_include(projdir, dirname, include):
+  for header in (posixpath.join(dirname, include), include):
+    header = posixpath.normpath(header)
+    if header == '..' or header.startswith('../') or posixpath.isabs(header):
+      continue
+    try:
+      st = os.stat(os.path.join(projdir, header))
+    except OSError:
+      continue
+    if stat.S_ISREG(st.st_mode):
+      return header, _stat_key(st)
+  return None
+
+# Keep running, taking commands as JSON requests (see _handle_request) one per line
+# on stdin, or from clients connecting to --socket=PATH. Parsed CMakeLists are kept
+# in memory between commands and re-read only when the file changes.
+def cmd_serve(preflags, groups):
+  global _tree_cache
+  _tree_cache = {}
+  socketname = _find_preflag(preflags, '--socket')
+  if socketname == True or socketname == False:
+    _serve_stream(sys.stdin, sys.stdout)
+    return
+  import signal
+  import SocketServer
+  class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+      _serve_stream(self.rfile, self.wfile)
+  _remove_stale_socket(socketname)
+  server = SocketServer.UnixStreamServer(socketname, RequestHandler)
+  # Make sure the socket is removed when we are told to stop
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.remove(socketname)
+
+# Remove the socket a server that is no longer running left at socketname. Refuse
+# to touch anything else there, whether a server still listening or not a socket.
+def _remove_stale_socket(socketname):
+  import socket
+  try:
+    mode = os.lstat(socketname).st_mode
+  except OSError:
+    return
+  if not stat.S_ISSOCK(mode):
+    raise Exception('%s already exists and is not a socket' % socketname)
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    try:
+      s.connect(socketname)
+    except socket.error:
+      os.remove(socketname)
+      return
+  finally:
+    s.close()
+  raise Exception('a server is already listening on %s' % socketname)
+
+def cmd_info(preflags, groups):
+  chunks = _open_session(preflags, True).chunks
+  print '%s (%s)' % (_get_name(chunks), _get_type(chunks))
+
+# Chunks shown by the list command, and the groups that select them
+_listable = [
+  ('--sources', 'sources'),
+  ('--headers', 'headers'),
+  ('--defines', 'definitions'),
+  ('--libs', 'linklibs'),
+  ('--subdirs', 'subdirs'),
+]
+
+def cmd_list(preflags, groups):
+  chunks = _open_session(preflags, True).chunks
+  selected = [name for group, name in _listable if group in groups]
+  if not selected:
+    # List everything the project has
+    selected = [name for group, name in _listable if chunkparser.find(chunks, name) is not None]
+  for name in selected:
+    c = _find_chunk(chunks, name)
+    print '[%s]' % name
+    for i in filter(_is_plain_chunk, c[1]):
+      if i.strip():
+	print i.strip()
+
+# Show the dependency graph of the targets in a project and all its subprojects:
+# an order they can be built in and any cycles, or the whole graph in the dot
+# language or as JSON, or only the targets that depend on the given ones
+def cmd_graph(preflags, groups):
+  import depgraph
+  graph = _project_graph(preflags)
+  if '--dependents' in groups:
+    if not groups['--dependents']:
+      raise Exception('--dependents needs at least one target')
+    for name in depgraph.dependents(graph, groups['--dependents']):
+      print name
+  elif '--dot' in groups:
+    sys.stdout.write(depgraph.dot(graph))
+  elif '--json' in groups:
+    sys.stdout.write(depgraph.as_json(graph))
+  else:
+    order, cycles = depgraph.order(graph)
+    print '[order]'
+    for name in order:
+      print name
+    if cycles:
+      print '[cycles]'
+      for cycle in cycles:
+	print str.join(' ', cycle)
+
+# Check that a CMakeLists, or with --recursive (given before or after the command)
+# the whole tree of projects, is in order: that it parses, with its begin and end
+# markers matching, that it has a valid project name and a recognized type, and
+# that proj would write it back exactly as it is. Every problem is reported with
+# its line number. Nothing is ever written, not even to the cache. The files are
+# checked in a process pool, one level of subdirectories at a time.
+def cmd_check(preflags, groups):
+  recursive = _find_preflag(preflags, '--recursive') or '--recursive' in groups
+  jobs = _get_jobs(preflags)
+  pool = None
+  checked = 0
+  failed = 0
+  seen = set()
+  queue = [_get_cmakelists(preflags)]
+  try:
+    while queue:
+      work = []
+      for filename in queue:
+	realname = os.path.realpath(filename)
+	if realname not in seen:
+	  seen.add(realname)
+	  work.append(filename)
+      if jobs == 1 or len(work) < 2:
+	results = itertools.imap(_check_file, work)
+      else:
+	if pool is None:
+	  import multiprocessing
+	  pool = multiprocessing.Pool(jobs)
+	results = pool.imap(_check_file, work)
+      queue = []
+      for filename, problems, subdirs in results:
+	checked += 1
+	if problems:
+	  failed += 1
+	for lineno, message in problems:
+	  if lineno is None:
+	    print '%s: %s' % (filename, message)
+	  else:
+	    print '%s:%d: %s' % (filename, lineno, message)
+	if recursive:
+	  dirname = os.path.dirname(filename)
+	  for subdir in subdirs:
+	    subfilename = os.path.join(dirname, subdir, 'CMakeLists.txt')
+	    if os.path.isfile(subfilename):
+	      queue.append(subfilename)
+  finally:
+    if pool is not None:
+      pool.terminate()
+  if failed:
+    raise Exception('%d of %d files failed the check' % (failed, checked))
+  if checked == 1:
+    print '1 file ok'
+  else:
+    print '%d files ok' % checked
+
+_error_line = _LazyRegex(r'line ([0-9]+): (.*)')
+
+# Check one CMakeLists for cmd_check. This is called in a pool worker, so rather
+# than printing, it returns (filename, [(line number or None, problem)...],
+# [subdirectory...]).
+def _check_file(filename):
+  try:
+    f = open(filename, 'r')
+    try:
+      data = f.read()
+    finally:
+      f.close()
+  except IOError as e:
+    return filename, [(None, str(e))], []
+  try:
+    chunks = chunkparser.parse(data)
+  except Exception as e:
+    m = _error_line.match(str(e))
+    if m:
+      return filename, [(int(m.group(1)), m.group(2))], []
+    return filename, [(None, str(e))], []
+
+  problems = []
+  subdirs = []
+  try:
+    _get_type(chunks)
+  except Exception as e:
+    problems.append((1, str(e)))
+  else:
+    c = chunkparser.find(chunks, 'projectname')
+    if c is None:
+      problems.append((1, 'couldn\'t find \'projectname\' chunk'))
+    else:
+      try:
+	_get_name(chunks)
+      except Exception as e:
+	start = [span[1] for span in chunks.spans if span[0] is c][0]
+	problems.append((data.count('\n', 0, start) + 1, str(e)))
+    c = chunkparser.find(chunks, 'subdirs')
+    if c is not None:
+      for line in filter(_is_plain_chunk, c[1]):
+	m = _subdir.match(line)
+	if m:
+	  subdirs.append(m.group(1))
+  text = chunkparser.generate(chunks)
+  if text != data:
+    offset = len(os.path.commonprefix([text, data]))
+    problems.append((data.count('\n', 0, offset) + 1, 'proj would not write this back as it is'))
+  return filename, problems, subdirs
+
+# Commands which --recursive applies to every project in the tree
+_recursive_commands = ['add', 'remove', 'info', 'list']
+
+# Run a batch of commands, one per line of f, given just as they would be on the
+# command line. Blank lines and # comments are skipped. All the commands work on
+# the same in-memory chunks and every CMakeLists they changed is written once when
+# the batch ends. If any command fails, nothing is written.
+def _run_batch(preflags, f):
+  import shlex
+  from StringIO import StringIO
+  global _batch_sessions
+  if _batch_sessions is not None:
+    raise Exception('batches can\'t be nested')
+  _batch_sessions = {}
+  stdin = sys.stdin
+  # Nobody can answer a prompt in the middle of a batch
+  sys.stdin = StringIO()
+  try:
+    lineno = 0
+    for line in f:
+      lineno += 1
+      args = shlex.split(line, True)
+      if not args:
+	continue
+      linepreflags, cmdwords, groups = optparser.parse(preflags + args)
+      func = _find_command(cmdwords)
+      if func is None:
+	raise Exception('line %d: unrecognized command \'%s\'' % (lineno, str.join(' ', cmdwords)))
+      if cmdwords[0] in ('batch', 'serve') or _find_preflag(linepreflags, '--recursive'):
+	raise Exception('line %d: \'%s\' can\'t be used in a batch' % (lineno, str.join(' ', cmdwords)))
+      try:
+	func(linepreflags, groups)
+      except Exception as e:
+	raise Exception('line %d: %s' % (lineno, str(e)))
+    # Nothing is saved if any file was changed meanwhile. Unlike a single edit,
+    # a batch isn't tried again, since its commands may have printed things.
+    # Nothing is locked until now, and locking in order of directory (which is
+    # what is locked, see _lock) and then filename means two batches can't each
+    # hold a lock the other is waiting for.
+    for filename in sorted(_batch_sessions, key=lambda k: (os.path.dirname(k), k)):
+      _batch_sessions[filename].lock()
+      _batch_sessions[filename].check()
+    _save_all([(s.filename, s.chunks) for s in _batch_sessions.values()], _find_preflag(preflags, '--in-place'))
+  finally:
+    for s in _batch_sessions.values():
+      s.close()
+    _batch_sessions = None
+    sys.stdin = stdin
+
+# Return the function implementing a command, or None
+def _find_command(cmdwords):
   # To add a command, just define a function named cmd_my_command. You don't need to
   # change anything down here.
   #
   # For example:
   #   "new project" is provided by cmd_new_project
   #   "list" is provided by cmd_list
+  #   "scan-headers" is provided by cmd_scan_headers
     
-  cmd = 'cmd_' + str.join('_', cmdwords)
-  func = globals().get(cmd, None)
+  cmd = 'cmd_' + str.join('_', cmdwords).replace('-', '_')
+  return globals().get(cmd, None)
+
+def _dispatch(preflags, cmdwords, groups):
+  # batch takes the script to run as its second command word
+  if len(cmdwords) == 2 and cmdwords[0] == 'batch':
+    if cmdwords[1] == '-':
+      _run_batch(preflags, sys.stdin)
+    else:
+      f = open(cmdwords[1], 'r')
+      try:
+	_run_batch(preflags, f)
+      finally:
+	f.close()
+    return
+
+  func = _find_command(cmdwords)
   if not func:
     print 'ERROR: unrecognized command \'%s\'' % str.join(' ', cmdwords)
     usage(1)
   func(preflags, groups)
 
-try:
-  process_cmdline(sys.argv[1:])
-except Exception as e:
-  print 'ERROR: %s' % str(e)
-  sys.exit(1)
\ No newline at end of file
+def process_cmdline(args):
+  preflags, cmdwords, groups = optparser.parse(args)
+  # TODO: validate all the stuff we just parsed:
+  # * Only recognized preflags are allowed
+  # * Only recognized commands are allowed
+  # * Only recognized groups are allowed
+  #
+  # The individual commands can validate the specific usages of preflags and groups.
+  
+  if cmdwords == []:
+    usage()
+
+  timing = _find_preflag(preflags, '--timing')
+  if timing:
+    modules = set(sys.modules)
+    commandstart = time.time()
+
+  profile = _find_preflag(preflags, '--profile')
+  if profile:
+    import profiler
+    profiling = profiler.Profiler(_profiled_functions(), profile)
+    profiling.start()
+
+  try:
+    socketname = _find_preflag(preflags, '--socket')
+    if socketname not in (True, False) and cmdwords != ['serve']:
+      _run_client(socketname, args)
+    elif _find_preflag(preflags, '--recursive') and str.join(' ', cmdwords) in _recursive_commands:
+      _run_recursive(preflags, cmdwords, groups)
+    else:
+      _dispatch(preflags, cmdwords, groups)
+  finally:
+    if profile:
+      profiling.stop()
+    if timing:
+      _report_timing(commandstart, modules)
+
+# The functions --profile times, as (phase, namespace, name of the function). See
+# profiler.py.
+def _profiled_functions():
+  import sourcescan
+  return [
+    ('read', globals(), '_load_chunks'),
+    ('parse', vars(chunkparser), 'parse'),
+    ('scan', vars(sourcescan), 'scan'),
+    ('lookup', vars(chunkparser), 'find'),
+    ('edit', globals(), '_add_to_chunk'),
+    ('edit', globals(), '_edit_statements'),
+    ('edit', globals(), '_set_name'),
+    ('generate', vars(chunkparser), 'pieces'),
+    ('compare', globals(), '_same_as_file'),
+    ('compare', globals(), '_plan_edits'),
+    ('write', globals(), '_save_all'),
+  ]
+
+# Print how long importing proj.py and running the command took to stderr, along
+# with the modules the command had to import
+def _report_timing(commandstart, modules):
+  now = time.time()
+  sys.stderr.write('timing: imports %.1f ms, command %.1f ms, total %.1f ms\n' % ((_imported - _started) * 1000, (now - commandstart) * 1000, (now - _started) * 1000))
+  imported = sorted(m for m in set(sys.modules) - modules if sys.modules[m] is not None)
+  if imported:
+    sys.stderr.write('timing: imported by the command: %s\n' % str.join(' ', imported))
+
+if __name__ == '__main__':
+  try:
+    process_cmdline(sys.argv[1:])
+  except Exception as e:
+    print 'ERROR: %s' % str(e)
+    sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,164 @@
+import os
+import stat
+import time
+import fnmatch
+
+# scandir gives us the file type of each entry without a stat call. It is part of
+# os in newer Pythons and available as a separate module for older ones.
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# File names included by default
+SOURCES = ['*.c', '*.cc', '*.cpp', '*.cxx', '*.c++']
+HEADERS = ['*.h', '*.hh', '*.hpp', '*.hxx', '*.inl']
+
+# Per-directory ignore files. Each line is a pattern, matched against the names and
+# the paths (relative to the directory holding the ignore file) of everything below
+# that directory. A pattern ending in / only matches directories. Blank lines and
+# lines starting with # are ignored.
+IGNOREFILE = '.projignore'
+
+# Directories that are never scanned
+_always_ignored = ['.git', '.hg', '.svn']
+
+# Yield the path of every file under each directory in tops whose name matches one
+# of include and which isn't excluded by exclude or an ignore file. The exclude
+# patterns work like the lines of an ignore file in each top directory. Excluded
+# directories are not entered at all. Within a directory, entries are visited in
+# name order, so the result is the same from one run to the next.
+#
+# Paths are the top directory joined with the path below it, using / as separator,
+# which is what CMake expects.
+#
+# snapshot, if given, is a Snapshot. Directories whose mtime hasn't changed since
+# the snapshot was taken aren't listed again, so a rescan of an unchanged tree
+# costs one stat per directory.
+#
+# skip, if given, is called with the path and the entries (see _list) of every
+# directory below a top directory, and nothing in a directory it returns True for
+# is scanned.
+def scan(tops, include, exclude=[], snapshot=None, skip=None):
+  for top in tops:
+    rules = [('', _parse_rule(p)) for p in exclude]
+    prefix = top.replace(os.sep, '/').rstrip('/')
+    if prefix in ('', '.'):
+      prefix = ''
+    else:
+      prefix += '/'
+
+    # Stack of (path relative to top, ignore rules in effect) for directories to scan
+    stack = [('', rules)]
+    while stack:
+      reldir, rules = stack.pop()
+      dirname = os.path.join(top, reldir)
+      if snapshot is None:
+	entries = _list(dirname)
+      else:
+	entries = snapshot.list(dirname)
+      if skip is not None and reldir and skip(dirname, entries):
+	continue
+      if (IGNOREFILE, False) in entries:
+	ignorefile = os.path.join(dirname, IGNOREFILE)
+	rules = rules + [(reldir, r) for r in _read_ignorefile(ignorefile)]
+
+      files = []
+      subdirs = []
+      for name, isdir in entries:
+	relpath = reldir + '/' + name if reldir else name
+	if isdir:
+	  if name not in _always_ignored and not _ignored(rules, name, relpath, True):
+	    subdirs.append(relpath)
+	elif _matches(include, name) and not _ignored(rules, name, relpath, False):
+	  files.append(relpath)
+
+      for relpath in files:
+	yield prefix + relpath
+      # Push in reverse so that subdirectories are visited in name order
+      for relpath in reversed(subdirs):
+	stack.append((relpath, rules))
+
+# List a directory as (name, isdir) pairs in name order. Symlinks to directories
+# count as files, so the scan can't loop.
+def _list(dirname):
+  if scandir is not None:
+    entries = [(e.name, e.is_dir(follow_symlinks=False)) for e in scandir(dirname)]
+  else:
+    entries = []
+    for name in os.listdir(dirname):
+      mode = os.lstat(os.path.join(dirname, name)).st_mode
+      entries.append((name, stat.S_ISDIR(mode)))
+  entries.sort()
+  return entries
+
+# The listings of the directories seen by one or more scans, with their mtimes.
+# dirs is what a previous snapshot's dirs held, and afterwards holds only the
+# directories scanned since, so saving it doesn't keep directories that are gone.
+class Snapshot(object):
+  def __init__(self, dirs=None):
+    self.previous = dirs or {}
+    self.dirs = {}
+
+  # List a directory, reusing the previous listing if its mtime hasn't changed. A
+  # directory modified in the last couple of seconds could change again without
+  # its mtime changing, so such a listing isn't trusted next time.
+  def list(self, dirname):
+    dirname = os.path.abspath(dirname)
+    mtime = os.stat(dirname).st_mtime
+    cached = self.dirs.get(dirname) or self.previous.get(dirname)
+    if cached is not None and cached[0] == mtime:
+      entries = cached[1]
+    else:
+      entries = _list(dirname)
+      if mtime > time.time() - 2:
+	mtime = None
+    self.dirs[dirname] = (mtime, entries)
+    return entries
+
+def _matches(patterns, name):
+  for p in patterns:
+    if fnmatch.fnmatchcase(name, p):
+      return True
+  return False
+
+# A rule is (pattern, matches directories only)
+def _parse_rule(pattern):
+  if pattern.endswith('/'):
+    return (pattern.rstrip('/'), True)
+  return (pattern, False)
+
+def _read_ignorefile(filename):
+  rules = []
+  f = open(filename, 'r')
+  try:
+    for line in f:
+      line = line.strip()
+      if line and not line.startswith('#'):
+	rules.append(_parse_rule(line))
+  finally:
+    f.close()
+  return rules
+
+# Rules are (directory the rule applies below, rule) pairs. A pattern with a /
+# in it is matched against the path relative to that directory, any other pattern
+# against the name alone.
+def _ignored(rules, name, relpath, isdir):
+  for base, (pattern, dironly) in rules:
+    if dironly and not isdir:
+      continue
+    if '/' in pattern:
+      if base:
+	if not relpath.startswith(base + '/'):
+	  continue
+	subpath = relpath[len(base) + 1:]
+      else:
+	subpath = relpath
+      if fnmatch.fnmatchcase(subpath, pattern.lstrip('/')):
+	return True
+    elif fnmatch.fnmatchcase(name, pattern):
+      return True
+  return False
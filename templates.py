@@ -42,6 +42,12 @@ add_executable(
 )
 # --== proj end addexe ==--
 
+# --== proj begin unity ==--
+# --== proj end unity ==--
+
+# --== proj begin pch ==--
+# --== proj end pch ==--
+
 # --== proj begin definitions ==--
 # --== proj end definitions ==--
 
@@ -78,6 +84,12 @@ add_library(
 )
 # --== proj end addlib ==--
 
+# --== proj begin unity ==--
+# --== proj end unity ==--
+
+# --== proj begin pch ==--
+# --== proj end pch ==--
+
 # --== proj begin definitions ==--
 # --== proj end definitions ==--
 
@@ -1,6 +1,7 @@
 import sys
 import chunkparser
 import unittest
+from StringIO import StringIO
 
 input_data_emptystring = ''
 input_data_test = 'test'
@@ -137,7 +138,232 @@ class test_chunkparser_parse(unittest.TestCase):
   def test_bad(self):
     for name, val in globals().items():
       if name.startswith('input_baddata_'):
-	self.assertRaises(Exception, lambda: chunkparser.parse(val))
+	self.assertRaises(chunkparser.ParseError, lambda: chunkparser.parse(val))
     
+class test_chunkparser_stream(unittest.TestCase):
+  # Parsing a file object must give the same result as parsing its contents
+  def test_file_object(self):
+    for name, val in globals().items():
+      if name.startswith('input_data_'):
+	self.assertEqual(chunkparser.parse(val), chunkparser.parse(StringIO(val)))
+
+  def test_line_iterator(self):
+    result = chunkparser.parse(iter(['a\n', '# --== proj begin b ==--\n', 'c\n', '# --== proj end b ==--\n']))
+    self.assertEqual(['a', ['b', ['c']], ''], result)
+
+  def test_deep_nesting(self):
+    depth = sys.getrecursionlimit() * 2
+    data = ''.join('# --== proj begin c%d ==--\n' % i for i in xrange(depth))
+    data += ''.join('# --== proj end c%d ==--\n' % i for i in reversed(xrange(depth)))
+    result = chunkparser.parse(StringIO(data))
+    self.assertEqual(depth, len(result.names))
+
+  def test_unexpected_close_line_number(self):
+    try:
+      chunkparser.parse(StringIO(input_baddata_1))
+      self.fail('expected an exception')
+    except Exception as e:
+      self.assertTrue(str(e).startswith('line 2:'), str(e))
+
+  def test_missing_close_line_number(self):
+    try:
+      chunkparser.parse('a\n' + input_baddata_2)
+      self.fail('expected an exception')
+    except Exception as e:
+      self.assertTrue(str(e).startswith('line 2:'), str(e))
+
+class test_chunkparser_generate(unittest.TestCase):
+  def test_empty_chunks(self):
+    self.assertEqual('# --== proj begin a ==--\n# --== proj end a ==--', chunkparser.generate([['a', []]]))
+    self.assertEqual('# --== proj begin a ==--\n# --== proj end a ==--', chunkparser.generate([['a', ['']]]))
+    self.assertEqual('# --== proj begin a ==--\n\n\n# --== proj end a ==--', chunkparser.generate([['a', ['', '']]]))
+
+  def test_write_matches_generate(self):
+    for name, val in globals().items():
+      if name.startswith('input_data_'):
+	chunks = chunkparser.parse(val)
+	out = StringIO()
+	chunkparser.write(chunks, out)
+	self.assertEqual(chunkparser.generate(chunks), out.getvalue())
+
+  def test_deep_nesting(self):
+    depth = sys.getrecursionlimit() * 2
+    data = '\n'.join(['# --== proj begin c%d ==--' % i for i in xrange(depth)] + ['x'] + ['# --== proj end c%d ==--' % i for i in reversed(xrange(depth))])
+    self.assertEqual(data, chunkparser.generate(chunkparser.parse(data)))
+
+class test_chunkparser_find(unittest.TestCase):
+  def test_index_nested_chunks(self):
+    result = chunkparser.parse(input_data_proj6)
+    self.assertEqual(['b', 'd'], sorted(result.names.keys()))
+    self.assertTrue(chunkparser.find(result, 'd') is result[1][1][1])
+
+  def test_index_keeps_first_occurrence(self):
+    result = chunkparser.parse(input_data_proj5.replace('proj begin e', 'proj begin b').replace('proj end e', 'proj end b'))
+    self.assertTrue(chunkparser.find(result, 'b') is result[1])
+
+  def test_missing_chunk(self):
+    result = chunkparser.parse(input_data_proj6)
+    self.assertEqual(None, chunkparser.find(result, 'x'))
+
+  def test_find_in_unindexed_list(self):
+    chunks = ['a', ['b', ['c', ['d', ['e']]]], 'f', '']
+    self.assertTrue(chunkparser.find(chunks, 'd') is chunks[1][1][1])
+    self.assertEqual(None, chunkparser.find(chunks, 'x'))
+
+  def test_templates_indexed(self):
+    result = chunkparser.parse(input_data_template_executable)
+    for name in ['executable', 'projectname', 'exename', 'sources', 'headers', 'definitions', 'linklibs', 'subdirs']:
+      self.assertEqual(name, chunkparser.find(result, name)[0])
+
+class test_chunkparser_lines(unittest.TestCase):
+  # Lines are only cut out of the text when they are needed
+  def test_lazy_until_changed(self):
+    chunks = chunkparser.parse(input_data_template_executable)
+    sources = chunkparser.find(chunks, 'addexe')[1]
+    self.assertTrue(isinstance(sources, chunkparser.Lines))
+    self.assertEqual(7, len(sources))
+    self.assertEqual(['add_executable(', ['exename', []], '', ['sources', []], '', ['headers', []], ')'], list(sources))
+    self.assertEqual(None, sources._items)
+    sources.append('x')
+    self.assertEqual(')', sources[-2])
+    self.assertEqual(chunkparser.generate(chunks), input_data_template_executable.replace(')\n# --== proj end addexe', ')\nx\n# --== proj end addexe'))
+
+  def test_list_operations(self):
+    lines = chunkparser.parse('a\nb\nc\nd')
+    self.assertEqual(4, len(lines))
+    self.assertEqual(['b', 'c'], lines[1:3])
+    self.assertEqual(['a', 'b', 'c', 'd'], list(lines))
+    self.assertTrue('c' in lines)
+    self.assertEqual(2, lines.index('c'))
+    self.assertRaises(IndexError, lambda: lines[4])
+    lines[1:3] = ['x']
+    del lines[0]
+    lines.insert(0, 'y')
+    self.assertEqual(['y', 'x', 'd'], lines)
+    self.assertNotEqual(['y', 'x'], lines)
+
+  def test_chunk_is_like_a_list(self):
+    chunk = chunkparser.parse('# --== proj begin a ==--\nb\n# --== proj end a ==--')[0]
+    self.assertTrue(chunkparser.is_chunk(chunk))
+    self.assertTrue(chunkparser.is_chunk(['a', []]))
+    self.assertFalse(chunkparser.is_chunk('a'))
+    name, children = chunk
+    self.assertEqual(('a', ['b']), (name, children))
+    self.assertEqual(['a', ['b']], chunk)
+    self.assertNotEqual(['a', ['c']], chunk)
+    chunk[1] = ['c']
+    self.assertEqual(['a', ['c']], chunk)
+
+  # Parsing the same text from a string, a file and an iterator of lines gives
+  # the same tree and spans
+  def test_same_as_line_parser(self):
+    for name, val in globals().items():
+      if name.startswith('input_data_'):
+	fromlines = chunkparser.parse(iter(StringIO(val)))
+	for result in [chunkparser.parse(val), chunkparser.parse(StringIO(val))]:
+	  self.assertEqual(fromlines, result)
+	  self.assertEqual([s[1:] for s in fromlines.spans], [s[1:] for s in result.spans])
+
+  def test_pickle(self):
+    import cPickle
+    chunks = chunkparser.parse(input_data_template_executable)
+    copy = cPickle.loads(cPickle.dumps(chunks, cPickle.HIGHEST_PROTOCOL))
+    self.assertEqual(chunks, copy)
+    self.assertTrue(chunkparser.find(copy, 'sources') is copy.spans[4][0])
+    self.assertEqual(input_data_template_executable, chunkparser.generate(copy))
+
+# Apply the edits returned by chunkparser.patches to text
+def apply_edits(text, edits):
+  out = []
+  pos = 0
+  for start, end, body in edits:
+    out.append(text[pos:start])
+    out.append(body)
+    pos = end
+  out.append(text[pos:])
+  return ''.join(out)
+
+class test_chunkparser_spans(unittest.TestCase):
+  def check_spans(self, text, chunks):
+    for chunk, start, end in chunks.spans:
+      self.assertEqual(chunkparser.body(chunk), text[start:end])
+
+  def test_spans_cover_bodies(self):
+    for name, val in globals().items():
+      if name.startswith('input_data_'):
+	self.check_spans(val, chunkparser.parse(val))
+	self.check_spans(val, chunkparser.parse(StringIO(val)))
+
+  def test_unchanged(self):
+    self.assertEqual([], chunkparser.patches(chunkparser.parse(input_data_template_executable)))
+
+  def test_patch_changed_chunks(self):
+    text = input_data_template_executable
+    chunks = chunkparser.parse(text)
+    for name, items in [('sources', ['a.cpp', 'b.cpp']), ('exename', ['hello']), ('definitions', [])]:
+      c = chunkparser.find(chunks, name)
+      c[1] = items
+      chunkparser.changed(chunks, c)
+    edits = chunkparser.patches(chunks)
+    self.assertEqual(3, len(edits))
+    text = apply_edits(text, edits)
+    self.assertEqual(chunkparser.generate(chunks), text)
+    chunkparser.patched(chunks, edits)
+    self.assertEqual([], chunks.dirty)
+    self.check_spans(text, chunks)
+
+    # The updated spans are good for another round of edits
+    c = chunkparser.find(chunks, 'headers')
+    c[1].append('a.h')
+    chunkparser.changed(chunks, c)
+    text = apply_edits(text, chunkparser.patches(chunks))
+    self.assertEqual(chunkparser.generate(chunks), text)
+
+  # Only the outermost changed chunk is replaced, and chunks inside it lose their
+  # spans once it has been
+  def test_nested_changes(self):
+    text = input_data_proj6
+    chunks = chunkparser.parse(text)
+    outer = chunkparser.find(chunks, 'b')
+    inner = chunkparser.find(chunks, 'd')
+    inner[1].append('x')
+    outer[1].insert(0, 'y')
+    chunkparser.changed(chunks, inner)
+    chunkparser.changed(chunks, outer)
+    edits = chunkparser.patches(chunks)
+    self.assertEqual(1, len(edits))
+    text = apply_edits(text, edits)
+    self.assertEqual(chunkparser.generate(chunks), text)
+    chunkparser.patched(chunks, edits)
+    self.assertEqual([outer], [s[0] for s in chunks.spans])
+    self.check_spans(text, chunks)
+    chunkparser.changed(chunks, inner)
+    self.assertEqual(None, chunkparser.patches(chunks))
+
+  # An inserted chunk is written with the body of the chunk it's in
+  def test_inserted_chunk(self):
+    text = input_data_template_executable
+    chunks = chunkparser.parse(text)
+    parent = chunkparser.find(chunks, 'addexe')
+    c = chunkparser.insert(chunks, parent, 1, 'new')
+    self.assertTrue(chunkparser.find(chunks, 'new') is c)
+    c[1].append('x')
+    edits = chunkparser.patches(chunks)
+    self.assertEqual(1, len(edits))
+    text = apply_edits(text, edits)
+    self.assertEqual(chunkparser.generate(chunks), text)
+    self.assertTrue('add_executable(\n# --== proj begin new ==--\nx\n# --== proj end new ==--\n' in text, text)
+
+  def test_whole_file_changed(self):
+    chunks = chunkparser.parse(input_data_proj6)
+    chunks.append('z')
+    chunkparser.changed(chunks, chunks)
+    self.assertEqual(None, chunkparser.patches(chunks))
+
+  def test_not_parsed(self):
+    chunks = chunkparser.Chunks([['a', ['b']]])
+    chunkparser.changed(chunks, chunks[0])
+    self.assertEqual(None, chunkparser.patches(chunks))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
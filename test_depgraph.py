@@ -0,0 +1,70 @@
+import json
+import depgraph
+import unittest
+
+# Build a graph of executables from (target, [targets it links to]) pairs
+def make_graph(links):
+  graph = depgraph.Graph()
+  for name, deps in links:
+    graph.add_target(name, 'executable', name + '/CMakeLists.txt')
+    for dep in deps:
+      graph.add_dependency(name, dep, 'link')
+  return graph
+
+class test_depgraph(unittest.TestCase):
+  def test_order(self):
+    graph = make_graph([('app', ['net', 'log']), ('net', ['log']), ('log', [])])
+    self.assertEqual((['log', 'net', 'app'], []), depgraph.order(graph))
+
+  def test_external(self):
+    graph = make_graph([('app', ['pthread'])])
+    self.assertEqual(('external', None), graph.targets['pthread'])
+    # A target that turns out to be built in the tree stops being external
+    graph.add_target('pthread', 'library', 'pthread/CMakeLists.txt')
+    self.assertEqual(['pthread', 'app'], depgraph.order(graph)[0])
+    self.assertRaises(Exception, graph.add_target, 'app', 'library', 'other/CMakeLists.txt')
+
+  def test_cycles(self):
+    graph = make_graph([('a', ['b']), ('b', ['c']), ('c', ['a']), ('d', ['d', 'a'])])
+    order, cycles = depgraph.order(graph)
+    self.assertEqual(['a', 'b', 'c', 'd'], order)
+    self.assertEqual([['a', 'b', 'c'], ['d']], cycles)
+
+  # Deep graphs don't hit the recursion limit
+  def test_long_chain(self):
+    graph = make_graph([('t%d' % i, ['t%d' % (i - 1)] if i else []) for i in xrange(5000)])
+    self.assertEqual(['t%d' % i for i in xrange(5000)], depgraph.order(graph)[0])
+
+  def test_dependents(self):
+    graph = make_graph([('app', ['net']), ('net', ['log']), ('tool', ['log']), ('log', []), ('other', [])])
+    self.assertEqual(['net', 'app', 'tool'], depgraph.dependents(graph, ['log']))
+    self.assertEqual([], depgraph.dependents(graph, ['app']))
+    self.assertRaises(Exception, depgraph.dependents, graph, ['missing'])
+
+  def test_link_beats_subdir(self):
+    graph = make_graph([('app', ['lib']), ('lib', [])])
+    graph.add_dependency('app', 'lib', 'subdir')
+    self.assertEqual('link', graph.edges['app']['lib'])
+
+  def test_dot(self):
+    graph = make_graph([('app', ['lib']), ('lib', [])])
+    graph.add_target('top', 'rootproject', 'CMakeLists.txt')
+    graph.add_dependency('top', 'app', 'subdir')
+    self.assertEqual('digraph proj {\n'
+      '  "app" [shape=box];\n'
+      '  "lib" [shape=box];\n'
+      '  "top" [shape=folder];\n'
+      '  "app" -> "lib";\n'
+      '  "top" -> "app" [style=dashed];\n'
+      '}\n', depgraph.dot(graph))
+
+  def test_json(self):
+    graph = make_graph([('app', ['lib', 'm']), ('lib', [])])
+    result = json.loads(depgraph.as_json(graph))
+    self.assertEqual(['lib', 'm', 'app'], result['order'])
+    self.assertEqual([], result['cycles'])
+    self.assertEqual({'type': 'executable', 'file': 'app/CMakeLists.txt', 'links': ['lib', 'm'], 'subdirs': []}, result['targets']['app'])
+    self.assertEqual('external', result['targets']['m']['type'])
+
+if __name__ == '__main__':
+    unittest.main()
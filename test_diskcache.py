@@ -0,0 +1,94 @@
+import os
+import time
+import shutil
+import tempfile
+import diskcache
+import unittest
+
+class test_diskcache(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def test_miss(self):
+    cache = diskcache.DiskCache(self.dirname)
+    self.assertEqual(None, cache.get('missing'))
+
+  def test_put_get(self):
+    cache = diskcache.DiskCache(self.dirname)
+    cache.put('a', ['x', ['y', ['z']]])
+    self.assertEqual(['x', ['y', ['z']]], cache.get('a'))
+    cache.put('a', 2)
+    self.assertEqual(2, cache.get('a'))
+
+  def test_shared_directory(self):
+    diskcache.DiskCache(self.dirname).put('a', 1)
+    self.assertEqual(1, diskcache.DiskCache(self.dirname).get('a'))
+
+  def test_creates_directory(self):
+    dirname = os.path.join(self.dirname, 'sub', 'dir')
+    diskcache.DiskCache(dirname).put('a', 1)
+    self.assertEqual(1, diskcache.DiskCache(dirname).get('a'))
+
+  def test_remove(self):
+    cache = diskcache.DiskCache(self.dirname)
+    cache.put('a', 1)
+    cache.remove('a')
+    cache.remove('a')
+    self.assertEqual(None, cache.get('a'))
+
+  def test_corrupt_entry_is_a_miss(self):
+    cache = diskcache.DiskCache(self.dirname)
+    cache.put('a', 1)
+    f = open(cache._path('a'), 'wb')
+    f.write('not a pickle')
+    f.close()
+    self.assertEqual(None, cache.get('a'))
+
+  # Once the cache is full, storing an entry evicts the least recently used ones
+  def test_evicts_least_recently_used(self):
+    cache = diskcache.DiskCache(self.dirname, 3100)
+    value = 'x' * 900
+    now = time.time()
+    for i, key in enumerate(['a', 'b', 'c']):
+      cache.put(key, value)
+      os.utime(cache._path(key), (now - 100 + i, now - 100 + i))
+    # Reading 'a' makes 'b' the least recently used
+    self.assertEqual(value, cache.get('a'))
+    cache.put('d', value)
+    self.assertEqual(None, cache.get('b'))
+    self.assertEqual(value, cache.get('a'))
+    self.assertEqual(value, cache.get('c'))
+    self.assertEqual(value, cache.get('d'))
+
+  # The directory is only counted by the first store and when the running total
+  # goes over maxsize, which also picks up what other caches have stored
+  def test_counts_directory_rarely(self):
+    cache = diskcache.DiskCache(self.dirname, 10000)
+    listdir = os.listdir
+    counted = []
+    def count(dirname):
+      counted.append(dirname)
+      return listdir(dirname)
+    os.listdir = count
+    try:
+      value = 'x' * 900
+      for key in 'abcdefghij':
+	cache.put(key, value)
+      self.assertEqual(1, len(counted))
+      cache.put('a', value)
+      cache.remove('b')
+      self.assertEqual(1, len(counted))
+      diskcache.DiskCache(self.dirname).put('z', 'x' * 2000)
+      self.assertEqual(2, len(counted))
+      cache.put('k', 'x' * 2000)
+      self.assertEqual(3, len(counted))
+    finally:
+      os.listdir = listdir
+    self.assertEqual(cache.size, sum(os.path.getsize(os.path.join(self.dirname, name)) for name in os.listdir(self.dirname)))
+    self.assertTrue(cache.size <= 9000, cache.size)
+
+if __name__ == '__main__':
+    unittest.main()
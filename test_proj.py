@@ -0,0 +1,911 @@
+import os
+import sys
+import stat
+import time
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+proj = os.path.join(here, 'proj.py')
+
+# Modules that only some commands need. Importing them is most of the cost of
+# starting up, so simple commands mustn't.
+heavy_modules = [
+  'templates', 'diskcache', 'sourcescan', 'multiprocessing', 'json', 'socket',
+  'SocketServer', 'tempfile', 'shutil', 'hashlib', 'shlex', 'StringIO',
+  'profiler', 'cProfile', 'inspect', 'depgraph',
+]
+
+# How much longer than starting a bare interpreter running "proj.py info" may take,
+# in seconds. This is several times what it takes today, so that a slow machine
+# doesn't fail the test, but importing a heavy module at startup would.
+startup_budget = 0.05
+
+# What tells whether filename has been written: reading it changes its atime
+def file_key(filename):
+  st = os.stat(filename)
+  return st.st_mtime, st.st_size, st.st_ino
+
+# Run proj.py with args in cwd and return the names of the modules it imported
+def imported_modules(args, cwd):
+  code = '''
+import sys, atexit, runpy
+sys.path.insert(0, %r)
+sys.argv = %r
+atexit.register(lambda: sys.stderr.write('MODULES ' + ' '.join(k for k, v in sys.modules.items() if v is not None) + '\\n'))
+runpy.run_path(%r, run_name='__main__')
+''' % (here, [proj] + args, proj)
+  p = subprocess.Popen([sys.executable, '-c', code], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = p.communicate()
+  for line in err.splitlines():
+    if line.startswith('MODULES '):
+      return line.split()[1:]
+  raise Exception('no module list in output: %s' % err)
+
+# Return the shortest time taken by several runs of a command
+def best_time(args, cwd):
+  best = None
+  for i in xrange(5):
+    start = time.time()
+    subprocess.check_call(args, cwd=cwd, stdout=open(os.devnull, 'w'))
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+# A test with a temporary directory of its own, holding filename
+class ProjTestCase(unittest.TestCase):
+  # The --cache directory, relative to the test directory, given to every run of
+  # proj.py, or None for no cache
+  cache = None
+
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dirname, 'CMakeLists.txt')
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def write(self, path, data):
+    path = os.path.join(self.dirname, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+  def read(self, path='CMakeLists.txt'):
+    f = open(os.path.join(self.dirname, path), 'rb')
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  # Make the CMakeLists at path look like one made from the templates before they
+  # had the unity and pch chunks
+  def make_old(self, path='CMakeLists.txt'):
+    text = self.read(path)
+    for name in ['unity', 'pch']:
+      text = text.replace('# --== proj begin %s ==--\n# --== proj end %s ==--\n\n' % (name, name), '')
+    self.write(path, text)
+
+  # Run proj.py with args in subdir of the test directory and return its exit
+  # status, output and errors
+  def call_proj(self, args, subdir='.', env=None):
+    if self.cache is not None:
+      args = ['--cache=%s' % os.path.join(self.dirname, self.cache)] + args
+    p = subprocess.Popen([sys.executable, proj] + args, cwd=os.path.join(self.dirname, subdir), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return p.returncode, out, err
+
+  # Run proj.py, failing the test if it fails, and return its output
+  def run_proj(self, args, subdir='.'):
+    status, out, err = self.call_proj(args, subdir)
+    self.assertEqual(0, status, out + err)
+    return out
+
+class test_startup(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'hello.cpp'])
+
+  def test_no_heavy_imports(self):
+    for args in [['info'], ['list'], ['remove', '--sources', 'missing.cpp'], ['help']]:
+      modules = imported_modules(args, self.dirname)
+      self.assertTrue('chunkparser' in modules)
+      for m in heavy_modules:
+	self.assertFalse(m in modules, '%s imported by %s' % (m, ' '.join(args)))
+
+  def test_startup_budget(self):
+    bare = best_time([sys.executable, '-c', 'pass'], self.dirname)
+    info = best_time([sys.executable, proj, 'info'], self.dirname)
+    self.assertTrue(info - bare < startup_budget, 'proj.py info took %.1f ms longer than a bare interpreter' % ((info - bare) * 1000))
+
+  def test_timing_report(self):
+    status, out, err = self.call_proj(['--timing', 'info'])
+    self.assertEqual('hello (executable)\n', out)
+    self.assertTrue(err.startswith('timing: imports '), err)
+
+# Text that generating the chunks wouldn't reproduce: trailing spaces on markers
+# and hand-written lines, and a Windows line ending
+handwritten = '''# Hand-written   \r
+# --== proj begin executable ==--  
+# --== proj begin projectname ==--
+project(proj_hello)
+# --== proj end projectname ==--
+# --== proj begin addexe ==--
+add_executable(
+# --== proj begin exename ==--
+hello
+# --== proj end exename ==--
+# --== proj begin sources ==--
+hello.cpp
+# --== proj end sources ==--
+# --== proj begin headers ==--
+# --== proj end headers ==--
+)
+# --== proj end addexe ==--
+# --== proj begin definitions ==--
+target_compile_definitions(hello PRIVATE -DLEVEL=1)
+# --== proj end definitions ==--
+# --== proj end executable ==--    
+message(STATUS "done")'''
+
+class test_save(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.write('CMakeLists.txt', handwritten)
+
+  # Only the bodies of the chunks that changed are rewritten
+  def test_text_outside_changed_chunks_kept(self):
+    self.run_proj(['add', '--sources', 'more.cpp', '--defines', 'LEVEL=22'])
+    expected = handwritten.replace('hello.cpp\n', 'hello.cpp\nmore.cpp\n').replace('LEVEL=1', 'LEVEL=22')
+    self.assertEqual(expected, self.read())
+
+  # An edit that changes nothing doesn't touch the file, so CMake doesn't
+  # configure again, and one that does keeps its permissions and symlinks
+  def test_file_kept(self):
+    before = file_key(self.filename)
+    self.run_proj(['add', '--sources', 'hello.cpp'])
+    self.run_proj(['remove', '--sources', 'missing.cpp'])
+    self.assertEqual(before, file_key(self.filename))
+
+    os.chmod(self.filename, 0751)
+    self.run_proj(['add', '--sources', 'more.cpp'])
+    self.assertEqual(0751, stat.S_IMODE(os.stat(self.filename).st_mode))
+
+    os.rename(self.filename, os.path.join(self.dirname, 'real.txt'))
+    os.symlink('real.txt', self.filename)
+    self.run_proj(['add', '--sources', 'most.cpp'])
+    self.assertEqual('real.txt', os.readlink(self.filename))
+    self.assertTrue('most.cpp\n' in self.read('real.txt'))
+    self.assertEqual(0751, stat.S_IMODE(os.stat(self.filename).st_mode))
+
+  def test_batch(self):
+    script = os.path.join(self.dirname, 'edits.txt')
+    f = open(script, 'w')
+    f.write('add --sources more.cpp\nremove --sources hello.cpp\nadd --headers hello.h\n')
+    f.close()
+    self.run_proj(['batch', script])
+    expected = handwritten.replace('hello.cpp\n', 'more.cpp\n').replace('headers ==--\n', 'headers ==--\nhello.h\n', 1)
+    self.assertEqual(expected, self.read())
+
+  # A batch that fails on any line writes nothing, to any of its files
+  def test_batch_rollback(self):
+    os.mkdir(os.path.join(self.dirname, 'top'))
+    self.run_proj(['new', 'rootproject', '--name', 'top'], 'top')
+    before = [(self.read(path), file_key(os.path.join(self.dirname, path))) for path in ['CMakeLists.txt', 'top/CMakeLists.txt']]
+    edits = 'add --sources more.cpp\n--cmakelists=top/CMakeLists.txt add --subdirs app\n%s\nadd --headers hello.h\n'
+    for failing in ['--cmakelists=top/CMakeLists.txt add --sources top.cpp', 'no such command']:
+      self.write('edits.txt', edits % failing)
+      status, out, err = self.call_proj(['batch', 'edits.txt'])
+      self.assertEqual(1, status)
+      self.assertTrue(out.startswith('ERROR: line 3: '), out)
+      self.assertEqual(before, [(self.read(path), file_key(os.path.join(self.dirname, path))) for path in ['CMakeLists.txt', 'top/CMakeLists.txt']])
+    # Without the failing line, both files are written
+    self.write('edits.txt', edits % '')
+    self.run_proj(['batch', 'edits.txt'])
+    self.assertTrue('more.cpp\n' in self.read())
+    self.assertTrue('add_subdirectory(app)\n' in self.read('top/CMakeLists.txt'))
+
+  # With --in-place, big files are edited in place when nothing has to move
+  def test_in_place(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    module._inplace_size = 0
+    inode = os.stat(self.filename).st_ino
+    module.process_cmdline(['--cmakelists=%s' % self.filename, 'add', '--defines', 'LEVEL=2'])
+    self.assertEqual(handwritten.replace('LEVEL=1', 'LEVEL=2'), self.read())
+    # Without it the file is always replaced
+    self.assertNotEqual(inode, os.stat(self.filename).st_ino)
+    inode = os.stat(self.filename).st_ino
+    module.process_cmdline(['--cmakelists=%s' % self.filename, '--in-place', 'add', '--defines', 'LEVEL=3'])
+    self.assertEqual(handwritten.replace('LEVEL=1', 'LEVEL=3'), self.read())
+    self.assertEqual(inode, os.stat(self.filename).st_ino)
+    # A body that changes length means copying the file
+    module.process_cmdline(['--cmakelists=%s' % self.filename, '--in-place', 'add', '--defines', 'LEVEL=10'])
+    self.assertEqual(handwritten.replace('LEVEL=1', 'LEVEL=10'), self.read())
+    self.assertNotEqual(inode, os.stat(self.filename).st_ino)
+
+class test_add_to_chunk(unittest.TestCase):
+  def setUp(self):
+    import imp
+    self.proj = imp.load_source('proj_module', proj)
+
+  # Items are added once, ignoring whitespace, after what is already there and in
+  # the order given
+  def test_add(self):
+    chunk = ['sources', ['b.cpp', ' a.cpp ', ['nested', ['a.cpp']]]]
+    self.proj._add_to_chunk(chunk, iter(['c.cpp', 'a.cpp', ' b.cpp', 'd.cpp', 'c.cpp ']), True)
+    self.assertEqual(['sources', ['b.cpp', ' a.cpp ', ['nested', ['a.cpp']], 'c.cpp', 'd.cpp']], chunk)
+
+  # Removing keeps sub-chunks, even one that holds an item being removed, and
+  # the order of the rest
+  def test_remove(self):
+    chunk = ['sources', ['d.cpp', ' a.cpp', ['nested', ['a.cpp']], 'c.cpp ', 'b.cpp']]
+    self.proj._add_to_chunk(chunk, iter(['a.cpp', 'b.cpp ', 'missing.cpp']), False)
+    self.assertEqual(['sources', ['d.cpp', ['nested', ['a.cpp']], 'c.cpp']], chunk)
+
+class test_profile(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'hello.cpp'])
+
+  def test_table(self):
+    status, out, err = self.call_proj(['--profile', 'add', '--sources', 'more.cpp'])
+    phases = [line.split()[0] for line in err.splitlines()[1:]]
+    for phase in ['read', 'parse', 'lookup', 'edit', 'generate', 'compare', 'write', 'other', 'total']:
+      self.assertTrue(phase in phases, err)
+
+  def test_json(self):
+    import json
+    self.run_proj(['--profile=profile.json', 'info'])
+    results = json.load(open(os.path.join(self.dirname, 'profile.json')))
+    self.assertEqual(['lookup', 'parse', 'read'], sorted(results['phases']))
+    self.assertTrue(results['seconds'] >= sum(p['seconds'] for p in results['phases'].values()))
+
+  def test_cprofile(self):
+    import pstats
+    status, out, err = self.call_proj(['--profile=info.prof', 'info'])
+    self.assertEqual('hello (executable)\n', out)
+    stats = pstats.Stats(os.path.join(self.dirname, 'info.prof'))
+    self.assertTrue([f for f in stats.stats if f[2] == 'cmd_info'])
+
+class test_recursive(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.run_proj(['new', 'rootproject', '--name', 'top', '--subdirs', 'app', 'lib'])
+    for subdir, args in [('app', ['new', 'executable', '--name', 'app', '--sources', 'main.cpp']), ('lib', ['new', 'library', '--name', 'lib', '--sources', 'lib.cpp'])]:
+      os.mkdir(os.path.join(self.dirname, subdir))
+      self.run_proj(args, subdir)
+
+  def test_info(self):
+    self.assertEqual('CMakeLists.txt: ok\n  top (rootproject)\napp/CMakeLists.txt: ok\n  app (executable)\nlib/CMakeLists.txt: ok\n  lib (library)\n', self.run_proj(['--recursive', 'info']))
+
+  # A project failing is reported with its output, the others still run, and proj
+  # fails
+  def test_failure(self):
+    status, out, err = self.call_proj(['--jobs=2', '--recursive', 'list', '--sources'])
+    self.assertEqual(1, status)
+    self.assertEqual('CMakeLists.txt: failed\n  ERROR: couldn\'t find \'sources\' chunk\napp/CMakeLists.txt: ok\n  [sources]\n  main.cpp\nlib/CMakeLists.txt: ok\n  [sources]\n  lib.cpp\nERROR: 1 of 3 projects failed\n', out)
+    status, out, err = self.call_proj(['--recursive', 'add', '--defines', 'FAST'])
+    self.assertEqual(0, status, out)
+    for subdir in ['.', 'app', 'lib']:
+      self.assertTrue('-DFAST)' in self.read(os.path.join(subdir, 'CMakeLists.txt')), subdir)
+
+  # A subproject that can't be parsed fails
+  def test_broken_subproject(self):
+    self.write('lib/CMakeLists.txt', '# --== proj begin library ==--\n')
+    status, out, err = self.call_proj(['--recursive', 'info'])
+    self.assertEqual(1, status)
+    self.assertTrue('lib/CMakeLists.txt: failed\n  ERROR: line 1: missing chunk close marker' in out, out)
+
+class test_serve(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'hello.cpp'])
+
+  # Send a request to the server reading from p's stdin and return the response
+  def request(self, p, args):
+    import json
+    p.stdin.write(json.dumps({'args': args, 'cwd': self.dirname}) + '\n')
+    p.stdin.flush()
+    response = json.loads(p.stdout.readline())
+    return response['status'], response['output']
+
+  def test_stdin(self):
+    p = subprocess.Popen([sys.executable, proj, 'serve'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+      self.assertEqual((0, ''), self.request(p, ['add', '--sources', 'more.cpp']))
+      self.assertEqual((0, '[sources]\nhello.cpp\nmore.cpp\n'), self.request(p, ['list', '--sources']))
+      # Files changed by someone else are read again, whether their size changed
+      # or just their mtime
+      self.write('CMakeLists.txt', self.read().replace('more.cpp', 'most.cpp'))
+      self.assertEqual((0, '[sources]\nhello.cpp\nmost.cpp\n'), self.request(p, ['list', '--sources']))
+      mtime = os.stat(self.filename).st_mtime
+      self.write('CMakeLists.txt', self.read().replace('most.cpp', 'mist.cpp'))
+      os.utime(self.filename, (mtime + 10, mtime + 10))
+      self.assertEqual((0, '[sources]\nhello.cpp\nmist.cpp\n'), self.request(p, ['list', '--sources']))
+      status, output = self.request(p, ['--cmakelists=missing.txt', 'info'])
+      self.assertEqual(1, status)
+      self.assertTrue(output.startswith('ERROR: '), output)
+      self.assertEqual((0, 'hello (executable)\n'), self.request(p, ['info']))
+    finally:
+      p.stdin.close()
+      self.assertEqual(0, p.wait())
+
+  def test_socket(self):
+    import signal
+    import socket
+    socketname = os.path.join(self.dirname, 'proj.sock')
+    # The socket of a server that is gone is replaced
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(socketname)
+    s.close()
+    p = subprocess.Popen([sys.executable, proj, '--socket=%s' % socketname, 'serve'], cwd=self.dirname)
+    try:
+      # Wait for the server to listen
+      deadline = time.time() + 10
+      while time.time() < deadline:
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+	  s.connect(socketname)
+	  break
+	except socket.error:
+	  time.sleep(0.01)
+	finally:
+	  s.close()
+      self.run_proj(['--socket=%s' % socketname, 'add', '--sources', 'more.cpp'])
+      self.assertEqual('[sources]\nhello.cpp\nmore.cpp\n', self.run_proj(['--socket=%s' % socketname, 'list', '--sources']))
+      # A second server can't take over the socket
+      status, out, err = self.call_proj(['--socket=%s' % socketname, 'serve'])
+      self.assertEqual(1, status)
+      self.assertTrue('already listening' in out, out)
+    finally:
+      os.kill(p.pid, signal.SIGTERM)
+      p.wait()
+    self.assertFalse(os.path.exists(socketname))
+
+  # Only a stale socket is removed
+  def test_not_a_socket(self):
+    self.write('notes.txt', 'notes\n')
+    status, out, err = self.call_proj(['--socket=notes.txt', 'serve'])
+    self.assertEqual(1, status)
+    self.assertEqual('notes\n', self.read('notes.txt'))
+
+class test_graph(ProjTestCase):
+  cache = 'cache'
+
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.run_proj(['new', 'rootproject', '--name', 'top', '--subdirs', 'app', 'lib'])
+    for subdir, args in [('lib', ['new', 'library', '--name', 'lib']), ('app', ['new', 'executable', '--name', 'app', '--libs', 'lib', 'm'])]:
+      os.mkdir(os.path.join(self.dirname, subdir))
+      self.run_proj(args, subdir)
+
+  def test_order(self):
+    self.assertEqual('[order]\nlib\nm\napp\ntop\n', self.run_proj(['graph']))
+    self.assertEqual('app\ntop\n', self.run_proj(['graph', '--dependents', 'lib']))
+    self.assertTrue('"app" -> "lib";' in self.run_proj(['graph', '--dot']))
+
+  def test_cycle(self):
+    os.mkdir(os.path.join(self.dirname, 'tool'))
+    self.run_proj(['new', 'executable', '--name', 'tool', '--libs', 'app'], 'tool')
+    self.run_proj(['add', '--subdirs', 'tool'])
+    self.run_proj(['add', '--libs', 'tool'], 'app')
+    self.assertEqual('[order]\nlib\nm\napp\ntool\ntop\n[cycles]\napp tool\n', self.run_proj(['graph']))
+
+  # Only projects that changed are read again
+  def test_index(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    read = []
+    def read_project(job):
+      read.append(os.path.basename(os.path.dirname(job[0])))
+      return _read_project(job)
+    _read_project = module._read_project
+    module._read_project = read_project
+    preflags = ['--cache=%s' % os.path.join(self.dirname, 'cache'), '--cmakelists=%s' % os.path.join(self.dirname, 'CMakeLists.txt'), '--jobs=1']
+    self.assertEqual(['app', 'lib', 'm', 'top'], sorted(module._project_graph(preflags).targets))
+    self.assertEqual(3, len(read))
+    del read[:]
+    module._project_graph(preflags)
+    self.assertEqual([], read)
+    self.run_proj(['remove', '--libs', 'm'], 'app')
+    self.assertEqual(['app', 'lib', 'top'], sorted(module._project_graph(preflags).targets))
+    self.assertEqual(['app'], read)
+
+  # A project reached twice is read once, but files on different devices are
+  # different files even when their inode numbers are the same
+  def test_same_file(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    preflags = ['--cmakelists=%s' % os.path.join(self.dirname, 'CMakeLists.txt'), '--jobs=1']
+    kinds = {'app': 'executable', 'lib': 'library', 'm': 'external', 'top': 'rootproject'}
+    os.symlink('lib', os.path.join(self.dirname, 'alias'))
+    self.run_proj(['add', '--subdirs', 'alias'])
+    self.assertEqual(kinds, dict((name, target[0]) for name, target in module._project_graph(preflags).targets.items()))
+    self.run_proj(['remove', '--subdirs', 'alias'])
+    stat = os.stat
+    def fake_stat(path):
+      st = stat(path)
+      subdir = os.path.basename(os.path.dirname(path))
+      if subdir not in ('app', 'lib'):
+	return st
+      return os.stat_result((st.st_mode, 1, ['app', 'lib'].index(subdir)) + tuple(st)[3:])
+    os.stat = fake_stat
+    try:
+      self.assertEqual(kinds, dict((name, target[0]) for name, target in module._project_graph(preflags).targets.items()))
+    finally:
+      os.stat = stat
+
+class test_sync(ProjTestCase):
+  cache = 'cache'
+
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    for path in ['app/main.cpp', 'app/src/alpha.cpp', 'app/r.h']:
+      self.write(path, '')
+    self.run_proj(['new', 'executable', '--name', 'app'], 'app')
+
+  def list(self):
+    return self.run_proj(['list', '--sources', '--headers'], 'app').split()
+
+  # However the CMakeLists is named, paths are relative to its directory
+  def test_paths(self):
+    expected = ['[sources]', 'main.cpp', 'src/alpha.cpp', '[headers]', 'r.h']
+    for args, subdir in [(['--cmakelists=./CMakeLists.txt'], 'app'), (['--cmakelists=./app/CMakeLists.txt'], '.'), (['--cmakelists=app/CMakeLists.txt'], '.'), ([], 'app')]:
+      self.run_proj(['remove', '--sources', 'main.cpp', 'src/alpha.cpp', '--headers', 'r.h'], 'app')
+      self.run_proj(args + ['sync'], subdir)
+      self.assertEqual(expected, self.list(), args)
+
+  # Subprojects have sources of their own
+  def test_subprojects(self):
+    self.write('app/lib/lib.cpp', '')
+    self.run_proj(['new', 'library', '--name', 'lib'], 'app/lib')
+    self.write('app/third/CMakeLists.txt', 'add_library(third third.cpp)\n')
+    self.write('app/third/third.cpp', '')
+    self.write('app/third/more/more.cpp', '')
+    self.run_proj(['add', '--subdirs', 'third'], 'app')
+    self.run_proj(['sync'], 'app')
+    self.assertEqual(['[sources]', 'main.cpp', 'src/alpha.cpp', '[headers]', 'r.h'], self.list())
+
+  # add and new scan directories relative to the project, like sync
+  def test_add_from(self):
+    self.write('app/gen/k.cpp', '')
+    self.run_proj(['--cmakelists=app/CMakeLists.txt', 'add', '--sources-from', 'gen'])
+    self.run_proj(['sync', '--sources-from', 'gen', '--headers-from'], 'app')
+    self.assertEqual(['[sources]', 'gen/k.cpp', '[headers]', 'r.h'], self.list())
+    # Under --recursive, each project scans its own directory
+    self.run_proj(['remove', '--sources', 'gen/k.cpp'], 'app')
+    self.write('app/lib/lib.cpp', '')
+    self.run_proj(['new', 'library', '--name', 'lib'], 'app/lib')
+    self.run_proj(['add', '--subdirs', 'lib'], 'app')
+    self.run_proj(['--recursive', 'add', '--sources-from', '.'], 'app')
+    self.assertEqual(['[sources]', 'main.cpp', 'gen/k.cpp', 'src/alpha.cpp', '[headers]', 'r.h'], self.list())
+    self.assertEqual(['[sources]', 'lib.cpp'], self.run_proj(['list', '--sources'], 'app/lib').split())
+
+  # Sources and headers are each found by their own patterns
+  def test_include(self):
+    for path in ['other/a.cpp', 'other/b.cc', 'other/c.h', 'other/d.hh']:
+      self.write(path, '')
+    self.run_proj(['new', 'executable', '--name', 'other', '--sources-from', '.', '--headers-from', '.', '--sources-include', '*.cc', '--headers-include', '*.hh'], 'other')
+    self.assertEqual(['[sources]', 'b.cc', '[headers]', 'd.hh'], self.run_proj(['list', '--sources', '--headers'], 'other').split())
+    self.run_proj(['sync', '--sources-include', '*.cpp'], 'other')
+    self.assertEqual(['[sources]', 'b.cc', 'a.cpp', '[headers]', 'd.hh', 'c.h'], self.run_proj(['list', '--sources', '--headers'], 'other').split())
+    # A pattern that would apply to both is refused
+    status, out, err = self.call_proj(['add', '--sources-from', '.', '--headers-from', '.', '--include', '*.cpp'], 'other')
+    self.assertEqual(1, status)
+    self.assertTrue('--sources-include' in out, out)
+
+
+class test_scan_headers(ProjTestCase):
+  cache = 'cache'
+
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.write('main.cpp', '#include "util.h"\n#include <vector>\n  #  include "src/a.h"\n#include "missing.h"\n')
+    self.write('util.h', '#pragma once\n')
+    self.write('src/a.cpp', '#include "a.h"\n')
+    self.write('src/a.h', '#include "detail/b.h"\n#include "../util.h"\n')
+    self.write('src/detail/b.h', '#include "util.h"\n#include "../../../outside.h"\n')
+    self.write('other.h', '')
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'main.cpp', 'src/a.cpp', '--headers', 'other.h'])
+
+  def test_scan(self):
+    self.assertEqual('headers: 3 added\n', self.run_proj(['--jobs=2', 'scan-headers']))
+    self.assertEqual('[headers]\nother.h\nutil.h\nsrc/a.h\nsrc/detail/b.h\n', self.run_proj(['list', '--headers']))
+    self.assertEqual('headers: 0 added\n', self.run_proj(['scan-headers']))
+
+  # Headers of subprojects are theirs, whether the project adds their directory
+  # or they hold a project managed by proj
+  def test_subprojects(self):
+    self.write('hello/hello.h', '')
+    self.run_proj(['new', 'library', '--name', 'hello', '--headers', 'hello.h'], 'hello')
+    self.write('third/third.h', '')
+    self.write('third/CMakeLists.txt', 'add_library(third third.h)\n')
+    self.write('main.cpp', '#include "hello/hello.h"\n#include "third/third.h"\n#include "util.h"\n')
+    self.run_proj(['add', '--subdirs', 'third'])
+    self.assertEqual('headers: 3 added\n', self.run_proj(['scan-headers']))
+    self.assertEqual('[headers]\nother.h\nutil.h\nsrc/a.h\nsrc/detail/b.h\n', self.run_proj(['list', '--headers']))
+
+  # Only files that changed are read again
+  def test_index(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    read = []
+    def read_includes(filename):
+      read.append(os.path.relpath(filename, self.dirname))
+      return _read_includes(filename)
+    _read_includes = module._read_includes
+    module._read_includes = read_includes
+    args = ['--cache=%s' % os.path.join(self.dirname, 'cache'), '--cmakelists=%s' % os.path.join(self.dirname, 'CMakeLists.txt'), 'scan-headers']
+    module.process_cmdline(args)
+    self.assertEqual(['main.cpp', 'src/a.cpp', 'util.h', 'src/a.h', 'src/detail/b.h'], read)
+    del read[:]
+    module.process_cmdline(args)
+    self.assertEqual([], read)
+    self.write('src/a.cpp', '#include "a.h"\n#include "new.h"\n')
+    self.write('new.h', '')
+    module.process_cmdline(args)
+    self.assertEqual(['src/a.cpp', 'new.h'], read)
+    self.assertTrue('new.h\n' in self.run_proj(['list', '--headers']))
+
+class test_unity(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    for n, size in enumerate([400, 300, 300, 200, 100, 100]):
+      self.write('src/f%d.cpp' % n, '//' * size)
+    self.write('c.c', '')
+
+  # The members of each batch, read from the batch files
+  def batches(self):
+    names = sorted(os.listdir(os.path.join(self.dirname, 'unity')))
+    return [[line[len('#include "../'):-1] for line in self.read('unity/' + name).splitlines() if line.startswith('#include')] for name in names]
+
+  def test_batches(self):
+    sources = ['c.c'] + ['src/f%d.cpp' % n for n in xrange(6)]
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources'] + sources + ['--unity', '2', '--unity-exclude', 'src/f5.cpp'])
+    # Balanced by size, C files and excluded files are left to compile on their own
+    self.assertEqual([['src/f0.cpp', 'src/f3.cpp', 'src/f4.cpp'], ['src/f1.cpp', 'src/f2.cpp']], self.batches())
+    text = self.read('CMakeLists.txt')
+    self.assertTrue('target_sources(hello PRIVATE unity/unity_0.cpp)\nset_source_files_properties(src/f0.cpp src/f3.cpp src/f4.cpp PROPERTIES HEADER_FILE_ONLY ON)\n' in text, text)
+
+    # A new source goes to the smallest batch, and only that batch is written
+    before = file_key(os.path.join(self.dirname, 'unity/unity_0.cpp'))
+    self.write('src/new.cpp', '//' * 100)
+    self.run_proj(['add', '--sources', 'src/new.cpp'])
+    self.assertEqual([['src/f0.cpp', 'src/f3.cpp', 'src/f4.cpp'], ['src/f1.cpp', 'src/f2.cpp', 'src/new.cpp']], self.batches())
+    self.assertEqual(before, file_key(os.path.join(self.dirname, 'unity/unity_0.cpp')))
+    self.run_proj(['remove', '--sources', 'src/f0.cpp', '--unity-exclude', 'src/f5.cpp'])
+    self.assertEqual([['src/f3.cpp', 'src/f4.cpp', 'src/f5.cpp'], ['src/f1.cpp', 'src/f2.cpp', 'src/new.cpp']], self.batches())
+
+    # Changing the number of batches shares the sources out again
+    self.run_proj(['add', '--unity', '3'])
+    self.assertEqual([['src/f1.cpp', 'src/f5.cpp'], ['src/f2.cpp', 'src/new.cpp'], ['src/f3.cpp', 'src/f4.cpp']], self.batches())
+    self.run_proj(['remove', '--unity'])
+    self.assertEqual([], self.batches())
+    self.assertFalse('unity_0' in self.read('CMakeLists.txt'))
+
+  def test_sync(self):
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'src/f0.cpp', '--unity'])
+    self.assertEqual([['src/f0.cpp']], self.batches())
+    self.run_proj(['sync', '--headers-from'])
+    # The batch files are never taken for sources, and C files aren't batched
+    self.assertEqual(6, sum(len(batch) for batch in self.batches()))
+    self.assertEqual(4, len(self.batches()))
+    self.assertFalse('unity/' in self.read('CMakeLists.txt').split('# --== proj begin sources ==--')[1].split('# --== proj end sources ==--')[0])
+
+  # Only CMake knows where entries using variables or generator expressions are
+  def test_not_plain_paths(self):
+    sources = ['src/f0.cpp', '${CMAKE_CURRENT_SOURCE_DIR}/gen/b.cpp', '$<$<CONFIG:Debug>:src/debug.cpp>', '<generated.cpp']
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources'] + sources + ['--unity', '2'])
+    self.assertEqual([['src/f0.cpp']], self.batches())
+    self.assertFalse('${' in self.read('unity/unity_0.cpp'))
+
+  # Files made before the templates had a unity chunk get one
+  def test_old_template(self):
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'src/f0.cpp', 'src/f1.cpp'])
+    self.make_old()
+    old = self.read()
+    self.assertFalse('unity' in old)
+    self.run_proj(['add', '--unity', '2'])
+    self.assertEqual([['src/f0.cpp'], ['src/f1.cpp']], self.batches())
+    text = self.read()
+    self.assertTrue('# --== proj end addexe ==--\n\n# --== proj begin unity ==--\nset(proj_unity_batches 2)\n' in text, text)
+    self.assertEqual(old, text.split('# --== proj begin unity ==--')[0] + text.split('# --== proj end unity ==--\n\n')[1])
+    self.assertEqual('1 file ok\n', self.run_proj(['check']))
+
+
+class test_pch(ProjTestCase):
+  cache = 'cache'
+
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.write('src/common.h', '#pragma once\n')
+    self.write('fresh.h', '#pragma once\n')
+    month = time.time() - 30 * 24 * 60 * 60
+    os.utime(os.path.join(self.dirname, 'src/common.h'), (month, month))
+    for n in xrange(3):
+      self.write('f%d.cpp' % n, '#include <vector>\n#include "src/common.h"\n#include "fresh.h"\n#include "missing.h"\n')
+    self.write('main.cpp', '#include <vector>\n#include <map>\n')
+    self.write('src/a.cpp', '#include "common.h"\n#include <map>\n')
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'main.cpp', 'f0.cpp', 'f1.cpp', 'f2.cpp', 'src/a.cpp'])
+
+  # The headers in the pch chunk
+  def chosen(self):
+    body = self.read().split('# --== proj begin pch ==--\n')[1].split('# --== proj end pch ==--')[0]
+    return [line.strip() for line in body.splitlines() if line.startswith('    ')]
+
+  def test_pch(self):
+    out = self.run_proj(['pch'])
+    self.assertEqual('<vector>: included by 4 of 5 sources\nsrc/common.h: included by 4 of 5 sources\n<map>: included by 2 of 5 sources\n', out)
+    self.assertEqual(['<vector>', 'src/common.h', '<map>'], self.chosen())
+    # Headers that changed lately are only chosen when allowed
+    self.run_proj(['pch', '--stable-days', '0', '--top', '2'])
+    self.assertEqual(['<vector>', 'src/common.h'], self.chosen())
+    self.run_proj(['pch', '--stable-days', '0'])
+    self.assertEqual(['<vector>', 'src/common.h', 'fresh.h', '<map>'], self.chosen())
+    self.run_proj(['pch', '--top', '0'])
+    self.assertEqual([], self.chosen())
+
+  # Files made before the templates had a pch chunk get one, after the unity
+  # chunk if they have one
+  def test_old_template(self):
+    self.make_old()
+    self.run_proj(['pch'])
+    self.assertEqual(['<vector>', 'src/common.h', '<map>'], self.chosen())
+    self.assertTrue('# --== proj end addexe ==--\n\n# --== proj begin pch ==--\n' in self.read())
+    self.run_proj(['pch', '--top', '0'])
+    self.make_old()
+    self.assertFalse('pch' in self.read())
+    self.run_proj(['add', '--unity', '1'])
+    self.run_proj(['pch'])
+    self.assertTrue('# --== proj end unity ==--\n\n# --== proj begin pch ==--\n' in self.read())
+    self.assertEqual('1 file ok\n', self.run_proj(['check']))
+
+
+class test_check(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.run_proj(['new', 'rootproject', '--name', 'top', '--subdirs', 'good', 'name', 'markers', 'spaces'])
+    for subdir in ['good', 'name', 'markers', 'spaces']:
+      os.mkdir(os.path.join(self.dirname, subdir))
+      self.run_proj(['new', 'library', '--name', subdir], subdir)
+    self.edit('name', lambda text: text.replace('project(proj_name)', 'project(name)'))
+    self.edit('markers', lambda text: text.replace('# --== proj end headers ==--\n', '', 1))
+    self.edit('spaces', lambda text: text.replace('# --== proj end exports ==--', '# --== proj end exports ==--  '))
+
+  def edit(self, subdir, change):
+    path = os.path.join(subdir, 'CMakeLists.txt')
+    self.write(path, change(self.read(path)))
+
+  def check(self, args):
+    env = dict(os.environ)
+    env['PROJ_CACHE_DIR'] = os.path.join(self.dirname, 'cache')
+    status, out, err = self.call_proj(args, env=env)
+    return status, out
+
+  def test_check(self):
+    before = [file_key(os.path.join(self.dirname, d, 'CMakeLists.txt')) for d in ['.', 'name', 'markers', 'spaces']]
+    for args in (['--jobs=2', 'check', '--recursive'], ['--jobs=1', '--recursive', 'check']):
+      status, out = self.check(args)
+      self.assertEqual(1, status)
+      self.assertEqual([
+	'ERROR: 3 of 5 files failed the check',
+	'markers/CMakeLists.txt:22: unexpected chunk close marker \'addlib\' (expected \'headers\')',
+	'name/CMakeLists.txt:8: corrupted or missing project name',
+	'spaces/CMakeLists.txt:39: proj would not write this back as it is',
+      ], sorted(out.splitlines()))
+    self.assertEqual(before, [file_key(os.path.join(self.dirname, d, 'CMakeLists.txt')) for d in ['.', 'name', 'markers', 'spaces']])
+    self.assertFalse(os.path.exists(os.path.join(self.dirname, 'cache')))
+    self.assertEqual((0, '1 file ok\n'), self.check(['check']))
+
+class test_concurrency(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    self.run_proj(['new', 'executable', '--name', 'hello', '--sources', 'hello.cpp'])
+
+  def sources(self):
+    return sorted(i for i in self.run_proj(['list', '--sources']).split() if not i.startswith('['))
+
+  # Start adding a source in each of count processes at once and wait for them all
+  def add_in_parallel(self, preflags, count):
+    procs = [subprocess.Popen([sys.executable, proj] + preflags + ['add', '--sources', 'file%d.cpp' % i], cwd=self.dirname) for i in xrange(count)]
+    for p in procs:
+      self.assertEqual(0, p.wait())
+    return sorted(['hello.cpp'] + ['file%d.cpp' % i for i in xrange(count)])
+
+  def test_locked(self):
+    self.assertEqual(self.add_in_parallel([], 8), self.sources())
+
+  def test_optimistic(self):
+    self.assertEqual(self.add_in_parallel(['--optimistic'], 8), self.sources())
+
+  def test_waits_for_lock(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    lock = module._lock(os.path.realpath(self.filename))
+    try:
+      p = subprocess.Popen([sys.executable, proj, 'add', '--sources', 'more.cpp'], cwd=self.dirname, close_fds=True)
+      time.sleep(0.5)
+      self.assertEqual(None, p.poll())
+    finally:
+      module._unlock(lock)
+    self.assertEqual(0, p.wait())
+    self.assertEqual(['hello.cpp', 'more.cpp'], self.sources())
+
+  # Files in one directory share a lock, which one process takes once
+  def test_same_directory(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    module._lock_timeout = 1
+    self.run_proj(['--cmakelists=b.txt', 'new', 'executable', '--name', 'b'])
+    self.write('edits.txt', '--cmakelists=%s add --sources a.cpp\n--cmakelists=%s add --sources b.cpp\n' % (self.filename, os.path.join(self.dirname, 'b.txt')))
+    module.process_cmdline(['batch', os.path.join(self.dirname, 'edits.txt')])
+    self.assertEqual({}, module._held_locks)
+    self.assertEqual(['a.cpp', 'hello.cpp'], self.sources())
+    self.assertTrue('b.cpp\n' in self.read('b.txt'))
+
+  # A batch locks nothing while its commands run, and then locks every directory
+  # in the same order whatever order its commands got to them
+  def test_batch_lock_order(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    os.mkdir(os.path.join(self.dirname, 'sub'))
+    self.run_proj(['new', 'library', '--name', 'sub'], 'sub')
+    self.run_proj(['--cmakelists=z.txt', 'new', 'executable', '--name', 'z'])
+    locked = []
+    lock = module._lock
+    def record(filename):
+      locked.append(os.path.relpath(filename, os.path.realpath(self.dirname)))
+      return lock(filename)
+    module._lock = record
+    self.write('edits.txt', '--cmakelists=z.txt add --sources z.cpp\n--cmakelists=sub/CMakeLists.txt add --sources s.cpp\n--cmakelists=CMakeLists.txt add --sources c.cpp\n')
+    cwd = os.getcwd()
+    os.chdir(self.dirname)
+    try:
+      module.process_cmdline(['batch', 'edits.txt'])
+    finally:
+      os.chdir(cwd)
+    self.assertEqual(['CMakeLists.txt', 'z.txt', 'sub/CMakeLists.txt'], locked)
+    self.assertEqual({}, module._held_locks)
+
+  # An edit made while the file is changed by someone else is made again. The lock
+  # only keeps out other proj processes, so the file is changed directly.
+  def test_conflict_retried(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    preflags = ['--cmakelists=%s' % self.filename]
+    calls = []
+    def edit(chunks):
+      calls.append(chunks)
+      if len(calls) == 1:
+	f = open(self.filename, 'a')
+	f.write('# changed\n')
+	f.close()
+      module._add_or_remove(module.Project(chunks), {'--sources': ['more.cpp']}, True)
+    for flag in ([], ['--optimistic']):
+      del calls[:]
+      module._edit(preflags + flag, edit)
+      self.assertEqual(2, len(calls))
+    self.assertEqual(['hello.cpp', 'more.cpp'], self.sources())
+    self.assertEqual(2, open(self.filename).read().count('# changed\n'))
+
+  # Chunks kept by the server after the whole file was written still catch a
+  # change made by someone else while they're being edited
+  def test_conflict_after_rewrite(self):
+    import imp
+    module = imp.load_source('proj_module', proj)
+    module._tree_cache = {}
+    filename = os.path.join(self.dirname, 'other.txt')
+    preflags = ['--cmakelists=%s' % filename]
+    module.process_cmdline(preflags + ['new', 'executable', '--name', 'other'])
+    session = module._Session(preflags, lock=True)
+    try:
+      self.assertTrue(session.chunks is module._tree_cache[os.path.realpath(filename)][1])
+      f = open(filename, 'a')
+      f.write('# changed\n')
+      f.close()
+      self.assertRaises(module.ConflictError, session.commit)
+    finally:
+      session.close()
+
+class test_project(ProjTestCase):
+  def setUp(self):
+    ProjTestCase.setUp(self)
+    import imp
+    # Importing proj.py mustn't run anything
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+      self.proj = imp.load_source('proj_module', proj)
+    finally:
+      sys.stdout = stdout
+    self.run_proj(['new', 'executable', '--name', 'app', '--sources', 'a.cpp', 'b.cpp'])
+
+  def list(self, what):
+    return [i.strip() for i in self.run_proj(['list', what]).splitlines() if i.strip() and not i.startswith('[')]
+
+  def test_edits(self):
+    project = self.proj.Project.open(self.dirname)
+    self.assertEqual('app', project.name())
+    self.assertEqual('executable', project.type())
+    project.add_sources(['c.cpp'])
+    project.remove_sources(['a.cpp'])
+    project.add_sources(['a.cpp', 'd.cpp'])
+    project.set_define('FOO')
+    project.set_define('BAR', '1', 'PUBLIC')
+    project.set_define('BAR', '2', 'PUBLIC')
+    project.add_lib('m')
+    project.add_subdir('tests')
+    # Nothing is written until the project is saved
+    self.assertEqual(['a.cpp', 'b.cpp'], self.list('--sources'))
+    project.save()
+    self.assertEqual(['b.cpp', 'c.cpp', 'a.cpp', 'd.cpp'], self.list('--sources'))
+    text = self.read()
+    for line in ['target_compile_definitions(app PRIVATE -DFOO)', 'target_compile_definitions(app PUBLIC -DBAR=2)', 'target_link_libraries(app general m)', 'add_subdirectory(tests)']:
+      self.assertEqual(1, text.count(line + '\n'), line)
+
+    # The project can go on being edited and saved
+    project.remove_define('FOO')
+    project.remove_lib('m')
+    project.remove_subdir('tests')
+    project.save()
+    text = self.read()
+    self.assertFalse('-DFOO' in text or 'general m' in text or 'add_subdirectory' in text, text)
+
+  # Queued edits are made to each chunk in one pass, and only the chunks that
+  # changed are written. How long that takes is measured by bench.py.
+  def test_many_edits(self):
+    calls = []
+    def spy(name):
+      func = getattr(self.proj, name)
+      def call(*args):
+	calls.append(name)
+	return func(*args)
+      setattr(self.proj, name, call)
+    for name in ['_add_to_chunk', '_edit_statements', '_stage_chunks']:
+      spy(name)
+    stage_edits = self.proj._stage_edits
+    edits = []
+    def record_edits(filename, e):
+      edits.extend(e)
+      return stage_edits(filename, e)
+    self.proj._stage_edits = record_edits
+    project = self.proj.Project.open(os.path.join(self.dirname, 'CMakeLists.txt'))
+    for i in xrange(2000):
+      project.add_sources(['src/f%d.cpp' % i])
+      project.set_define('D%d' % i, str(i))
+    project.save()
+    self.assertEqual(['_add_to_chunk', '_edit_statements'], calls)
+    self.assertEqual(2, len(edits))
+    self.assertEqual(2002, len(self.list('--sources')))
+    self.assertEqual(2000, self.read().count('target_compile_definitions('))
+
+  def test_errors(self):
+    project = self.proj.Project.open(self.dirname)
+    project.add_sources(['c.cpp'])
+    self.write('CMakeLists.txt', self.read() + '# changed\n')
+    self.assertRaises(self.proj.ConflictError, project.save)
+    self.assertEqual(['a.cpp', 'b.cpp'], self.list('--sources'))
+    self.assertRaises(self.proj.EditError, project.set_define, 'FOO', None, 'PROTECTED')
+
+    os.mkdir(os.path.join(self.dirname, 'top'))
+    self.run_proj(['new', 'rootproject', '--name', 'top'], 'top')
+    top = self.proj.Project.open(os.path.join(self.dirname, 'top'))
+    self.assertRaises(self.proj.EditError, top.add_sources, ['a.cpp'])
+    # A rootproject has no target to link
+    self.assertRaises(self.proj.ProjectError, top.add_lib, 'm')
+
+    self.write('CMakeLists.txt', '# --== proj begin sources ==--\n')
+    self.assertRaises(self.proj.ParseError, self.proj.Project.open, self.dirname)
+    self.write('CMakeLists.txt', 'project(other)\n')
+    self.assertRaises(self.proj.ProjectError, self.proj.Project.open(self.dirname).name)
+    # All of them are Errors
+    self.assertTrue(issubclass(self.proj.ConflictError, self.proj.Error))
+
+if __name__ == '__main__':
+    unittest.main()
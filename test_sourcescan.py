@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import sourcescan
+import unittest
+
+tree = [
+  'main.cpp',
+  'main.h',
+  'notes.txt',
+  'src/a.cpp',
+  'src/a.h',
+  'src/b.c',
+  'src/test_a.cpp',
+  'src/detail/c.cpp',
+  'build/generated.cpp',
+  'third_party/lib/x.cpp',
+  '.git/hooks/hook.cpp',
+]
+
+class test_sourcescan(unittest.TestCase):
+  def setUp(self):
+    self.top = tempfile.mkdtemp()
+    for path in tree:
+      self.write(path, '')
+
+  def tearDown(self):
+    shutil.rmtree(self.top)
+
+  def write(self, path, data):
+    path = os.path.join(self.top, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    f = open(path, 'w')
+    f.write(data)
+    f.close()
+
+  def scan(self, include, exclude=[]):
+    return [p[len(self.top) + 1:] for p in sourcescan.scan([self.top], include, exclude)]
+
+  def test_sources(self):
+    self.assertEqual(['main.cpp', 'build/generated.cpp', 'src/a.cpp', 'src/b.c', 'src/test_a.cpp', 'src/detail/c.cpp', 'third_party/lib/x.cpp'], self.scan(sourcescan.SOURCES))
+
+  def test_headers(self):
+    self.assertEqual(['main.h', 'src/a.h'], self.scan(sourcescan.HEADERS))
+
+  def test_exclude_names_and_dirs(self):
+    self.assertEqual(['main.cpp', 'src/a.cpp', 'src/b.c', 'src/detail/c.cpp'], self.scan(sourcescan.SOURCES, ['test_*', 'build/', 'third_party']))
+
+  def test_exclude_path(self):
+    self.assertEqual(['main.cpp', 'build/generated.cpp', 'src/a.cpp', 'src/b.c', 'src/test_a.cpp', 'third_party/lib/x.cpp'], self.scan(sourcescan.SOURCES, ['src/detail']))
+
+  def test_ignorefile(self):
+    self.write('.projignore', '# Generated code\nbuild/\n\nthird_party/lib\n')
+    self.write('src/.projignore', 'test_*.cpp\ndetail/c.cpp\n')
+    self.assertEqual(['main.cpp', 'src/a.cpp', 'src/b.c'], self.scan(sourcescan.SOURCES))
+
+  def test_dir_only_rule(self):
+    self.write('odd.cpp/y.cpp', '')
+    self.assertEqual(['main.cpp', 'build/generated.cpp', 'src/a.cpp', 'src/b.c', 'src/test_a.cpp', 'src/detail/c.cpp', 'third_party/lib/x.cpp'], self.scan(sourcescan.SOURCES, ['*.cpp/']))
+
+  # Directories skip says so are left out, but a top directory never is
+  def test_skip(self):
+    self.write('third_party/CMakeLists.txt', '')
+    skip = lambda dirname, entries: ('CMakeLists.txt', False) in entries
+    found = [p[len(self.top) + 1:] for p in sourcescan.scan([self.top], sourcescan.SOURCES, [], None, skip)]
+    self.assertEqual(['main.cpp', 'build/generated.cpp', 'src/a.cpp', 'src/b.c', 'src/test_a.cpp', 'src/detail/c.cpp'], found)
+    self.assertEqual(['x.cpp'], [os.path.basename(p) for p in sourcescan.scan([os.path.join(self.top, 'third_party')], sourcescan.SOURCES, [], None, skip)])
+
+  def test_relative_top(self):
+    cwd = os.getcwd()
+    os.chdir(self.top)
+    try:
+      self.assertEqual(['main.h', 'src/a.h'], list(sourcescan.scan(['.'], sourcescan.HEADERS)))
+      self.assertEqual(['src/a.h'], list(sourcescan.scan(['src/'], sourcescan.HEADERS)))
+    finally:
+      os.chdir(cwd)
+
+  def age(self, path, seconds):
+    path = os.path.join(self.top, path)
+    # Whole seconds survive the round trip through utime exactly
+    t = int(os.stat(path).st_mtime) - seconds
+    os.utime(path, (t, t))
+
+  # Unchanged directories are not listed again
+  def test_snapshot_reuses_listing(self):
+    self.age('src', 60)
+    snapshot = sourcescan.Snapshot()
+    self.assertEqual(['src/a.h'], self.scan_snapshot(snapshot))
+    # Sneak a file in without changing the directory's mtime
+    mtime = os.stat(os.path.join(self.top, 'src')).st_mtime
+    self.write('src/b.h', '')
+    os.utime(os.path.join(self.top, 'src'), (mtime, mtime))
+    snapshot = sourcescan.Snapshot(snapshot.dirs)
+    self.assertEqual(['src/a.h'], self.scan_snapshot(snapshot))
+    # Any change to the directory's mtime makes it be listed again
+    self.age('src', 10)
+    snapshot = sourcescan.Snapshot(snapshot.dirs)
+    self.assertEqual(['src/a.h', 'src/b.h'], self.scan_snapshot(snapshot))
+
+  # A recently modified directory might change again within its mtime resolution
+  def test_snapshot_distrusts_recent_changes(self):
+    snapshot = sourcescan.Snapshot()
+    self.scan_snapshot(snapshot)
+    self.assertEqual(None, snapshot.dirs[os.path.join(self.top, 'src')][0])
+
+  def test_snapshot_keeps_only_scanned_dirs(self):
+    snapshot = sourcescan.Snapshot()
+    self.scan_snapshot(snapshot)
+    shutil.rmtree(os.path.join(self.top, 'src', 'detail'))
+    snapshot = sourcescan.Snapshot(snapshot.dirs)
+    self.scan_snapshot(snapshot)
+    self.assertFalse(os.path.join(self.top, 'src', 'detail') in snapshot.dirs)
+
+  def scan_snapshot(self, snapshot):
+    top = os.path.join(self.top, 'src')
+    return [p[len(self.top) + 1:] for p in sourcescan.scan([top], sourcescan.HEADERS, [], snapshot)]
+
+if __name__ == '__main__':
+    unittest.main()